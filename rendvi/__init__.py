@@ -1,13 +1,50 @@
 __version__ = "0.0.1"
 
-import ee
 import string
 import random
-import datetime
-from rendvi.core import *
-from rendvi.masking import *
-from rendvi.smoothing import *
-from rendvi import eeCollections
+import importlib
+
+# public names and the module they live in, modules are only imported (and ee with them)
+# the first time one of their names is accessed (PEP 562)
+_lazyAttributes = {
+    "Utils": "rendvi.core",
+    "Rendvi": "rendvi.core",
+    "Masking": "rendvi.masking",
+    "Smoother": "rendvi.smoothing",
+    "MovingLinearRegress": "rendvi.smoothing",
+    "Whittaker": "rendvi.smoothing",
+    "LocalUtils": "rendvi.local",
+    "LocalRendvi": "rendvi.local",
+    "LocalMasking": "rendvi.local",
+    "ClimatologyBuilder": "rendvi.climatology",
+    "TileScheduler": "rendvi.tiling",
+    "CubeStore": "rendvi.cubestore",
+    "SensorFusion": "rendvi.fusion",
+    "ArraySeries": "rendvi.arrayseries",
+    "LocalExporter": "rendvi.localexport",
+    "ExportScheduler": "rendvi.scheduler",
+    "ExportManifest": "rendvi.manifest",
+    "TimeSeriesExtractor": "rendvi.timeseries",
+}
+_lazySubmodules = ("core", "masking", "smoothing", "local", "scheduler", "timeseries",
+                   "cache", "profiling", "decorators", "forecast", "eeCollections",
+                   "climatology", "tiling", "cubestore", "fusion", "arrayseries",
+                   "localexport", "manifest")
+
+
+def __getattr__(name):
+    if name in _lazyAttributes:
+        value = getattr(importlib.import_module(_lazyAttributes[name]), name)
+    elif name in _lazySubmodules:
+        value = importlib.import_module(f"rendvi.{name}")
+    else:
+        raise AttributeError(f"module 'rendvi' has no attribute '{name}'")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + list(_lazyAttributes.keys()) + list(_lazySubmodules))
 
 # try:
 #     ee.Initialize()
@@ -16,11 +53,15 @@ from rendvi import eeCollections
 
 
 def exportImage(image, region, assetId, description=None, scale=1000, crs='EPSG:4326', pyramiding=None):
+    import ee
     if (description == None) or (type(description) != str):
         description = ''.join(random.SystemRandom().choice(
             string.ascii_letters) for _ in range(8)).lower()
-    # get serializable geometry for export
-    exportRegion = region.bounds().getInfo()['coordinates']
+    # get serializable geometry for export, coordinates can be passed in directly
+    if isinstance(region, ee.Geometry):
+        exportRegion = region.bounds().getInfo()['coordinates']
+    else:
+        exportRegion = region
 
     if pyramiding is None:
         pyramiding = {'.default': 'mean'}
@@ -41,35 +82,16 @@ def exportImage(image, region, assetId, description=None, scale=1000, crs='EPSG:
     return
 
 
-def batchExport(collection, region, collectionAsset, prefix=None, suffix=None, scale=1000, crs='EPSG:4326', metadata=None, pyramiding=None):
-    n = collection.size()
-    exportImages = collection.sort('system:time_start', False).toList(n)
-    nIter = n.getInfo()
+def batchExport(collection, region, collectionAsset, prefix=None, suffix=None, scale=1000, crs='EPSG:4326', metadata=None, pyramiding=None,
+                maxConcurrent=20, maxRetries=3, skipExisting=True, overwrite=False, wait=True, **kwargs):
+    from rendvi.scheduler import ExportScheduler
+    # bounded submission with retries, waits for the tasks to finish unless wait=False,
+    # see rendvi.scheduler.ExportScheduler for the throttling, polling and retry options
+    scheduler = ExportScheduler(region, scale=scale, crs=crs, pyramiding=pyramiding, maxConcurrent=maxConcurrent,
+                                maxRetries=maxRetries, skipExisting=skipExisting, overwrite=overwrite, **kwargs)
 
-    for i in range(nIter):
-        img = ee.Image(exportImages.get(i))
-        if metadata is not None:
-            img = img.set(metadata)
+    scheduler.addCollection(collection, collectionAsset, prefix=prefix, suffix=suffix, metadata=metadata)
 
-        t = img.get('system:time_start').getInfo()
-        date = datetime.datetime.utcfromtimestamp(
-            t / 1e3).strftime("%Y%m%d")
+    scheduler.run(wait=wait)
 
-        exportName = date
-        if prefix is not None:
-            exportName = f"{prefix}_" + exportName
-        if suffix is not None:
-            exportName = exportName + f"_{suffix}"
-
-        description = exportName
-        print(f"running export for {description}")
-
-        if not collectionAsset.endswith('/'):
-            collectionAsset += '/'
-
-        exportName=collectionAsset + description
-
-        exportImage(img, region, exportName, description=description,
-                    scale=scale, crs=crs, pyramiding=pyramiding)
-
-    return
+    return scheduler
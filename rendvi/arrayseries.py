@@ -0,0 +1,363 @@
+import re
+import ee
+import numpy as np
+import pandas as pd
+from rendvi.core import Utils, Rendvi
+from rendvi.smoothing import Smoother, MovingLinearRegress
+from rendvi.forecast import Harmonics
+
+
+class ArraySeries:
+    """
+    Dekad series held as array images with time on the array axis, one 1-D array image per
+    band plus a 0/1 'valid' array for masked observations. The dates are fetched once when
+    the series is built so every temporal window is a constant resolved client side, and
+    despike, back-fill, moving regression and harmonics become a few shifted arraySlice
+    terms, elementwise reductions and matrix solves per pixel instead of a filterDate per
+    date. Spatial smoothing runs on the flattened stack in one reduceNeighborhood call.
+    toRendvi converts back to an ImageCollection, normally only for export.
+    """
+    # placeholder for masked values in elementwise max and sort, larger than any NDVI
+    fillValue = 1e30
+
+    def __init__(self, arrays, valid, dates, band, seed=0):
+        self.arrays = arrays
+        self.valid = valid
+        self.dates = list(dates)
+        self.BAND = band
+        self.SEED = seed
+        return
+
+    def __repr__(self):
+        return f"ArraySeries({self.BAND}, {len(self)} dates, {list(self.arrays)})"
+
+    def __len__(self):
+        return len(self.dates)
+
+    @classmethod
+    def fromRendvi(cls, collection, keepBandPattern="^(pct|nClear).*"):
+        ic = collection.IC.sort('system:time_start')
+        keep = ee.Image(ic.first()).select(keepBandPattern).bandNames() if keepBandPattern is not None else ee.List([])
+
+        # single round trip for the dates and kept band names
+        dates, keepNames = ee.List([ic.aggregate_array('system:time_start'), keep]).getInfo()
+        names = [collection.BAND] + [name for name in keepNames if name != collection.BAND]
+
+        def _stack(img):
+            valid = img.select(collection.BAND).mask().gt(0).rename('valid')
+            return ee.Image.cat([valid] + [img.select(name).unmask(0).float() for name in names])
+
+        # T x (1 + bands) array, every band is split into its own 1-D array
+        stack = ic.map(_stack).toArray()
+
+        def _column(k):
+            return stack.arraySlice(1, k, k + 1).arrayProject([0])
+
+        arrays = {name: _column(k + 1) for k, name in enumerate(names)}
+        return cls(arrays, _column(0), dates, collection.BAND, collection.SEED)
+
+    def toRendvi(self):
+        names = list(self.arrays)
+        stack = ee.Image.cat([self.arrays[name] for name in names] + [self.valid])
+        dates = ee.List(self.dates)
+
+        def _image(i):
+            i = ee.Number(i).int()
+            d = ee.Date(dates.get(i))
+            img = stack.arraySlice(0, i, i.add(1)).arrayFlatten([['0']]).rename(names + ['valid'])
+            value = img.select(self.BAND).updateMask(img.select('valid'))
+            return ee.Image.cat([value, img.select(names[1:]), Utils.timeBand(d)])\
+                .set('system:time_start', d.millis())
+
+        images = ee.List.sequence(0, len(self) - 1).map(_image)
+        return Rendvi(ee.ImageCollection.fromImages(images), self.BAND, self.SEED)
+
+    # constant array image of a 1-D or 2-D sequence
+    @staticmethod
+    def _const(values):
+        return ee.Image(ee.Array(np.asarray(values, dtype=np.float64).tolist()))
+
+    # a where test is 1, b where it is 0
+    @staticmethod
+    def _blend(test, a, b):
+        return test.multiply(a).add(test.Not().multiply(b))
+
+    # divide with zero denominators replaced by one
+    @staticmethod
+    def _safeDivide(a, b):
+        return a.divide(b.add(b.eq(0)))
+
+    # times of the series in time units relative to the first date
+    def _times(self, timeUnits="day"):
+        millis = np.asarray(self.dates, dtype=np.float64)
+        return (millis - millis[0]) / Smoother.unitMillis[timeUnits]
+
+    def _keep(self, pattern):
+        if pattern is None:
+            return {}
+        return {name: arr for name, arr in self.arrays.items()
+                if name != self.BAND and re.fullmatch(pattern, name)}
+
+    def _derive(self, arrays, valid, index=slice(None)):
+        def _slice(arr):
+            if index == slice(None):
+                return arr
+            start, stop, _ = index.indices(len(self))
+            return arr.arraySlice(0, start, stop)
+        return ArraySeries({name: _slice(arr) for name, arr in arrays.items()}, _slice(valid),
+                           self.dates[index], self.BAND, self.SEED)
+
+    # out[i] = arr[i + k], zero past either end of the series
+    def _shift(self, arr, k):
+        n = len(self)
+        if k == 0:
+            return arr
+        if abs(k) >= n:
+            return self._const(np.zeros(n))
+        pad = self._const(np.zeros(abs(k)))
+        if k > 0:
+            return arr.arraySlice(0, k, n).arrayCat(pad, 0)
+        return pad.arrayCat(arr.arraySlice(0, 0, n + k), 0)
+
+    # (shifted, member) terms covering the index window [lo[i], hi[i]) of every date i
+    def _window(self, arr, lo, hi):
+        pos = np.arange(len(self))
+        lo, hi = np.asarray(lo), np.asarray(hi)
+        nonEmpty = hi > lo
+        if not nonEmpty.any():
+            return []
+        terms = []
+        for k in range(int((lo - pos)[nonEmpty].min()), int((hi - 1 - pos)[nonEmpty].max()) + 1):
+            member = (pos + k >= lo) & (pos + k < hi)
+            if member.any():
+                terms.append((self._shift(arr, k), self._const(member)))
+        return terms
+
+    def _windowSum(self, arr, lo, hi):
+        out = self._const(np.zeros(len(self)))
+        for shifted, member in self._window(arr, lo, hi):
+            out = out.add(shifted.multiply(member))
+        return out
+
+    def _windowMax(self, arr, valid, lo, hi):
+        out = self._const(np.full(len(self), -self.fillValue))
+        for (shifted, member), (ok, _) in zip(self._window(arr, lo, hi), self._window(valid, lo, hi)):
+            out = out.max(self._blend(ok.multiply(member), shifted, -self.fillValue))
+        return out
+
+    def applyDespike(self, window=30, step=10, offset=1, timeUnits="day", keepBandPattern="^(pct|nClear).*"):
+        days = self._times(timeUnits)
+        value, valid = self.arrays[self.BAND], self.valid
+
+        # fore and aft windows of Rendvi.applyDespike as index ranges
+        foreLo = np.searchsorted(days, days - (window - offset))
+        foreHi = np.searchsorted(days, days - (step - offset))
+        aftLo = np.searchsorted(days, days + (step + offset))
+        aftHi = np.searchsorted(days, days + (window + offset))
+
+        tempMax = self._windowMax(value, valid, foreLo, foreHi).max(self._windowMax(value, valid, aftLo, aftHi))
+        nValid = self._windowSum(valid, foreLo, foreHi).add(self._windowSum(valid, aftLo, aftHi))
+
+        # dates without any neighbor compare against the seeded random image as in the filter method
+        noNeighbors = self._const(((foreHi <= foreLo) & (aftHi <= aftLo)).astype(float))
+        random = ee.Image.random(self.SEED).subtract(0.5).multiply(2).toArray().arrayRepeat(0, len(self))
+        Bn = self._blend(noNeighbors, random, tempMax).multiply(1.1)
+
+        # masked when every neighbor is masked, like the max of fully masked neighbors
+        defined = valid.multiply(noNeighbors.add(nValid.gt(0)).gt(0))
+        low = value.lt(Bn)
+
+        arrays = {self.BAND: value, 'despiked': defined.multiply(low.Not())}
+        arrays.update(self._keep(keepBandPattern))
+
+        include = window // step
+        return self._derive(arrays, defined.multiply(low), slice(include, len(self) - include))
+
+    # dekad of year (0-35) of every date with the leap year table of Rendvi.climatologyBackFill
+    def _dekads(self):
+        dates = pd.to_datetime(self.dates, unit='ms')
+        out = np.empty(len(dates), dtype=np.int64)
+        for i, d in enumerate(dates):
+            table = Utils.leapYearDekadDoy if d.year % 4 == 0 else Utils.perpetualDekadDoy
+            out[i] = np.searchsorted(table[1:36], d.dayofyear, side='right')
+        return out
+
+    def climatologyBackFill(self, climatology, nPeriods=5, step=10, keepBandPattern="^(pct|nClear).*"):
+        value, valid = self.arrays[self.BAND], self.valid
+        names = [f"d{i}" for i in range(len(self))]
+        dekads = self._dekads().tolist()
+
+        # climatology of the dekad of every date picked by band number from the 36 band stacks
+        climatology = climatology.sort('system:time_start')
+
+        def _lookup(selector, scale=0.0001):
+            return climatology.select(selector).toBands().multiply(scale).select(dekads, names)
+
+        # the count is compared unscaled as in Rendvi, so only dekads without observations are masked
+        climoMean, climoStd, climoCount = _lookup('.*mean'), _lookup('.*stdDev'), _lookup('count', 1)
+        climoValid = climoMean.mask().And(climoStd.mask()).toArray()
+        climoMean, climoStd = climoMean.unmask(0).toArray(), climoStd.unmask(0).toArray()
+
+        zScore = self._safeDivide(value.subtract(climoMean), climoStd)
+        zValid = valid.multiply(climoCount.gt(0.6).unmask(0).toArray())
+
+        # previous dekads within [t - nDays, t - 1 day), same window as the lookup method
+        millis = np.asarray(self.dates, dtype=np.float64)
+        nDays = (nPeriods * step) + 5
+        lo = np.searchsorted(millis, millis - nDays * 86400000)
+        hi = np.searchsorted(millis, millis - 86400000)
+
+        zCount = self._windowSum(zValid, lo, hi)
+        zMean = self._safeDivide(self._windowSum(zScore.multiply(zValid), lo, hi), zCount)
+
+        # no fill when previous dekads exist but none has a z-score, z = 0 without previous dekads
+        hasPrevious = self._const((hi > lo).astype(float))
+        fillOk = climoValid.multiply(zCount.eq(0).multiply(hasPrevious).Not())
+        fillValue = climoMean.add(zMean.multiply(climoStd))
+
+        arrays = {self.BAND: self._blend(valid, value, fillValue)}
+        arrays.update(self._keep(keepBandPattern))
+        arrays['climatologyFilled'] = valid.Not().multiply(fillOk)
+
+        return self._derive(arrays, valid.max(fillOk))
+
+    def spatialSmoothing(self, kernel, zThreshold=1, constraintBand='^clima.*', keepBandPattern="^(pct|nClear).*"):
+        value, valid = self.arrays[self.BAND], self.valid
+        names = [f"d{i}" for i in range(len(self))]
+        constraint = [arr for name, arr in self.arrays.items() if re.fullmatch(constraintBand, name)][0]
+
+        # every date as a band so the neighborhood statistics are a single reduceNeighborhood
+        stack = value.arrayFlatten([names]).updateMask(valid.arrayFlatten([names]))
+        reducers = ee.Reducer.mean().combine(ee.Reducer.stdDev(), '', True)
+        reduced = stack.reduceNeighborhood(reducers, kernel)
+        mean = reduced.select([f"{name}_mean" for name in names])
+        std = reduced.select([f"{name}_stdDev" for name in names]).unmask(0).toArray()
+        meanValid = mean.mask().gt(0).toArray()
+        mean = mean.unmask(0).toArray()
+
+        outside = self._safeDivide(value.subtract(mean), std).abs()
+        inside = outside.lt(zThreshold).Or(constraint.eq(0))
+        keepValue = valid.multiply(meanValid).multiply(inside)
+
+        arrays = {self.BAND: self._blend(keepValue, value, mean)}
+        arrays.update(self._keep(keepBandPattern))
+        arrays['spatialSmoothed'] = valid.multiply(meanValid).multiply(inside.Not())
+
+        return self._derive(arrays, keepValue.max(meanValid))
+
+    # sort the arrays elementwise with a bubble network of min/max pairs
+    @staticmethod
+    def _sortNetwork(arrays):
+        arrays = list(arrays)
+        for i in range(len(arrays)):
+            for j in range(len(arrays) - 1 - i):
+                a, b = arrays[j], arrays[j + 1]
+                arrays[j], arrays[j + 1] = a.min(b), a.max(b)
+        return arrays
+
+    def applySmoothing(self, window=30, step=10, maxStack=6, offset=1, timeUnits="day", keepBandPattern="^(pct|nClear).*"):
+        n = len(self)
+        days = self._times(timeUnits)
+        value, valid = self.arrays[self.BAND], self.valid
+
+        # windows of the moving regression as index ranges, centered on the dates idx
+        smoother = MovingLinearRegress(self, window=window, step=step, offset=offset,
+                                       timeUnits=timeUnits, maxStack=maxStack)
+        idx, lo, hi = smoother._windows(days)
+        first, last = smoother._overlaps(idx, lo, hi)
+        windowLo, windowHi = np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64)
+        windowLo[idx], windowHi[idx] = lo, hi
+
+        x = self._const(days)
+        xv = x.multiply(valid)
+        y = value.multiply(valid)
+        count, sx, sy, sxy, sxx = [self._windowSum(term, windowLo, windowHi)
+                                   for term in (valid, xv, y, xv.multiply(y), xv.multiply(x))]
+
+        den = count.multiply(sxx).subtract(sx.pow(2))
+        fitted = count.gt(1).And(den.gt(0))
+        scale = self._safeDivide(count.multiply(sxy).subtract(sx.multiply(sy)), den)
+        intercept = self._safeDivide(sy.subtract(scale.multiply(sx)), count)
+
+        # candidate fits of each date from the windows first..last, window j is centered on idx[j]
+        windowOf = np.full(n, -1)
+        windowOf[idx] = np.arange(idx.size)
+        fromWindow, toWindow = np.full(n, 0), np.full(n, -1)
+        fromWindow[idx], toWindow[idx] = first, last
+        candidates, counts = [], []
+        shifts = (first - np.arange(idx.size)).tolist() + (last - np.arange(idx.size)).tolist()
+        for k in range(min(shifts, default=0), max(shifts, default=-1) + 1):
+            target = windowOf + k
+            member = (windowOf >= 0) & (target >= fromWindow) & (target <= toWindow)
+            if not member.any():
+                continue
+            ok = self._shift(fitted, k).multiply(self._const(member))
+            fit = self._shift(scale, k).multiply(x).add(self._shift(intercept, k))
+            candidates.append(self._blend(ok, fit, self.fillValue))
+            counts.append(ok)
+
+        # median of the valid candidates, masked candidates sort to the end
+        nFits = self._const(np.zeros(n))
+        for ok in counts:
+            nFits = nFits.add(ok)
+        lower = nFits.subtract(1).divide(2).floor()
+        upper = nFits.subtract(1).divide(2).ceil()
+        median = self._const(np.zeros(n))
+        for r, sortedFit in enumerate(self._sortNetwork(candidates)):
+            median = median.add(sortedFit.multiply(lower.eq(r).add(upper.eq(r))).divide(2))
+        hasFit = nFits.gt(0)
+
+        arrays = {self.BAND: self._blend(hasFit, median, 0)}
+        arrays.update(self._keep(keepBandPattern))
+        arrays['temporalFilled'] = valid.Not().multiply(hasFit)
+
+        include = window // step
+        return self._derive(arrays, hasFit, slice(include, n - include))
+
+    # harmonic regression of the valid observations with one design matrix for all pixels,
+    # returns a fitted Harmonics model with the coefficients as a multi-band image
+    def fitHarmonics(self, nCycles=3):
+        model = Harmonics(nCycles=nCycles)
+        design = model._design(pd.to_datetime(self.dates, unit='ms'))
+        n, p = design.shape
+        shape = ee.Image(ee.Array([n, 1]))
+
+        x = self._const(design)
+        y = self.arrays[self.BAND].multiply(self.valid).arrayReshape(shape, 2)
+        xw = x.multiply(self.valid.arrayReshape(shape, 2).arrayRepeat(1, p))
+
+        # weighted normal equations (X'WX) b = X'Wy
+        gram = xw.matrixTranspose().matrixMultiply(x)
+        coefficients = gram.matrixSolve(xw.matrixTranspose().matrixMultiply(y))
+
+        nValid = self.valid.arrayReduce(ee.Reducer.sum(), [0]).arrayGet([0])
+        model.coefficients = coefficients.arrayProject([0]).arrayFlatten([model.independents])\
+            .updateMask(nValid.gte(p))
+        model.dependents = [self.BAND]
+        return model
+
+    # predictions of a harmonic model fitted by fitHarmonics for the dates of the series
+    def predictHarmonics(self, model):
+        design = model._design(pd.to_datetime(self.dates, unit='ms'))
+        coefficients = model.coefficients.select(model.independents)
+        predicted = self._const(design).matrixMultiply(coefficients.toArray().arrayReshape(
+            ee.Image(ee.Array([len(model.independents), 1])), 2)).arrayProject([0])
+        valid = coefficients.mask().reduce(ee.Reducer.min()).unmask(0).toArray().arrayRepeat(0, len(self))
+        return ArraySeries({'predicted': predicted.unmask(0)}, valid, self.dates, 'predicted', self.SEED)
+
+    # the standard chain of Rendvi.runPipeline on the array representation
+    def runPipeline(self, climatology, kernel, despikeWindow=30, step=10, offset=1, nPeriods=5, zThreshold=1,
+                    smoothingWindow=50, maxStack=6):
+        despiked = self.applyDespike(window=despikeWindow, step=step, offset=offset,
+                                     keepBandPattern="^(pct|nClear).*")
+
+        backFilled = despiked.climatologyBackFill(climatology, nPeriods=nPeriods, step=step,
+                                                  keepBandPattern="^(de|pct|nClear).*")
+
+        spatialSmoothed = backFilled.spatialSmoothing(kernel, zThreshold=zThreshold,
+                                                      keepBandPattern="^(clima|de|pct|nClear|t).*")
+
+        smoothed = spatialSmoothed.applySmoothing(window=smoothingWindow, step=step, maxStack=maxStack, offset=offset,
+                                                  keepBandPattern="^(clima|de|pct|nClear|sp).*")
+
+        return smoothed
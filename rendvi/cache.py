@@ -0,0 +1,284 @@
+import os
+import ee
+import json
+import time
+import shutil
+import hashlib
+import contextlib
+import numpy as np
+import xarray as xr
+from pathlib import Path
+from rendvi.cubestore import CubeStore
+from rendvi.scheduler import ExportScheduler, listAssets
+
+# cache used by the stage methods decorated with rendvi.decorators.cachedStage
+_activeCache = None
+
+
+def getCache():
+    return _activeCache
+
+
+def setCache(cache):
+    global _activeCache
+    _activeCache = cache
+    return
+
+
+@contextlib.contextmanager
+def useCache(cache):
+    previous = getCache()
+    setCache(cache)
+    try:
+        yield cache
+    finally:
+        setCache(previous)
+
+
+class StageCache:
+    """
+    Base class for caching intermediate pipeline stages. Entries are keyed by a content
+    hash of the input collection (or the key of the cached stage it came from), the stage
+    name and the stage parameters, and are tracked in a JSON index for LRU eviction.
+    """
+    def __init__(self, indexPath):
+        self.indexPath = Path(indexPath).expanduser()
+        self.indexPath.parent.mkdir(parents=True, exist_ok=True)
+        self.index = self._readIndex()
+        return
+
+    def _readIndex(self):
+        if self.indexPath.is_file():
+            return json.loads(self.indexPath.read_text())
+        return {}
+
+    def _writeIndex(self):
+        tmp = self.indexPath.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self.index, indent=2))
+        os.replace(str(tmp), str(self.indexPath))
+        return
+
+    # hashable token for stage parameters, including ee objects and arrays
+    def _token(self, value):
+        if isinstance(value, ee.ComputedObject):
+            return value.serialize()
+        if isinstance(value, (xr.Dataset, xr.DataArray)):
+            return self._hashDataset(value)
+        if isinstance(value, np.ndarray):
+            return hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()
+        if isinstance(value, dict):
+            return {str(k): self._token(v) for k, v in sorted(value.items())}
+        if isinstance(value, (list, tuple)):
+            return [self._token(v) for v in value]
+        if hasattr(value, 'cacheKey') and value.cacheKey is not None:
+            return value.cacheKey
+        return repr(value)
+
+    @staticmethod
+    def _hashDataset(ds):
+        if isinstance(ds, xr.DataArray):
+            ds = ds.to_dataset(name=ds.name or 'values')
+        h = hashlib.sha1()
+        for name in sorted(list(ds.coords) + list(ds.data_vars), key=str):
+            h.update(str(name).encode())
+            h.update(np.ascontiguousarray(ds[name].values).tobytes())
+        return h.hexdigest()
+
+    def inputKey(self, collection):
+        raise NotImplementedError
+
+    def key(self, collection, stage, params):
+        payload = json.dumps({
+            'input': self.inputKey(collection),
+            'band': collection.BAND,
+            'seed': collection.SEED,
+            'stage': stage,
+            'params': self._token(params),
+        }, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def supports(self, collection):
+        raise NotImplementedError
+
+    def fetch(self, collection, stage, params, compute):
+        if not self.supports(collection):
+            return compute()
+
+        key = self.key(collection, stage, params)
+
+        out = self.load(key, collection) if key in self.index else None
+        if out is None:
+            out = compute()
+            self.store(key, stage, out)
+        else:
+            self.index[key]['lastAccess'] = time.time()
+            self._writeIndex()
+
+        out.cacheKey = key
+        return out
+
+    def load(self, key, collection):
+        raise NotImplementedError
+
+    def store(self, key, stage, out):
+        raise NotImplementedError
+
+    def remove(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        for key in list(self.index.keys()):
+            self.remove(key)
+        return
+
+
+class LocalStageCache(StageCache):
+    """
+    Caches LocalRendvi stages as Zarr stores in a cache directory, evicting the least
+    recently used entries once the total size exceeds maxBytes. With storage="cube" stages
+    are kept as memory-mapped CubeStores and loaded without reading them into memory.
+    """
+    def __init__(self, cacheDir="~/.rendvi/cache", maxBytes=50e9, storage="zarr"):
+        if storage not in ("zarr", "cube"):
+            raise ValueError(f"storage must be 'zarr' or 'cube', got '{storage}'")
+        self.cacheDir = Path(cacheDir).expanduser()
+        self.maxBytes = maxBytes
+        self.storage = storage
+        super(LocalStageCache, self).__init__(self.cacheDir / 'index.json')
+        return
+
+    def supports(self, collection):
+        return hasattr(collection, 'DS')
+
+    def inputKey(self, collection):
+        if getattr(collection, 'cacheKey', None) is not None:
+            return collection.cacheKey
+        return self._hashDataset(collection.DS)
+
+    @staticmethod
+    def _dirSize(path):
+        return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+    def load(self, key, collection):
+        path = Path(self.index[key]['path'])
+        if not path.exists():
+            del self.index[key]
+            self._writeIndex()
+            return None
+        if path.suffix == '.cube':
+            ds = CubeStore(path).toDataset()
+        else:
+            ds = xr.open_zarr(str(path)).load()
+        return type(collection)(ds, collection.BAND, collection.SEED)
+
+    def store(self, key, stage, out):
+        path = self.cacheDir / f"{stage}_{key}.{self.storage}"
+        if self.storage == 'cube':
+            CubeStore.create(path, out.DS)
+        else:
+            out.DS.to_zarr(str(path), mode='w')
+        now = time.time()
+        self.index[key] = {'path': str(path), 'stage': stage, 'size': self._dirSize(path),
+                           'created': now, 'lastAccess': now}
+        self.evict()
+        self._writeIndex()
+        return
+
+    def remove(self, key):
+        entry = self.index.pop(key, None)
+        if entry is not None:
+            shutil.rmtree(entry['path'], ignore_errors=True)
+        self._writeIndex()
+        return
+
+    @property
+    def totalBytes(self):
+        return sum(entry['size'] for entry in self.index.values())
+
+    def evict(self):
+        byAccess = sorted(self.index.items(), key=lambda item: item[1]['lastAccess'])
+        while self.totalBytes > self.maxBytes and len(byAccess) > 1:
+            key, _ = byAccess.pop(0)
+            self.remove(key)
+        return
+
+
+class EEStageCache(StageCache):
+    """
+    Caches Rendvi stages as EE ImageCollection assets under assetRoot. A cache miss returns
+    the lazily computed collection and starts exports to materialise it, later runs reuse
+    the asset once all images have been exported. Keeps at most maxEntries collections.
+    The exports are all submitted at once (EE queues them) so a miss returns promptly,
+    a maxConcurrent in the scheduler options is not applied.
+    """
+    def __init__(self, assetRoot, region, scale=250, crs='EPSG:4326', maxEntries=20,
+                 indexPath="~/.rendvi/ee_cache.json", **schedulerKwargs):
+        self.assetRoot = assetRoot.rstrip('/')
+        self.region = region
+        self.scale = scale
+        self.crs = crs
+        self.maxEntries = maxEntries
+        self.schedulerKwargs = schedulerKwargs
+        super(EEStageCache, self).__init__(indexPath)
+        return
+
+    def supports(self, collection):
+        return hasattr(collection, 'IC')
+
+    def inputKey(self, collection):
+        if getattr(collection, 'cacheKey', None) is not None:
+            return collection.cacheKey
+        return hashlib.sha1(collection.IC.serialize().encode()).hexdigest()
+
+    def load(self, key, collection):
+        entry = self.index[key]
+        assets = ee.ImageCollection(entry['asset'])
+        try:
+            complete = assets.size().getInfo() >= entry['expected']
+        except ee.EEException:
+            complete = False
+        if not complete:
+            return None
+        return type(collection)(assets, collection.BAND, collection.SEED)
+
+    def store(self, key, stage, out):
+        if key in self.index:
+            # exports were already started by an earlier run
+            return
+        asset = f"{self.assetRoot}/{stage}_{key[:16]}"
+        try:
+            ee.data.createAsset({'type': 'ImageCollection'}, asset)
+        except ee.EEException:
+            pass
+
+        # unthrottled, a bounded scheduler keeps polling until all but maxConcurrent tasks are started
+        schedulerKwargs = dict(self.schedulerKwargs, maxConcurrent=None)
+        scheduler = ExportScheduler(self.region, scale=self.scale, crs=self.crs, **schedulerKwargs)
+        jobs = scheduler.addCollection(out.IC, asset, prefix=stage)
+        scheduler.run(wait=False)
+
+        now = time.time()
+        self.index[key] = {'asset': asset, 'stage': stage, 'expected': len(jobs),
+                           'created': now, 'lastAccess': now}
+        self.evict()
+        self._writeIndex()
+        return
+
+    def remove(self, key):
+        entry = self.index.pop(key, None)
+        if entry is not None:
+            try:
+                for asset in listAssets(entry['asset']):
+                    ee.data.deleteAsset(asset)
+                ee.data.deleteAsset(entry['asset'])
+            except ee.EEException:
+                pass
+        self._writeIndex()
+        return
+
+    def evict(self):
+        byAccess = sorted(self.index.items(), key=lambda item: item[1]['lastAccess'])
+        while len(byAccess) > self.maxEntries:
+            key, _ = byAccess.pop(0)
+            self.remove(key)
+        return
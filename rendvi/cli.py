@@ -2,7 +2,7 @@ import ee
 import fire
 from rendvi.core import *
 from rendvi.masking import *
-from rendvi import collections
+from rendvi import eeCollections
 
 def eeAuthenticate():
 
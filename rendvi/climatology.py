@@ -0,0 +1,174 @@
+import json
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pathlib import Path
+from rendvi.core import Utils
+
+
+class ClimatologyBuilder:
+    """
+    Streaming per-dekad climatology for local (time, y, x) stacks. Keeps running count,
+    mean and M2 (sum of squared deviations) per dekad and pixel and folds new observations
+    in chunk by chunk with the parallel Welford update, so a new year of dekads can be added
+    without revisiting earlier years and stacks larger than memory can be read lazily
+    (e.g. from xr.open_zarr). Optional fixed-bin histograms act as mergeable percentile
+    sketches with an error of at most one bin width.
+    """
+    # an observation belongs to the dekad starting at doy i if its doy is within [i, i + 5],
+    # the same window as the dayOfYear filter in Rendvi.calcClimatology
+    dekadStarts = np.array(Utils.perpetualDekadDoy[:-1])
+
+    def __init__(self, band, chunkSize=100, percentileRange=None, percentileBins=100):
+        self.band = band
+        self.chunkSize = chunkSize
+        self.percentileRange = percentileRange
+        self.percentileBins = percentileBins
+
+        self.count = None
+        self.mean = None
+        self.m2 = None
+        self.hist = None
+        self.coords = None
+        self.dims = None
+        self.attrs = {}
+        # days already folded in, updates skip them so re-running a year is harmless
+        self.folded = np.array([], dtype=np.int64)
+        return
+
+    def _init(self, ds):
+        shape = (36,) + ds[self.band].shape[1:]
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+        if self.percentileRange is not None:
+            self.hist = np.zeros(shape + (self.percentileBins,), dtype=np.uint32)
+        self.coords = {k: (v.dims, v.values) for k, v in ds.coords.items() if 'time' not in v.dims}
+        self.dims = tuple(d for d in ds[self.band].dims if d != 'time')
+        self.attrs = dict(ds.attrs)
+        return
+
+    @classmethod
+    def dekadIndex(cls, times):
+        doy = np.asarray(pd.DatetimeIndex(times).dayofyear)
+        k = np.searchsorted(cls.dekadStarts, doy, side='right') - 1
+        member = (k >= 0) & (doy <= cls.dekadStarts[np.maximum(k, 0)] + 5)
+        return np.where(member, k, -1)
+
+    # fold the observations of one dekad into its running state (Chan et al. pairwise update)
+    def _merge(self, k, stack):
+        valid = np.isfinite(stack)
+        nB = valid.sum(axis=0)
+        has = nB > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mB = np.where(valid, stack, 0).sum(axis=0) / nB
+            m2B = np.where(valid, (stack - mB) ** 2, 0).sum(axis=0)
+
+        nA = self.count[k]
+        n = nA + nB
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = mB - self.mean[k]
+            self.mean[k] = np.where(has, self.mean[k] + delta * nB / n, self.mean[k])
+            self.m2[k] = np.where(has, self.m2[k] + m2B + delta ** 2 * nA * nB / n, self.m2[k])
+        self.count[k] = n
+
+        if self.hist is not None:
+            lo, hi = self.percentileRange
+            width = (hi - lo) / self.percentileBins
+            bins = np.clip(((np.where(valid, stack, lo) - lo) / width).astype(np.int64), 0, self.percentileBins - 1)
+            pixel = np.broadcast_to(np.arange(nB.size).reshape(nB.shape), stack.shape)
+            flat = (pixel * self.percentileBins + bins)[valid]
+            self.hist[k] += np.bincount(flat, minlength=nB.size * self.percentileBins)\
+                .reshape(self.hist.shape[1:]).astype(np.uint32)
+        return
+
+    def update(self, ds):
+        if hasattr(ds, 'DS'):
+            ds = ds.DS
+        if isinstance(ds, xr.DataArray):
+            ds = ds.to_dataset(name=self.band)
+        if self.count is None:
+            self._init(ds)
+
+        times = pd.DatetimeIndex(ds['time'].values)
+        days = times.values.astype('datetime64[D]').astype(np.int64)
+        dekads = self.dekadIndex(times)
+        todo = np.where((dekads >= 0) & ~np.isin(days, self.folded))[0]
+
+        # only one chunk of the stack is loaded at a time
+        for start in range(0, todo.size, self.chunkSize):
+            idx = todo[start:start + self.chunkSize]
+            values = ds[self.band].isel(time=idx).values.astype(np.float64)
+            for k in np.unique(dekads[idx]):
+                self._merge(k, values[dekads[idx] == k])
+
+        self.folded = np.union1d(self.folded, days[todo])
+        return self
+
+    def _template(self, data):
+        climoTimes = [pd.Timestamp(2001, 1, 1) + pd.Timedelta(days=int(i) - 1) for i in self.dekadStarts]
+        dims = ('dekad',) + self.dims
+        coords = dict(self.coords)
+        coords.update(dekad=np.arange(1, 37), time=('dekad', climoTimes))
+        return xr.Dataset({name: (dims, arr) for name, arr in data.items()}, coords=coords, attrs=self.attrs)
+
+    # climatology in the layout of LocalRendvi.calcClimatology
+    def result(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(self.count > 0, self.mean, np.nan)
+            std = np.where(self.count > 0, np.sqrt(self.m2 / self.count), np.nan)
+        return self._template({
+            f"{self.band}_mean": mean.astype(np.float32),
+            f"{self.band}_stdDev": std.astype(np.float32),
+            "count": np.minimum(self.count, np.iinfo(np.uint16).max).astype(np.uint16),
+        })
+
+    # percentiles (0-100) per dekad interpolated within the histogram bins
+    def percentiles(self, q=(10, 50, 90)):
+        if self.hist is None:
+            raise ValueError("percentiles require a percentileRange when creating the builder")
+        lo, hi = self.percentileRange
+        width = (hi - lo) / self.percentileBins
+
+        cdf = np.cumsum(self.hist, axis=-1)
+        total = cdf[..., -1]
+        out = {}
+        for p in np.atleast_1d(q):
+            target = total * (p / 100.)
+            b = np.argmax(cdf >= target[..., np.newaxis], axis=-1)
+            below = np.take_along_axis(cdf, b[..., np.newaxis], -1)[..., 0] - \
+                np.take_along_axis(self.hist, b[..., np.newaxis], -1)[..., 0]
+            inBin = np.take_along_axis(self.hist, b[..., np.newaxis], -1)[..., 0]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                value = lo + width * (b + np.clip((target - below) / inBin, 0, 1))
+            out[f"{self.band}_p{int(p) if float(p).is_integer() else p}"] = \
+                np.where(total > 0, value, np.nan).astype(np.float32)
+        return self._template(out)
+
+    # running state as a compressed npz so later years can be folded in without the originals
+    def save(self, path):
+        layout = dict(band=self.band, dims=self.dims, coords={k: d for k, (d, _) in self.coords.items()})
+        arrays = dict(count=self.count, mean=self.mean, m2=self.m2, folded=self.folded,
+                      layout=np.array(json.dumps(layout)))
+        arrays.update({f"coord_{k}": v for k, (_, v) in self.coords.items()})
+        if self.hist is not None:
+            arrays.update(hist=self.hist, percentileRange=np.array(self.percentileRange))
+        np.savez_compressed(Path(path).expanduser(), **arrays)
+        return
+
+    @classmethod
+    def load(cls, path, chunkSize=100):
+        with np.load(Path(path).expanduser()) as state:
+            layout = json.loads(str(state['layout']))
+            hasHist = 'hist' in state.files
+            builder = cls(layout['band'], chunkSize=chunkSize,
+                          percentileRange=tuple(state['percentileRange']) if hasHist else None,
+                          percentileBins=state['hist'].shape[-1] if hasHist else 100)
+            builder.count = state['count']
+            builder.mean = state['mean']
+            builder.m2 = state['m2']
+            builder.folded = state['folded']
+            builder.hist = state['hist'] if hasHist else None
+            builder.dims = tuple(layout['dims'])
+            builder.coords = {k: (tuple(d), state[f"coord_{k}"]) for k, d in layout['coords'].items()}
+        return builder
@@ -1,9 +1,21 @@
 import ee
-import pandas as pd
 from rendvi.masking import Masking
+from rendvi.smoothing import MovingLinearRegress
+from rendvi.timeseries import TimeSeriesExtractor
+from rendvi.decorators import cachedStage, profileMethods
 
 
 class Utils:
+    # lists of doy values that correspond to the dekad begin dates
+    # the last value closes the final dekad of the year
+    perpetualDekadDoy = [1, 11, 21, 32, 42, 52, 60, 70, 80, 91, 101, 111, 121, 131, 141, 152, 162,
+                         172, 182, 192, 202, 213, 223, 233, 244, 254, 264, 274, 284, 294, 305, 315, 325, 335, 345, 355, 366]
+    leapYearDekadDoy = [1, 11, 21, 32, 42, 52, 61, 71, 81, 92, 102, 112, 122, 132, 142, 153, 163,
+                        173, 183, 193, 203, 214, 224, 234, 245, 255, 265, 275, 285, 295, 306, 316, 326, 336, 346, 356, 367]
+    qaFlags = [2, 3, 4, 5, 6, 7, 8]
+    qaBandNames = ["pctOutOfRange", "pctPoorQuality", "pctClouds",
+                   "pctShadows", "pctSnow", "pctSensorZ", "pctSolarZ"]
+
     # helper function to add NDVI band to image collection
     @staticmethod
     def addNDBand(coll, b1=None, b2=None, outName=None):
@@ -57,6 +69,42 @@ class Utils:
         constBand = ee.Image(1)
         return img.addBands(constBand)
 
+    # combine two climatology states dekad by dekad with the parallel Welford update
+    @staticmethod
+    def mergeClimatologyState(state, update):
+        def _merge(pair):
+            pair = ee.Feature(pair)
+            primary = ee.Image(pair.get('primary'))
+            a = primary.unmask(0)
+            b = ee.Image(pair.get('secondary')).unmask(0)
+            nA = a.select('count')
+            nB = b.select('count')
+            n = nA.add(nB)
+            delta = b.select('mean').subtract(a.select('mean'))
+            mean = a.select('mean').add(delta.multiply(nB).divide(n))
+            m2 = a.select('m2').add(b.select('m2')).add(
+                delta.pow(2).multiply(nA).multiply(nB).divide(n))
+            merged = ee.Image.cat([n, mean, m2]).rename(['count', 'mean', 'm2']).updateMask(n.gt(0))
+            return ee.Image(merged.copyProperties(primary, primary.propertyNames()))
+
+        joined = ee.Join.inner().apply(state, update, ee.Filter.equals(leftField='dekad', rightField='dekad'))
+        return ee.ImageCollection(joined.map(_merge))
+
+    # climatology state to the scaled layout returned by Rendvi.calcClimatology
+    @staticmethod
+    def climatologyFromState(state):
+        def _format(img):
+            img = ee.Image(img)
+            band = ee.String(img.get('band'))
+            count = img.select('count')
+            stdDev = img.select('m2').divide(count).sqrt()
+            climo = img.select('mean').addBands(stdDev).rename(
+                [band.cat('_mean'), band.cat('_stdDev')]).multiply(10000).int16()
+            count = count.rename('count').multiply(1000).uint16()
+            return ee.Image(climo.addBands(count).copyProperties(img, ['system:time_start', 'dekad']))
+
+        return ee.ImageCollection(state.map(_format))
+
     @property
     def perpetualDekads():
         # create lists of doy values that correspond to the dekad begin dates
@@ -86,6 +134,15 @@ class Utils:
         out = ee.Algorithms.If(nBands.gt(2), img.copyProperties(img, ['system:time_start']), None)
         return out
 
+    # days before the newest published output that can still change when new dekads arrive
+    # and days of history before that needed for every stage to see its full window
+    @staticmethod
+    def incrementalWindows(despikeWindow=30, step=10, offset=1, nPeriods=5, smoothingWindow=50):
+        windowRange = smoothingWindow // 2
+        settleDays = (despikeWindow + offset) + (windowRange + offset) + (windowRange - offset) + step
+        lookbackDays = (despikeWindow + offset + step) + ((nPeriods * step) + 5) + (2 * windowRange + offset + step)
+        return settleDays, lookbackDays
+
     @staticmethod
     def reduceQaToImages(coll, qaBand=None, renameBands=None):
         if qaBand:
@@ -109,6 +166,7 @@ class Utils:
         return qaPct.addBands(pctClear)
 
 
+@profileMethods
 class Rendvi:
     def __init__(self, ic, band=None, seed=0):
         self.IC = ic
@@ -120,6 +178,8 @@ class Rendvi:
             self.BAND = band
 
         self.SEED = seed
+        # set when the collection was produced or loaded by a rendvi.cache stage cache
+        self.cacheKey = None
         return
 
     def __repr__(self):
@@ -136,63 +196,62 @@ class Rendvi:
     def getDates(self):
         return ee.List(self.IC.aggregate_array('system:time_start'))
 
+    @cachedStage('dekads')
     def getDekadImages(self, includeQa=True):
-        # loop functions to calculate dekads from daily data
-        def yrLoop(yr):
-            # loop over each dekad within year
-            def dkLoop(dk):
-                idxArr = ee.Array(dk)  # convert list to array
-                t1 = idxArr.get([0])  # get start of dekad
-                t2 = idxArr.get([1])  # end of dekad
-                date = y1.advance(ee.Number(t1).subtract(1), 'day')
-
-                dekadModis = yrModis.filter(ee.Filter.calendarRange(t1, t2, 'day_of_year'))\
-
-                composite = dekadModis.select(self.BAND).qualityMosaic(self.BAND)\
-                    .rename(self.BAND).set('system:time_start', date.millis(), 'begin', ee.Number(t1))
-
-                if includeQa:
-                    nClearObs = dekadModis.select(self.BAND).count()\
-                        .rename("nClearObs")
-
-                    qaComposite = Utils.reduceQaToImages(dekadModis, qaBand="qa",
-                                                         renameBands=["pctOutOfRange", "pctPoorQuality", "pctClouds", "pctShadows", "pctSnow", "pctSensorZ", "pctSolarZ"])
-
-                    result = ee.Algorithms.If(composite,
-                                              composite.addBands(
-                                                  qaComposite).addBands(nClearObs),
-                                              None)
-                else:
-                    result = ee.Algorithms.If(composite,
-                                              composite,
-                                              None)
-                return result
-
-            # create date objects to filter
-            y1 = ee.Date.fromYMD(yr, 1, 1)
-            y2 = y1.advance(1, 'year')
-
-            yrModis = self.IC.filterDate(y1, y2)
-
-            # get proper dekad timing based on leap year or perpetual year
-            thisDekad = ee.List(ee.Algorithms.If(ee.Number(yr).mod(4).eq(0),
-                                                 Utils.leapYearDekads.fget(),
-                                                 Utils.perpetualDekads.fget()))
-
-            return thisDekad.map(dkLoop)
-
-        years = self.getDates().map(lambda x: ee.Date(x).get('year')).distinct()
-
-        x = ee.ImageCollection(years.map(yrLoop).flatten())
-        # dekads = ee.ImageCollection.fromImages(
-        #     x.map(Utils.validImage, True).toList(x.size()))
-
-        if includeQa:
-            dekads = x.map(Utils.validQaImage,True)
-        else:
-            dekads = x.map(Utils.validImage,True)
-
-        dekadIc = ee.ImageCollection.fromImages(dekads.toList(dekads.size()))
+        perpetual = ee.List(Utils.perpetualDekadDoy)
+        leapYear = ee.List(Utils.leapYearDekadDoy)
+        countBands = [f"n{flag}" for flag in Utils.qaFlags] + ["clear", "total"]
+
+        def dekadTable(year):
+            return ee.List(ee.Algorithms.If(ee.Number(year).mod(4).eq(0), leapYear, perpetual))
+
+        # assign every daily image its dekad once, a key of year * 100 + dekad and for days that
+        # begin a dekad the key of the previous dekad they also close (calendarRange is inclusive)
+        def _assignDekad(img):
+            date = img.date()
+            year = date.get('year')
+            doy = date.getRelative('day', 'year').add(1)
+            table = dekadTable(year)
+            dk = table.slice(1, 36).filter(ee.Filter.lte('item', doy)).size()
+            key = ee.Number(year).multiply(100).add(dk)
+            closesPrevious = ee.Number(table.get(dk)).eq(doy).And(dk.gt(0))
+            img = img.set('dekadKey', key, 'previousKey', ee.Algorithms.If(closesPrevious, key.subtract(1), -1))
+
+            if includeQa:
+                # per observation indicators so every count of a dekad comes from one sum
+                qa = img.select('qa')
+                flags = [qa.eq(flag).unmask(0) for flag in Utils.qaFlags]
+                clear = img.select(self.BAND).mask().gt(0)
+                img = img.addBands(ee.Image.cat(flags + [clear, ee.Image(1)]).uint8().rename(countBands))
+            return img
+
+        keyed = self.IC.map(_assignDekad)
+
+        # only dekads with observations are composited so no empty results need filtering
+        keys = ee.List(keyed.aggregate_array('dekadKey')).cat(keyed.aggregate_array('previousKey'))\
+            .distinct().remove(-1).sort()
+
+        def _composite(key):
+            key = ee.Number(key)
+            year = key.divide(100).floor()
+            begin = dekadTable(year).get(key.mod(100))
+            date = ee.Date.fromYMD(year, 1, 1).advance(ee.Number(begin).subtract(1), 'day')
+
+            members = keyed.filter(ee.Filter.Or(ee.Filter.eq('dekadKey', key), ee.Filter.eq('previousKey', key)))
+
+            # max composite, equivalent to qualityMosaic on the band itself
+            composite = members.select(self.BAND).max().rename(self.BAND)
+
+            if includeQa:
+                counts = members.select(countBands).sum()
+                qaPct = counts.select(countBands[:-2]).float().divide(counts.select('total')).rename(Utils.qaBandNames)
+                pctClear = ee.Image(1).subtract(qaPct.reduce(ee.Reducer.sum())).rename("pctClear")
+                nClearObs = counts.select(['clear'], ['nClearObs'])
+                composite = composite.addBands(qaPct).addBands(pctClear).addBands(nClearObs)
+
+            return composite.set('system:time_start', date.millis(), 'begin', begin)
+
+        dekadIc = ee.ImageCollection.fromImages(keys.map(_composite))
 
         return Rendvi(dekadIc, self.BAND, self.SEED)
 
@@ -218,7 +277,25 @@ class Rendvi:
 
         return dekadClimo
 
-    def applyDespike(self, window=30, step=10, offset=1, diffThresh=0.2, timeUnits="day",keepBandPattern="^(pct|nClear).*"):
+    # per dekad running state (count, mean, M2) that a new year can be folded into with
+    # Utils.mergeClimatologyState instead of recomputing the climatology from every year
+    def calcClimatologyState(self):
+        def _dekadState(i):
+            i = ee.Number(ee.List(i).get(0))
+            dummyT = ee.Date.fromYMD(2001, 1, 1)
+            climoColl = self.IC.select(self.BAND).filter(
+                ee.Filter.dayOfYear(i, i.add(5)))
+            count = climoColl.count().rename('count')
+            mean = climoColl.mean().rename('mean')
+            m2 = climoColl.reduce(ee.Reducer.variance()).multiply(count).rename('m2')
+            properties = {'system:time_start': dummyT.advance(i.subtract(1), 'day').millis(),
+                          'dekad': i, 'band': self.BAND}
+            return ee.Image.cat([count, mean, m2]).float().set(properties)
+
+        return ee.ImageCollection(Utils.perpetualDekads.fget().map(_dekadState))
+
+    @cachedStage('despiked')
+    def applyDespike(self, window=30, step=10, offset=1, diffThresh=0.2, timeUnits="day",keepBandPattern="^(pct|nClear).*",method="filter"):
         def _despike(d):
             d = ee.Date(d)
 
@@ -274,16 +351,70 @@ class Rendvi:
 
             return out
 
+        # despike using the neighbors attached to each image by a single join
+        # only the fore/aft max and t are needed for the despike mask so
+        # the t-1/t+1 lookups are dropped
+        def _despikeJoined(img):
+            t = ee.Image(img)
+            d = t.date()
+
+            random = ee.Image.random(self.SEED).subtract(
+                0.5).multiply(2).rename(self.BAND)
+
+            neighbors = ee.ImageCollection.fromImages(t.get('neighbors'))
+            tempFore = neighbors.filterDate(
+                d.advance(-(window - offset), timeUnits), d.advance(-(step - offset), timeUnits))
+            tempAft = neighbors.filterDate(
+                d.advance((step + offset), timeUnits), d.advance((window + offset), timeUnits))
+
+            tempMax = ee.ImageCollection(tempFore.merge(tempAft)).select(self.BAND).max()
+            tempMax = ee.Image(ee.Algorithms.If(
+                tempMax.bandNames().length().gt(0), tempMax, random))
+
+            Bn = tempMax.multiply(1.1)
+            despikeMask = t.select(self.BAND).lt(Bn.select(self.BAND)).rename("despiked")
+
+            maskedOut = t.select(self.BAND).updateMask(despikeMask)
+
+            # start from the time band so the joined neighbors are not carried as properties
+            out = ee.Image.cat([
+                Utils.timeBand(d),
+                maskedOut,
+                despikeMask.Not().unmask(0),
+            ]).select([self.BAND, 't', 'despiked'])
+
+            if keepBandPattern is not None:
+                out = out.addBands(t.select(keepBandPattern))
+
+            return out.set('system:time_start', d.millis())
+
         dates = self.getDates()
 
         include = window // step
 
-        despiked = ee.ImageCollection(
-            dates.slice(include, -include).map(_despike))
+        if method == "filter":
+            despiked = ee.ImageCollection(
+                dates.slice(include, -include).map(_despike))
+        elif method == "join":
+            unitMillis = {'day': 86400000, 'week': 604800000, 'hour': 3600000,
+                          'minute': 60000, 'second': 1000}
+            timeField = 'system:time_start'
+            primary = self.IC.filter(ee.Filter.inList(timeField, dates.slice(include, -include)))
+            joinFilter = ee.Filter.maxDifference(
+                difference=(window + offset) * unitMillis[timeUnits],
+                leftField=timeField,
+                rightField=timeField
+            )
+            joined = ee.Join.saveAll(matchesKey='neighbors', ordering=timeField)\
+                .apply(primary=primary, secondary=self.IC, condition=joinFilter)
+            despiked = ee.ImageCollection(joined).map(_despikeJoined)
+        else:
+            raise ValueError(f"Despike method '{method}' not recognized, use one of 'filter' or 'join'")
 
         return Rendvi(despiked, self.BAND, self.SEED)
 
-    def climatologyBackFill(self, climatology, nPeriods=5, step=10, keepBandPattern="^(pct|nClear).*"):
+    @cachedStage('backFilled')
+    def climatologyBackFill(self, climatology, nPeriods=5, step=10, keepBandPattern="^(pct|nClear).*", method="filter"):
         def findClimoDate(img):
             t = ee.Date(img.get('system:time_start'))
             yr = ee.Number(t.get('year'))
@@ -329,11 +460,75 @@ class Rendvi:
 
             return out
 
+        # the climatology (36 images sorted by dekad) indexed once as 36-band images so each
+        # dekad picks its band by number instead of filtering the climatology collection
+        climatology = climatology.sort('system:time_start')
+        climoMean = climatology.select('.*mean').toBands().multiply(0.0001).float()
+        climoStd = climatology.select('.*stdDev').toBands().multiply(0.0001).float()
+        # unscaled as in getPrevious, so only dekads without observations are masked
+        climoCount = climatology.select('count').toBands()
+        perpetual = ee.List(Utils.perpetualDekadDoy)
+        leapYear = ee.List(Utils.leapYearDekadDoy)
+
+        # z-score of every dekad computed exactly once
+        def _zScore(img):
+            d = img.date()
+            year = d.get('year')
+            doy = d.getRelative('day', 'year').add(1)
+            table = ee.List(ee.Algorithms.If(ee.Number(year).mod(4).eq(0), leapYear, perpetual))
+            dk = table.slice(1, 36).filter(ee.Filter.lte('item', doy)).size()
+
+            z = img.select(self.BAND).subtract(climoMean.select([dk]))\
+                .divide(climoStd.select([dk])).updateMask(climoCount.select([dk]).gt(0.6))
+            return img.addBands(z.rename('zScore')).set('dekad', dk, 'windowEnd', d.advance(-1, 'day').millis())
+
+        # fill from the mean z-score of the window of previous dekads attached by the join
+        def _backFillJoined(img):
+            d = img.date()
+            dk = img.get('dekad')
+            previous = ee.List(img.get('previous'))
+
+            zScore = ee.Image(ee.Algorithms.If(previous.size().gt(0),
+                                               ee.ImageCollection.fromImages(previous).mean(),
+                                               ee.Image(0).rename('zScore')))
+
+            fillVal = climoMean.select([dk]).add(zScore.select('zScore').multiply(climoStd.select([dk])))\
+                .rename(self.BAND)
+
+            fillMask = img.select(self.BAND).mask().Not().And(fillVal.mask()).unmask(0).rename("climatologyFilled")
+
+            # start from the time band so the joined images are not carried as properties
+            out = ee.Image.cat([
+                Utils.timeBand(d),
+                img.select(self.BAND).unmask(fillVal),
+                img.select(keepBandPattern),
+                fillMask
+            ])
+
+            return out.select(ee.List([self.BAND]).cat(img.select(keepBandPattern).bandNames()).cat(['climatologyFilled', 't']))\
+                .set('system:time_start', d.millis())
+
         nDays = ((nPeriods * step) + 5) * -1
-        filledDekads = self.IC.map(_backFill).map(Utils.addTimeBand)
+
+        if method == "filter":
+            filledDekads = self.IC.map(_backFill).map(Utils.addTimeBand)
+        elif method == "lookup":
+            timeField = 'system:time_start'
+            zScores = self.IC.map(_zScore)
+            # previous dekads within [t - nDays, t - 1 day), same window as the filter method
+            joinFilter = ee.Filter.And(
+                ee.Filter.maxDifference(difference=-nDays * 86400000, leftField=timeField, rightField=timeField),
+                ee.Filter.greaterThan(leftField='windowEnd', rightField=timeField)
+            )
+            joined = ee.Join.saveAll(matchesKey='previous', ordering=timeField, outer=True)\
+                .apply(primary=zScores, secondary=zScores.select('zScore'), condition=joinFilter)
+            filledDekads = ee.ImageCollection(joined).map(_backFillJoined)
+        else:
+            raise ValueError(f"Back-fill method '{method}' not recognized, use one of 'filter' or 'lookup'")
 
         return Rendvi(filledDekads, self.BAND, self.SEED)
 
+    @cachedStage('spatialSmoothed')
     def spatialSmoothing(self,kernel,zThreshold=1,constraintBand='^clima.*',keepBandPattern="^(pct|nClear).*"):
         def _smooth(image):
             valueImage = image.select(self.BAND)
@@ -350,7 +545,15 @@ class Rendvi:
 
         return Rendvi(smoothedColl, self.BAND, self.SEED)
 
-    def applySmoothing(self, window=30, step=10, maxStack=6, offset=1, timeUnits="day",keepBandPattern="^(pct|nClear).*"):
+    def applySmoothing(self, window=30, step=10, maxStack=6, offset=1, timeUnits="day",keepBandPattern="^(pct|nClear).*",method="filter"):
+        # closed form rolling sums, see rendvi.smoothing.MovingLinearRegress
+        if method == "sums":
+            smoother = MovingLinearRegress(self, window=window, step=step, offset=offset,
+                                           timeUnits=timeUnits, maxStack=maxStack)
+            return smoother.smooth(keepBandPattern=keepBandPattern, flagName="temporalFilled")
+        elif method != "filter":
+            raise ValueError(f"Smoothing method '{method}' not recognized, use one of 'filter' or 'sums'")
+
         # Function to smooth the despiked dekad time series
         def _smooth(d):
             def applyFit(img):
@@ -399,10 +602,55 @@ class Rendvi:
         return Rendvi(smoothed, self.BAND, self.SEED)
 
 
-    def getTimeSeries(self,region,scale,start=False,end=False):
-        result = self.imageCollection.getRegion(region,scale).getInfo()
-        df = pd.DataFrame(result[1:])
-        df.columns = result[0]
-        df["date"]= pd.to_datetime([t['value']*1e6 if type(t)==dict else t*1e6 for t in df["time"]] )
+    # run the standard processing chain on dekad composites as in scripts/export_rendvi.py
+    def runPipeline(self, climatology, kernel, despikeWindow=30, step=10, offset=1, nPeriods=5, zThreshold=1,
+                    smoothingWindow=50, maxStack=6, despikeMethod="filter", smoothingMethod="filter", backFillMethod="filter"):
+        despiked = self.applyDespike(window=despikeWindow, step=step, offset=offset,
+                                     keepBandPattern="^(pct|nClear).*", method=despikeMethod)
+
+        backFilled = despiked.climatologyBackFill(climatology, nPeriods=nPeriods, step=step,
+                                                  keepBandPattern="^(de|pct|nClear).*", method=backFillMethod)
+
+        spatialSmoothed = backFilled.spatialSmoothing(kernel, zThreshold=zThreshold,
+                                                      keepBandPattern="^(clima|de|pct|nClear|t).*")
+
+        smoothed = spatialSmoothed.applySmoothing(window=smoothingWindow, step=step, maxStack=maxStack, offset=offset,
+                                                  keepBandPattern="^(clima|de|pct|nClear|sp).*", method=smoothingMethod)
+
+        return smoothed
+
+    # reprocess only the trailing dekads that change when new dekads are added after the
+    # latest published output, self holds the dekad composites (history plus newest dekads).
+    # The stages are rerun from the dekads over the bounded lookback window since the published
+    # outputs only hold the final values. Returns the updated outputs and the ids of the published
+    # assets they revise, export them with overwrite=True to replace those assets
+    def updateTrailing(self, published, climatology, kernel, despikeWindow=30, step=10, offset=1, nPeriods=5,
+                       zThreshold=1, smoothingWindow=50, maxStack=6, despikeMethod="filter", smoothingMethod="filter",
+                       backFillMethod="filter"):
+        settleDays, lookbackDays = Utils.incrementalWindows(despikeWindow=despikeWindow, step=step, offset=offset,
+                                                            nPeriods=nPeriods, smoothingWindow=smoothingWindow)
+
+        lastPublished = ee.Date(published.aggregate_max('system:time_start'))
+        start = lastPublished.advance(-settleDays, 'day')
+        history = start.advance(-lookbackDays, 'day')
+
+        trailing = Rendvi(self.IC.filter(ee.Filter.gte('system:time_start', history.millis())),
+                          self.BAND, self.SEED)
+
+        smoothed = trailing.runPipeline(climatology, kernel, despikeWindow=despikeWindow, step=step, offset=offset,
+                                        nPeriods=nPeriods, zThreshold=zThreshold, smoothingWindow=smoothingWindow,
+                                        maxStack=maxStack, despikeMethod=despikeMethod, smoothingMethod=smoothingMethod,
+                                        backFillMethod=backFillMethod)
+
+        updated = smoothed.IC.filter(ee.Filter.gte('system:time_start', start.millis()))
+        replaced = published.filter(ee.Filter.gte('system:time_start', start.millis())).aggregate_array('system:id')
+
+        return Rendvi(updated, self.BAND, self.SEED), replaced
+
+    def getTimeSeries(self, region, scale, start=None, end=None, bands=None, **kwargs):
+        # region can be a geometry, FeatureCollection, GeoDataFrame or list of (lon, lat) sites,
+        # see rendvi.timeseries.TimeSeriesExtractor for the batching options
+        extractor = TimeSeriesExtractor(self.imageCollection, scale=scale, bands=bands, **kwargs)
+        df = extractor.extract(region, start=start, end=end)
         df.index = df.date
         return df
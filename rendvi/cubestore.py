@@ -0,0 +1,134 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pathlib import Path
+
+
+class CubeStore:
+    """
+    Directory of raw memory-mapped arrays plus a small JSON index of dates, variables and
+    coordinates for local (time, y, x) stacks. Every variable is laid out pixel-major as
+    (y, x, time) with spare time capacity, so the series of a pixel is contiguous on disk,
+    new dekads are appended in place and toDataset returns (time, y, x) views of the maps
+    without reading or copying anything. The index is rewritten after the data, an
+    interrupted append leaves the store at its previous length.
+    """
+    indexName = 'index.json'
+
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+        indexPath = self.path / self.indexName
+        if not indexPath.exists():
+            raise FileNotFoundError(f"no cube store at {self.path}, create one with CubeStore.create")
+        self.index = json.loads(indexPath.read_text())
+        return
+
+    def __repr__(self):
+        return f"CubeStore({self.path}, {len(self)} dates, {list(self.index['variables'])})"
+
+    def __len__(self):
+        return len(self.index['dates'])
+
+    @classmethod
+    def create(cls, path, ds, capacity=None):
+        path = Path(path).expanduser()
+        path.mkdir(parents=True, exist_ok=True)
+        timeVars = [name for name, var in ds.data_vars.items() if 'time' in var.dims]
+        spatialDims = tuple(d for d in ds[timeVars[0]].dims if d != 'time')
+        shape = tuple(ds.sizes[d] for d in spatialDims)
+
+        index = {
+            'dims': spatialDims,
+            'shape': shape,
+            'capacity': 0,
+            'dates': [],
+            'variables': {name: {'dtype': str(ds[name].dtype), 'file': f"{name}.dat"} for name in timeVars},
+            'coords': {d: ds[d].values.tolist() for d in spatialDims if d in ds.coords},
+            'timeCoords': {k: [] for k, v in ds.coords.items() if v.dims == ('time',) and k != 'time'},
+            'attrs': {k: v for k, v in ds.attrs.items() if isinstance(v, (str, int, float, list))},
+        }
+        (path / cls.indexName).write_text(json.dumps(index))
+
+        store = cls(path)
+        store._grow(capacity if capacity is not None else ds.sizes['time'])
+        store.append(ds)
+        return store
+
+    @property
+    def dates(self):
+        return pd.DatetimeIndex(self.index['dates'])
+
+    def _writeIndex(self):
+        tmp = self.path / (self.indexName + '.tmp')
+        tmp.write_text(json.dumps(self.index))
+        os.replace(tmp, self.path / self.indexName)
+        return
+
+    def _memmap(self, name, mode='r', capacity=None):
+        info = self.index['variables'][name]
+        capacity = self.index['capacity'] if capacity is None else capacity
+        return np.memmap(self.path / info['file'], dtype=info['dtype'], mode=mode,
+                         shape=tuple(self.index['shape']) + (capacity,))
+
+    # reallocate every variable with a larger time capacity, copying row blocks of the old maps
+    def _grow(self, capacity):
+        old, n = self.index['capacity'], len(self)
+        for name, info in self.index['variables'].items():
+            target = self.path / (info['file'] + '.grow')
+            new = np.memmap(target, dtype=info['dtype'], mode='w+', shape=tuple(self.index['shape']) + (capacity,))
+            if old > 0:
+                src = self._memmap(name, capacity=old)
+                for y0 in range(0, new.shape[0], 256):
+                    new[y0:y0 + 256, :, :n] = src[y0:y0 + 256, :, :n]
+                del src
+            new.flush()
+            del new
+            os.replace(target, self.path / info['file'])
+        self.index['capacity'] = capacity
+        self._writeIndex()
+        return
+
+    def append(self, ds):
+        if isinstance(ds, xr.DataArray):
+            ds = ds.to_dataset()
+        if hasattr(ds, 'DS'):
+            ds = ds.DS
+        missing = set(self.index['variables']) - set(ds.data_vars)
+        if missing:
+            raise ValueError(f"appended dataset is missing variables {sorted(missing)}")
+
+        times = pd.DatetimeIndex(ds['time'].values)
+        if len(self) and times.min() <= self.dates.max():
+            raise ValueError(f"appended dates must be after the last stored date {self.dates.max().date()}")
+
+        n, k = len(self), times.size
+        if n + k > self.index['capacity']:
+            # grow geometrically so repeated appends stay amortized O(1) per dekad
+            self._grow(max(2 * self.index['capacity'], n + k))
+
+        dims = ('time',) + tuple(self.index['dims'])
+        for name, info in self.index['variables'].items():
+            mm = self._memmap(name, mode='r+')
+            mm[:, :, n:n + k] = np.moveaxis(ds[name].transpose(*dims).values.astype(info['dtype']), 0, -1)
+            mm.flush()
+            del mm
+
+        for name, values in self.index['timeCoords'].items():
+            values.extend(ds[name].values.tolist())
+        self.index['dates'].extend(times.strftime('%Y-%m-%dT%H:%M:%S').tolist())
+        self._writeIndex()
+        return self
+
+    # (time, y, x) views of the memory maps, mode 'r+' allows stages to write in place
+    def toDataset(self, variables=None, mode='r'):
+        n = len(self)
+        dims = ('time',) + tuple(self.index['dims'])
+        names = self.index['variables'] if variables is None else variables
+        dataVars = {name: (dims, np.moveaxis(self._memmap(name, mode=mode)[:, :, :n], -1, 0)) for name in names}
+
+        coords = {d: values for d, values in self.index['coords'].items()}
+        coords['time'] = self.dates
+        coords.update({k: ('time', v) for k, v in self.index['timeCoords'].items()})
+        return xr.Dataset(dataVars, coords=coords, attrs=self.index['attrs'])
@@ -1,5 +1,8 @@
 import ee
+import inspect
 import functools
+from rendvi.cache import getCache
+from rendvi.profiling import getProfiler
 
 
 def retainTime(func):
@@ -24,3 +27,57 @@ def retainMetadata(func):
             .set('system:time_start',args[0].get('system:time_start')))
 
     return wrapper
+
+
+def cachedStage(stage):
+    # reuse the output of a Rendvi/LocalRendvi stage method from the active rendvi.cache
+    # cache, keyed by the input collection, stage name and bound parameters
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            cache = getCache()
+            if cache is None:
+                return func(self, *args, **kwargs)
+
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            params.pop('self')
+
+            return cache.fetch(self, stage, params, lambda: func(self, *args, **kwargs))
+
+        return wrapper
+
+    return decorator
+
+
+def profileMethods(cls):
+    # record every public method call of a Rendvi/LocalRendvi class with the active
+    # rendvi.profiling profiler, the methods run unwrapped when no profiler is active
+    def wrap(name, func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            profiler = getProfiler()
+            if profiler is None:
+                return func(self, *args, **kwargs)
+
+            record = profiler.enter(self, name)
+            try:
+                result = func(self, *args, **kwargs)
+            except Exception as e:
+                record['error'] = str(e)
+                profiler.exit(record, None)
+                raise
+            profiler.exit(record, result)
+            return result
+
+        return wrapper
+
+    for name, attr in list(vars(cls).items()):
+        if name.startswith('_') or not inspect.isfunction(attr):
+            continue
+        setattr(cls, name, wrap(name, attr))
+
+    return cls
@@ -1,40 +1,57 @@
 import ee
 
-MOD09GQ = {
+
+class CollectionInfo(dict):
+    """
+    Band names and id of an EE ImageCollection. The "imageCollection" entry is only built
+    on first access so importing this module does not need an initialized EE session.
+    """
+    def __getitem__(self, key):
+        if key == "imageCollection" and not dict.__contains__(self, key):
+            dict.__setitem__(self, key, ee.ImageCollection(self["id"]))
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key == "imageCollection" or dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    @property
+    def imageCollection(self):
+        return self["imageCollection"]
+
+
+MOD09GQ = CollectionInfo({
     "id": "MODIS/006/MOD09GQ",
     "red": "sur_refl_b01",
     "nir": "sur_refl_b02",
     "qc": "QC_250m",
-    "imageCollection": ee.ImageCollection("MODIS/006/MOD09GQ"),
-}
+})
 
-MOD09GA = {
-    "id": "MODIS/006/MYD09GA",
+MOD09GA = CollectionInfo({
+    "id": "MODIS/006/MOD09GA",
     "red": "sur_refl_b01",
     "nir": "sur_refl_b02",
     "state": "state_1km",
-    "imageCollection": ee.ImageCollection("MODIS/006/MOD09GA"),
-}
-MYD09GQ = {
+})
+MYD09GQ = CollectionInfo({
     "id": "MODIS/006/MYD09GQ",
     "red": "sur_refl_b01",
     "nir": "sur_refl_b02",
     "qc": "QC_250m",
-    "imageCollection": ee.ImageCollection("MODIS/006/MYD09GQ"),
-}
+})
 
-MYD09GA = {
-    "id": "MODIS/006/MYD09GQ",
+MYD09GA = CollectionInfo({
+    "id": "MODIS/006/MYD09GA",
     "red": "sur_refl_b01",
     "nir": "sur_refl_b02",
     "state": "state_1km",
-    "imageCollection": ee.ImageCollection("MODIS/006/MYD09GA"),
-}
+})
 
-VNP09GA = {
+VNP09GA = CollectionInfo({
     "id": "NOAA/VIIRS/001/VNP09GA",
     "red": "I1",
     "nir": "I2",
     "state": "state_1km",
-    "imageCollection": ee.ImageCollection("NOAA/VIIRS/001/VNP09GA"),
-}
+})
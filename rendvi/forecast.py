@@ -1,14 +1,20 @@
 import ee
-import copy
 import math
+import numpy as np
+import pandas as pd
+import xarray as xr
 from rendvi.decorators import retainTime
 from rendvi.core import Utils, Rendvi
+from rendvi.local import LocalRendvi
 
 
 class ForecastModel:
     def __init__(self,independents=None,dependents=None):
         self.independents = independents
-        self.dependents = dependents
+        # band names as a python list for both engines, wrapped in an ee.List where EE needs one
+        if isinstance(dependents, str):
+            dependents = [dependents]
+        self.dependents = list(dependents) if dependents is not None else None
         # empty object to apply the computed coefficients
         # values will be set during fit method
         self.coefficients = None
@@ -16,22 +22,74 @@ class ForecastModel:
 
     # Function to get a sequence of band names for harmonic terms.
     def _getNames(self, base, n):
-        return ee.List([f'{base}_{i}' for i in range(1,n+1)])
+        return [f'{base}_{i}' for i in range(1,n+1)]
 
+    # add the time and constant bands server side where an image does not have them yet
     def _prepInputs(self, collection):
-        first = ee.Image(collection.IC.first())
-        bands = first.bandNames().getInfo()
-        outCollection = copy.deepcopy(collection.imageCollection)
-        if 'time' not in bands:
-            outCollection = outCollection.map(lambda x:
-                x.addBands(
-                    ee.Image(x.date().difference(ee.Date('1970-01-01'),'year')).float().rename('time')
-                )
-            )
-        if 'constant' not in bands:
-            outCollection = outCollection.map(Utils.addConstantBand)
-
-        return Rendvi(outCollection, collection.BAND, collection.SEED)
+        def _addInputs(image):
+            bands = image.bandNames()
+            time = image.date().difference(ee.Date('1970-01-01'), 'year')
+            withTime = ee.Image(ee.Algorithms.If(bands.contains('time'), image,
+                                                 image.addBands(ee.Image(time).float().rename('time'))))
+            return ee.Image(ee.Algorithms.If(bands.contains('constant'), withTime,
+                                             Utils.addConstantBand(withTime)))
+
+        return Rendvi(collection.IC.map(_addInputs), collection.BAND, collection.SEED)
+
+    # fractional years since 1970 as used for the EE 'time' band
+    @staticmethod
+    def _localTime(dates):
+        dates = pd.DatetimeIndex(dates)
+        return np.asarray((dates - pd.Timestamp(1970, 1, 1)) / pd.Timedelta(days=365.25), dtype=np.float64)
+
+    # solve the least squares fit of y (time, pixels) on the design matrix x (time, terms)
+    # for every pixel ignoring its nan observations. Mask patterns shared by at least minGroup
+    # pixels are solved with one QR per pattern, the remaining pixels with batched normal
+    # equations in blocks of blockSize pixels, which beat a python loop over many small groups
+    @staticmethod
+    def _solveMasked(x, y, minGroup=256, blockSize=65536):
+        n, p = x.shape
+        valid = np.isfinite(y)
+        beta = np.full((p, y.shape[1]), np.nan)
+        solvable = valid.sum(axis=0) >= p
+
+        # group by a hash of the packed mask, members that collide with another pattern
+        # are left to the per pixel solve below
+        packed = np.packbits(valid.T, axis=1)
+        words = np.ascontiguousarray(np.pad(packed, ((0, 0), (0, -packed.shape[1] % 8)))).view(np.uint64)
+        keys = (words * np.uint64(0x9E3779B97F4A7C15) >> np.arange(words.shape[1], dtype=np.uint64)).sum(axis=1)
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+
+        grouped = np.zeros(y.shape[1], dtype=bool)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.concatenate([[0], np.cumsum(counts)])
+        for g in np.where(counts >= minGroup)[0]:
+            cols = order[bounds[g]:bounds[g + 1]]
+            cols = cols[solvable[cols] & (packed[cols] == packed[cols[0]]).all(axis=1)]
+            if cols.size < minGroup:
+                continue
+            rows = valid[:, cols[0]]
+            # one QR of the shared design matrix for every pixel of the group
+            q, r = np.linalg.qr(x[rows])
+            try:
+                beta[:, cols] = np.linalg.solve(r, q.T @ y[np.ix_(rows, cols)])
+            except np.linalg.LinAlgError:
+                beta[:, cols], *_ = np.linalg.lstsq(x[rows], y[np.ix_(rows, cols)], rcond=None)
+            grouped[cols] = True
+
+        remaining = np.where(solvable & ~grouped)[0]
+        outer = (x[:, :, None] * x[:, None, :]).reshape(n, p * p)
+        for b0 in range(0, remaining.size, blockSize):
+            rest = remaining[b0:b0 + blockSize]
+            w = valid[:, rest].astype(np.float64)
+            # x'Wx and x'Wy of every pixel of the block as two matrix products
+            gram = (w.T @ outer).reshape(-1, p, p)
+            rhs = (np.where(valid[:, rest], y[:, rest], 0).T @ x)[..., None]
+            try:
+                beta[:, rest] = np.linalg.solve(gram, rhs)[..., 0].T
+            except np.linalg.LinAlgError:
+                beta[:, rest] = (np.linalg.pinv(gram) @ rhs)[..., 0].T
+        return beta
 
 
     def detrend(self, collection):
@@ -47,16 +105,17 @@ class ForecastModel:
 
         #  Compute a linear trend.  This will have two bands: 'residuals' and
         # a 2x1 band called coefficients (columns are for dependent variables).
-        trend = inputs.IC.select(self.independents.add(dependent))\
+        independents = ee.List(self.independents)
+        trend = inputs.IC.select(independents.add(dependent))\
             .reduce(ee.Reducer.linearRegression(
-                numX=self.independents.length(),
+                numX=independents.length(),
                 numY=1
             ))
 
         # Flatten the coefficients into a 2-band image
         coefficients = trend.select('coefficients')\
             .arrayProject([0])\
-            .arrayFlatten([self.independents])
+            .arrayFlatten([independents])
 
         outCollection = inputs.IC.map(_applyDetrend)
 
@@ -79,11 +138,11 @@ class ForecastModel:
 
 
 class Harmonics(ForecastModel):
-    def __init__(self, *args, nCycles=3,**kwargs):
+    def __init__(self, *args, nCycles=3, blockSize=65536, **kwargs):
         super(Harmonics, self).__init__(*args, **kwargs)
 
         self.cycles = nCycles
-        self.frequencyImg = ee.Image.constant(ee.List.sequence(1, nCycles))
+        self.blockSize = blockSize
 
         # Construct lists of names for the harmonic terms.
         self.cosNames = self._getNames('cos', self.cycles)
@@ -93,28 +152,39 @@ class Harmonics(ForecastModel):
         if self.independents is None:
 
             # add in two more independent variables: sine and cosine
-            self.independents = ee.List(['constant', 'time'])\
-                .cat(self.cosNames).cat(self.sinNames)
-
-
+            self.independents = ['constant', 'time'] + self.cosNames + self.sinNames
 
         return
 
     # Function to add harmonic terms to current image
     def _addHarmonicCoefs(self, image):
+        frequencyImg = ee.Image.constant(ee.List.sequence(1, self.cycles))
         timeRadians = image.select('time').multiply(2 * math.pi)
-        cosines = timeRadians.multiply(self.frequencyImg).cos()\
+        cosines = timeRadians.multiply(frequencyImg).cos()\
             .rename(self.cosNames)
-        sines = timeRadians.multiply(self.frequencyImg).sin()\
+        sines = timeRadians.multiply(frequencyImg).sin()\
             .rename(self.sinNames)
 
         return image\
             .addBands(cosines)\
             .addBands(sines)
 
+    # design matrix of the independents for a set of dates, built once for all pixels
+    def _design(self, dates):
+        t = self._localTime(dates)
+        freq = 2 * math.pi * t[:, None] * np.arange(1, self.cycles + 1)
+        terms = {'constant': np.ones_like(t), 'time': t}
+        terms.update({name: np.cos(freq[:, i]) for i, name in enumerate(self.cosNames)})
+        terms.update({name: np.sin(freq[:, i]) for i, name in enumerate(self.sinNames)})
+        return np.stack([terms[name] for name in self.independents], axis=1)
+
     def fit(self, collection):
+        if hasattr(collection, 'DS'):
+            return self._fitLocal(collection)
+
         if self.dependents is None:
-            self.dependents = ee.List([ee.String(collection.BAND)])
+            self.dependents = [collection.BAND]
+        dependents = ee.List(self.dependents)
 
         inputs = self._prepInputs(collection)
 
@@ -123,23 +193,44 @@ class Harmonics(ForecastModel):
 
         # Fit the model as with the linear trend, using the linearRegression() reducer
         # The output of this reducer is a 4x1 array image.
+        independents = ee.List(self.independents)
         harmonicTrend = harmonicCollection\
-            .select(self.independents.cat(self.dependents))\
+            .select(independents.cat(dependents))\
             .reduce(ee.Reducer.linearRegression(
-                numX=self.independents.length(),
-                numY=self.dependents.length()
+                numX=independents.length(),
+                numY=dependents.length()
             ))
 
         # Turn the array image into a multi-band image of coefficients
         harmonicCoefficients = harmonicTrend.select('coefficients')\
             .arrayProject([0])\
-            .arrayFlatten([self.independents])
+            .arrayFlatten([independents])
 
         self.coefficients = harmonicCoefficients
 
         return
 
+    # coefficient rasters of every pixel from one design matrix for the shared time axis
+    def _fitLocal(self, collection):
+        band = collection.BAND if self.dependents is None else self.dependents[0]
+        values = collection.DS[band].values
+        shape = values.shape
+
+        x = self._design(collection.getDates())
+        beta = self._solveMasked(x, values.reshape(shape[0], -1).astype(np.float64), blockSize=self.blockSize)
+
+        dims = tuple(d for d in collection.DS[band].dims if d != 'time')
+        coords = {k: v for k, v in collection.DS.coords.items() if 'time' not in v.dims}
+        self.coefficients = xr.Dataset(
+            {name: (dims, beta[i].reshape(shape[1:]).astype(np.float32)) for i, name in enumerate(self.independents)},
+            coords=coords)
+
+        return
+
     def predict(self, collection):
+        if isinstance(self.coefficients, xr.Dataset):
+            return self._predictLocal(collection)
+
         @retainTime
         def _applyPrediction(image):
             return image.select(self.independents)\
@@ -157,97 +248,199 @@ class Harmonics(ForecastModel):
 
         return Rendvi(predictedHarmonic, 'predicted', collection.SEED)
 
+    # predictions for the dates of a LocalRendvi or any sequence of dates
+    def _predictLocal(self, collection):
+        dates = collection.getDates() if hasattr(collection, 'DS') else pd.DatetimeIndex(collection)
+        x = self._design(dates)
+        beta = np.stack([self.coefficients[name].values for name in self.independents])
+        shape = beta.shape[1:]
+
+        predicted = (x @ beta.reshape(len(self.independents), -1)).reshape((len(dates),) + shape)
+
+        coords = dict(self.coefficients.coords)
+        coords['time'] = dates
+        dims = ('time',) + tuple(self.coefficients[self.independents[0]].dims)
+        out = xr.Dataset({'predicted': (dims, predicted.astype(np.float32))}, coords=coords)
+
+        seed = collection.SEED if hasattr(collection, 'SEED') else 0
+        return LocalRendvi(out, 'predicted', seed)
+
 
 class AutoRegressive(ForecastModel):
-    def __init__(self,*args,lag=20,units='day',**kwargs):
+    """
+    AR(order) model of an ordered series of dekads. Lagged predictors are built by shifting
+    the series by whole time steps instead of joining the collection with itself, the fit
+    solves every pixel at once and forecast runs the recursion for several dekads ahead.
+    """
+    def __init__(self, *args, order=2, blockSize=65536, **kwargs):
         super(AutoRegressive, self).__init__(*args, **kwargs)
 
-        self.lag = lag
-        if units != 'day':
-            factors = {'second':60*60*24,'minute':60*24,'month':1/30,'year':1/365}
-            self.lag = self.lag * factors[units]
-
-        self.arIndependents = None
-        self.arCoefficients = None
+        self.order = order
+        self.blockSize = blockSize
 
         return
 
-    def _merge(self,image):
-        # Function to be passed to iterate.
-        def merger(current, previous):
-            return ee.Image(previous).addBands(current)
-
-        return ee.ImageCollection.fromImages(
-            image.get('images')).iterate(merger, image)
-
-    def _lag(self,left,right):
-        print(self.lag)
-        timeField = 'system:time_start'
-        filter = ee.Filter.And(
-            ee.Filter.maxDifference(
-              difference= 1000 * 60 * 60 * 24 * self.lag,
-              leftField= timeField,
-              rightField= timeField
-            ),
-            ee.Filter.greaterThan(
-              leftField= timeField,
-              rightField= timeField
-        ))
-
-        return ee.Join.saveAll(
-            matchesKey= 'images',
-            measureKey= 'delta_t',
-            ordering= timeField,
-            ascending= False # Sort reverse chronologically, needed for merging
-        ).apply(
-            primary= left,
-            secondary= right,
-            condition= filter
-        )
-
-    def lagMergeCollection(self,collection):
-        lagged = ee.ImageCollection(self._lag(collection.IC,collection.IC))
-        merged = ee.ImageCollection(lagged.map(self._merge))
-        return Rendvi(merged,collection.BAND,collection.SEED)
-
-    def fit(self,collection,lookback=None):
+    def _lagNames(self, band):
+        return self._getNames(band, self.order)
+
+    # start of the dekad following a date, dekads begin on the 1st, 11th and 21st
+    @staticmethod
+    def _nextDekads(last, steps):
+        out = []
+        d = pd.Timestamp(last)
+        for _ in range(steps):
+            start = d.replace(day=1)
+            d = start + pd.Timedelta(days=10) if d.day < 11 else (
+                start + pd.Timedelta(days=20) if d.day < 21 else start + pd.DateOffset(months=1))
+            out.append(d)
+        return pd.DatetimeIndex(out)
+
+    @staticmethod
+    def _nextDekadEE(d):
+        day = ee.Number(d.get('day'))
+        start = ee.Date.fromYMD(d.get('year'), d.get('month'), 1)
+        return ee.Date(ee.Algorithms.If(day.lt(11), start.advance(10, 'day'),
+                                        ee.Algorithms.If(day.lt(21), start.advance(20, 'day'), start.advance(1, 'month'))))
+
+    # pair every image with the previous order images of the time sorted series by index
+    def lagMergeCollection(self, collection):
+        band = collection.BAND
+        names = self._lagNames(band)
+        images = collection.IC.sort('system:time_start').select(band).toList(collection.IC.size())
+
+        def _lagged(i):
+            i = ee.Number(i)
+            current = ee.Image(images.get(i))
+            lags = [ee.Image(images.get(i.subtract(k))).rename(name) for k, name in enumerate(names, 1)]
+            return current.addBands(ee.Image.cat(lags))
+
+        merged = ee.List.sequence(self.order, images.size().subtract(1)).map(_lagged)
+        return Rendvi(ee.ImageCollection.fromImages(merged), band, collection.SEED)
+
+    # (time, order + 1, pixels) design and (time, pixels) target from shifted views of the stack
+    def _laggedStack(self, values):
+        n = values.shape[0]
+        lags = [values[self.order - k:n - k] for k in range(1, self.order + 1)]
+        x = np.stack([np.ones_like(lags[0])] + lags, axis=1)
+        return x, values[self.order:]
+
+    def fit(self, collection):
+        band = collection.BAND
         if self.independents is None:
-            self.independents = ee.List(['constant']).cat(
-                self._getNames(collection.BAND, 2))
+            self.independents = ['constant'] + self._lagNames(band)
 
-        dependent = ee.String(collection.BAND)
+        if hasattr(collection, 'DS'):
+            return self._fitLocal(collection)
 
-        inputs = self._prepInputs(collection)
+        inputs = self._prepInputs(self.lagMergeCollection(collection))
+        independents = ee.List(self.independents)
 
         ar = inputs.IC\
-            .select(self.independents.add(self.dependent))\
-            .reduce(ee.Reducer.linearRegression(self.independents.length(), 1))
+            .select(independents.add(band))\
+            .reduce(ee.Reducer.linearRegression(independents.length(), 1))
 
         # Turn the array image into a multi-band image of coefficients.
         self.coefficients = ar.select('coefficients')\
           .arrayProject([0])\
-          .arrayFlatten([self.independents])
+          .arrayFlatten([independents])
 
         return
 
-    def predict(self,collection,lookback=None):
-        @retainTime
-        def _applyPrediction(image):
-            return image.addBands(
-              image.expression('beta0 + beta1 * p1 + beta2 * p2', {
-                'p1': image.select(collection.BAND+'_1'),
-                'p2': image.select(collection.BAND+'_2'),
-                'beta0': self.coefficients.select('constant'),
-                'beta1': self.coefficients.select(collection.BAND+'_1'),
-                'beta2': self.coefficients.select(collection.BAND+'_2')
-              }).rename('predicted'));
+    # batched least squares of every pixel from its own lagged series, solved per block of
+    # pixels through the normal equations
+    def _fitLocal(self, collection):
+        band = collection.BAND
+        values = collection.DS[band].values
+        shape = values.shape
+        y = values.reshape(shape[0], -1).astype(np.float64)
+        p = self.order + 1
+
+        beta = np.full((p, y.shape[1]), np.nan)
+        for b0 in range(0, y.shape[1], self.blockSize):
+            x, target = self._laggedStack(y[:, b0:b0 + self.blockSize])
+            valid = np.isfinite(target) & np.isfinite(x).all(axis=1)
+            x = np.where(valid[:, None], x, 0)
+            target = np.where(valid, target, 0)
+
+            gram = np.einsum('tip,tjp->pij', x, x)
+            rhs = np.einsum('tip,tp->pi', x, target)[..., None]
+            solvable = valid.sum(axis=0) >= p
+            try:
+                solved = np.linalg.solve(gram[solvable], rhs[solvable])
+            except np.linalg.LinAlgError:
+                solved = np.linalg.pinv(gram[solvable]) @ rhs[solvable]
+            beta[:, b0 + np.where(solvable)[0]] = solved[..., 0].T
+
+        dims = tuple(d for d in collection.DS[band].dims if d != 'time')
+        coords = {k: v for k, v in collection.DS.coords.items() if 'time' not in v.dims}
+        self.coefficients = xr.Dataset(
+            {name: (dims, beta[i].reshape(shape[1:]).astype(np.float32)) for i, name in enumerate(self.independents)},
+            coords=coords)
 
+        return
 
-        dependent = ee.String(collection.BAND)
+    # one step ahead predictions for every image of the series
+    def predict(self, collection):
+        band = collection.BAND
+        names = self._lagNames(band)
 
-        inputs = self._prepInputs(collection)
+        if hasattr(collection, 'DS'):
+            values = collection.DS[band].values
+            x, _ = self._laggedStack(values.astype(np.float64))
+            beta = np.stack([self.coefficients[name].values for name in self.independents])
+            predicted = np.full(values.shape, np.nan, dtype=np.float32)
+            predicted[self.order:] = (x * beta[None]).sum(axis=1)
 
-        # Compute fitted values.
+            out = collection.DS.copy()
+            out['predicted'] = (collection.DS[band].dims, predicted)
+            return LocalRendvi(out, band, collection.SEED)
+
+        @retainTime
+        def _applyPrediction(image):
+            terms = image.select(['constant'] + names).multiply(self.coefficients.select(self.independents))
+            return image.addBands(terms.reduce('sum').rename('predicted'))
+
+        inputs = self._prepInputs(self.lagMergeCollection(collection))
         outCollection = inputs.IC.map(_applyPrediction)
 
-        return Rendvi(outCollection, collection.BAND, collection.SEED)
+        return Rendvi(outCollection, band, collection.SEED)
+
+    # forecast the steps dekads after the end of the series, feeding each forecast back in
+    # as the first lag of the next step
+    def forecast(self, collection, steps=3):
+        band = collection.BAND
+        names = self._lagNames(band)
+
+        if hasattr(collection, 'DS'):
+            values = collection.DS[band].values
+            beta = np.stack([self.coefficients[name].values for name in self.independents]).astype(np.float64)
+            history = [values[-k].astype(np.float64) for k in range(1, self.order + 1)]
+            forecasts = []
+            for _ in range(steps):
+                step = beta[0] + sum(beta[k] * history[k - 1] for k in range(1, self.order + 1))
+                forecasts.append(step)
+                history = [step] + history[:-1]
+
+            dates = self._nextDekads(collection.getDates()[-1], steps)
+            dims = collection.DS[band].dims
+            coords = {k: v for k, v in collection.DS.coords.items() if 'time' not in v.dims}
+            coords['time'] = dates
+            out = xr.Dataset({band: (dims, np.stack(forecasts).astype(np.float32))}, coords=coords,
+                             attrs=collection.DS.attrs)
+            return LocalRendvi(out, band, collection.SEED)
+
+        latest = collection.IC.sort('system:time_start', False).select(band).toList(self.order)
+        history = [ee.Image(latest.get(k)) for k in range(self.order)]
+        date = history[0].date()
+
+        forecasts = []
+        for _ in range(steps):
+            date = self._nextDekadEE(date)
+            step = self.coefficients.select('constant')
+            for k, name in enumerate(names):
+                step = step.add(self.coefficients.select(name).multiply(history[k]))
+            step = step.rename(band).set('system:time_start', date.millis())
+            forecasts.append(step)
+            history = [step] + history[:-1]
+
+        return Rendvi(ee.ImageCollection.fromImages(forecasts), band, collection.SEED)
@@ -0,0 +1,105 @@
+import ee
+import numpy as np
+import xarray as xr
+from rendvi import eeCollections
+from rendvi.masking import Masking
+from rendvi.core import Utils, Rendvi
+from rendvi.local import LocalMasking, LocalRendvi
+
+
+class SensorFusion:
+    """
+    Masks MODIS Terra (MOD09GQ/GA), Aqua (MYD09GQ/GA) and VIIRS (VNP09GA) daily surface
+    reflectance, converts every observation to NDVI on the Terra scale with a linear
+    gain/offset per sensor and merges them into one daily collection, so getDekadImages
+    builds a single dekad composite from all of them. The 250m and 1km MODIS products are
+    paired once with a join on the date instead of a filterDate lookup per image.
+    """
+    # sensor -> (reflectance product, 1km state product for MODIS)
+    products = {
+        "terra": (eeCollections.MOD09GQ, eeCollections.MOD09GA),
+        "aqua": (eeCollections.MYD09GQ, eeCollections.MYD09GA),
+        "viirs": (eeCollections.VNP09GA, None),
+    }
+
+    def __init__(self, sensors=("terra", "aqua", "viirs"), calibration=None):
+        unknown = set(sensors) - set(self.products)
+        if unknown:
+            raise ValueError(f"unknown sensors {sorted(unknown)}, expected any of {list(self.products)}")
+        self.sensors = list(sensors)
+        # gain and offset that map the NDVI of each sensor to the Terra NDVI,
+        # identity until set or estimated with crossCalibrate
+        self.calibration = {sensor: (1.0, 0.0) for sensor in self.sensors}
+        if calibration is not None:
+            self.calibration.update(calibration)
+        return
+
+    def _maskSensor(self, sensor, start, end):
+        fine, coarse = self.products[sensor]
+        coll = fine.imageCollection.filterDate(start, end)
+        if coarse is not None:
+            masked = Masking.applyModis(coll, coarse.imageCollection.filterDate(start, end), method="join")
+        else:
+            masked = Masking.applyViirs(coll)
+        return Utils.addNDBand(masked, b1=fine['nir'], b2=fine['red'], outName='ndvi')
+
+    def ingest(self, start, end):
+        def _calibrate(sensor):
+            gain, offset = self.calibration[sensor]
+
+            def _apply(img):
+                ndvi = img.select('ndvi').multiply(gain).add(offset)
+                return img.select('qa').addBands(ndvi)\
+                    .set('system:time_start', img.get('system:time_start'), 'sensor', sensor)
+            return _apply
+
+        fused = ee.ImageCollection([])
+        for sensor in self.sensors:
+            fused = fused.merge(self._maskSensor(sensor, start, end).map(_calibrate(sensor)))
+
+        return Rendvi(fused.sort('system:time_start'), 'ndvi')
+
+    # gain/offset of a linear fit of the reference NDVI on the target NDVI over pixels
+    # sampled from dekad composites both sensors have, returned as an ee.Dictionary
+    @staticmethod
+    def crossCalibrate(reference, target, region, scale=1000, numPixels=500, seed=0):
+        def _sample(pair):
+            pair = ee.Feature(pair)
+            x = ee.Image(pair.get('secondary')).select([target.BAND], ['x'])
+            y = ee.Image(pair.get('primary')).select([reference.BAND], ['y'])
+            return x.addBands(y).sample(region=region, scale=scale, numPixels=numPixels, seed=seed)
+
+        pairs = ee.Join.inner().apply(reference.IC, target.IC,
+                                      ee.Filter.equals(leftField='system:time_start', rightField='system:time_start'))
+        samples = ee.FeatureCollection(pairs.map(_sample)).flatten()
+        fit = ee.Dictionary(samples.reduceColumns(ee.Reducer.linearFit(), ['x', 'y']))
+        return ee.Dictionary({'gain': fit.get('scale'), 'offset': fit.get('offset')})
+
+    # local equivalent of ingest for raw datasets per sensor, MODIS sensors take a
+    # (250m, 1km) pair of datasets. All sensors are put on the grid of the first one
+    def fuseLocal(self, datasets):
+        fused = []
+        grid = None
+        for sensor in self.sensors:
+            fine, coarse = self.products[sensor]
+            raw = datasets[sensor]
+            if coarse is not None:
+                ds250, ds1km = raw if isinstance(raw, (tuple, list)) else (raw, None)
+                masked = LocalMasking.applyModis(ds250, ds1km, red=fine['red'], nir=fine['nir'])
+            else:
+                masked = LocalMasking.applyViirs(raw, red=fine['red'], nir=fine['nir'])
+
+            red, nir = masked[fine['red']], masked[fine['nir']]
+            gain, offset = self.calibration[sensor]
+            ndvi = ((nir - red) / (nir + red + 1e-7)) * gain + offset
+
+            out = xr.Dataset({'ndvi': ndvi.astype(np.float32), 'qa': masked['qa']})
+            out = out.assign_coords(sensor=('time', np.full(out.sizes['time'], sensor)))
+            if grid is None:
+                grid = out
+            else:
+                out = out.reindex(y=grid['y'].values, x=grid['x'].values, method='nearest')
+            fused.append(out)
+
+        ds = xr.concat(fused, dim='time').sortby('time')
+        return LocalRendvi(ds, 'ndvi')
@@ -0,0 +1,601 @@
+import re
+import warnings
+import functools
+import numpy as np
+import pandas as pd
+import xarray as xr
+from rendvi.core import Utils
+from rendvi.climatology import ClimatologyBuilder
+from rendvi.smoothing import MovingLinearRegress, Whittaker
+from rendvi.decorators import cachedStage, profileMethods
+
+
+class LocalUtils:
+    # lists of doy values that correspond to the dekad begin dates
+    # the last value closes the final dekad of the year
+    perpetualDekadDoy = np.array(Utils.perpetualDekadDoy)
+    leapYearDekadDoy = np.array(Utils.leapYearDekadDoy)
+
+    # qa flag values written by Masking.applyModis/applyViirs and the pct bands they reduce to
+    qaFlags = Utils.qaFlags
+    qaBandNames = Utils.qaBandNames
+
+    # conversion factors from the EE time units to days
+    unitFactors = {'day': 1., 'week': 7., 'hour': 1 / 24.,
+                   'minute': 1 / (24. * 60), 'second': 1 / (24. * 60 * 60)}
+
+    # helper function to add normalized difference band to a dataset
+    @staticmethod
+    def addNDBand(ds, b1=None, b2=None, outName=None):
+        nd = (ds[b1] - ds[b2]) / (ds[b1] + ds[b2] + 1e-7)
+        outName = outName if outName is not None else 'nd'
+        return ds.assign({outName: nd.astype(np.float32)})
+
+    # select the band names of a dataset matching a regex, mirrors ee.Image.select(pattern)
+    @staticmethod
+    def selectBands(ds, pattern):
+        if pattern is None:
+            return []
+        return [name for name in ds.data_vars if re.fullmatch(pattern, str(name))]
+
+    # convert datetimes into fractional time units since the epoch
+    @staticmethod
+    def toDays(times, timeUnits="day"):
+        if timeUnits not in LocalUtils.unitFactors:
+            raise ValueError(f"timeUnits '{timeUnits}' is not supported by the local engine, "
+                             f"use one of {list(LocalUtils.unitFactors.keys())}")
+        ns = pd.DatetimeIndex(times).values.astype('datetime64[ns]').astype(np.int64)
+        return ns / (86400e9 * LocalUtils.unitFactors[timeUnits])
+
+    # get the dekad table (begin doy values) for each year in an array
+    @staticmethod
+    def dekadTables(years):
+        years = np.asarray(years)
+        isLeap = (years % 4 == 0)[:, np.newaxis]
+        return np.where(isLeap, LocalUtils.leapYearDekadDoy, LocalUtils.perpetualDekadDoy)
+
+    # get the zero-based dekad index (0-35) within the year for each datetime
+    @staticmethod
+    def dekadOfYear(times):
+        times = pd.DatetimeIndex(times)
+        tables = LocalUtils.dekadTables(times.year)
+        doy = np.asarray(times.dayofyear)[:, np.newaxis]
+        return np.clip((tables[:, 1:-1] <= doy).sum(axis=1), 0, 35)
+
+    # get the begin date of a dekad (zero-based index) for a year
+    @staticmethod
+    def dekadStart(year, dekad):
+        table = LocalUtils.leapYearDekadDoy if year % 4 == 0 else LocalUtils.perpetualDekadDoy
+        return pd.Timestamp(year, 1, 1) + pd.Timedelta(days=int(table[dekad]) - 1)
+
+    # get the [lo, hi) index range of sorted times falling within [start, end) for each window
+    @staticmethod
+    def windowBounds(days, start, end):
+        return np.searchsorted(days, start), np.searchsorted(days, end)
+
+    # reduce variable length index ranges of a stack along the time axis with a binary ufunc
+    # windows are short relative to the series so this loops over the window width, not the dates
+    @staticmethod
+    def rangeReduce(ufunc, stack, lo, hi, fill=np.nan):
+        out = np.full((lo.size,) + stack.shape[1:], fill, dtype=np.result_type(stack.dtype, np.float32))
+        width = int((hi - lo).max()) if lo.size > 0 else 0
+        for k in range(width):
+            inRange = (lo + k) < hi
+            take = stack[np.minimum(lo + k, stack.shape[0] - 1)]
+            out[inRange] = ufunc(out[inRange], take[inRange])
+        return out
+
+    # sum a stack over [lo, hi) index windows that lie within a few steps of each date by
+    # adding shifted views of the stack once per offset instead of gathering every window
+    @staticmethod
+    def windowSum(stack, lo, hi):
+        n = stack.shape[0]
+        out = np.zeros(stack.shape, dtype=np.result_type(stack.dtype, np.float32))
+        idx = np.arange(n)
+        hasWindow = hi > lo
+        if not hasWindow.any():
+            return out
+
+        for k in range(int((idx - hi + 1)[hasWindow].min()), int((idx - lo)[hasWindow].max()) + 1):
+            # date i takes stack[i - k] if that index is within its window
+            inWindow = ((idx - k) >= lo) & ((idx - k) < hi)
+            dst = slice(max(k, 0), n + min(k, 0))
+            src = slice(max(-k, 0), n - max(k, 0))
+            weights = inWindow[dst].reshape((-1,) + (1,) * (stack.ndim - 1))
+            out[dst] += stack[src] * weights
+        return out
+
+    # mean, population std and count of the finite values in the (2 * ry + 1, 2 * rx + 1)
+    # box around every pixel of a (time, y, x) stack from summed-area tables, so the cost
+    # per pixel does not depend on the box size. Boxes are clipped at the edges like the
+    # nan padding of a sliding window. Stacks are processed block time steps at a time
+    @staticmethod
+    def boxStats(stack, ry, rx, block=32):
+        n, ny, nx = stack.shape
+        hy, hx = 2 * ry + 1, 2 * rx + 1
+
+        # box sums from a zero padded summed-area table using shifted slices only,
+        # the padding stands in for masked pixels beyond the edges
+        def _boxSums(*values):
+            table = np.zeros((len(values), values[0].shape[0], ny + hy, nx + hx), dtype=np.float64)
+            for i, v in enumerate(values):
+                table[i, :, ry + 1:ry + 1 + ny, rx + 1:rx + 1 + nx] = v
+            np.cumsum(table, axis=-2, out=table)
+            np.cumsum(table, axis=-1, out=table)
+            rows = table[..., hy:, :] - table[..., :-hy, :]
+            return rows[..., hx:] - rows[..., :-hx]
+
+        mean = np.empty(stack.shape, dtype=np.float32)
+        std = np.empty(stack.shape, dtype=np.float32)
+        count = np.empty(stack.shape, dtype=np.float32)
+        for t in range(0, n, block):
+            chunk = stack[t:t + block]
+            valid = np.isfinite(chunk)
+            # centre on the image mean so the sum of squares does not lose precision
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                centre = np.nan_to_num(np.nanmean(chunk, axis=(1, 2), keepdims=True))
+            values = np.where(valid, chunk - centre, 0)
+
+            c, total, squares = _boxSums(valid, values, values.astype(np.float64) ** 2)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                m = total / c
+                var = squares / c - m ** 2
+            # rounding leaves tiny residues where the box is constant
+            var[var < 1e-12] = 0
+
+            mean[t:t + block] = np.where(c > 0, m + centre, np.nan)
+            std[t:t + block] = np.where(c > 0, np.sqrt(var), np.nan)
+            count[t:t + block] = c
+        return mean, std, count
+
+    # reduce a stack with a nan-aware numpy function without all-nan warnings
+    @staticmethod
+    def nanReduce(func, stack, axis=0):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            return func(stack, axis=axis)
+
+    # lookup from a qa flag value to an integer with a one in the count lane of that flag,
+    # summing the looked up codes over a dekad yields every flag count at once, width is the
+    # lane size in bits and has to hold the longest dekad
+    @staticmethod
+    def qaLaneTable(width=4):
+        dtype = np.uint32 if width == 4 else np.uint64
+        table = np.zeros(256, dtype=dtype)
+        for i, flag in enumerate(LocalUtils.qaFlags):
+            table[flag] = dtype(1) << dtype(width * i)
+        return table
+
+    @staticmethod
+    def unpackLanes(codes, width=4):
+        mask = codes.dtype.type((1 << width) - 1)
+        return [(codes >> codes.dtype.type(width * i)) & mask for i in range(len(LocalUtils.qaFlags))]
+
+    # build a new dataset on the spatial grid of a template dataset
+    @staticmethod
+    def buildDataset(template, times, bands):
+        coords = {k: v for k, v in template.coords.items() if 'time' not in v.dims}
+        coords['time'] = pd.DatetimeIndex(times)
+        dims = None
+        dataVars = {}
+        for name, arr in bands.items():
+            if dims is None:
+                dims = ('time',) + tuple(d for d in template[next(iter(template.data_vars))].dims if d != 'time')
+            dataVars[name] = (dims, arr)
+        return xr.Dataset(dataVars, coords=coords, attrs=template.attrs)
+
+
+
+class LocalMasking:
+    """
+    Vectorized QA decoding mirroring rendvi.Masking for local datasets of raw MODIS
+    (MXD09GQ/MXD09GA) and VIIRS (VNP09GA) bands. Every QA word is decoded with a single
+    lookup into a 65536 entry table and OR-ed into a packed uint8 bitfield, bit k is set
+    for qa flag value k + 2 (LocalUtils.qaFlags) and bit 7 for pixels with fill values.
+    """
+    maskedBit = 7
+    fillValue = -28672
+
+    # bits of the packed field for each qa flag value
+    flagBits = {flag: i for i, flag in enumerate(LocalUtils.qaFlags)}
+
+    # uint8 lookup of the qa flag value (highest priority flag) for every packed bitfield,
+    # later .where() calls in Masking take precedence so the highest set bit wins
+    priorityTable = np.zeros(256, dtype=np.uint8)
+    for _v in range(1, 256):
+        _low = _v & 0x7F
+        priorityTable[_v] = LocalUtils.qaFlags[_low.bit_length() - 1] if _low else 1
+    del _v, _low
+
+    # lookup table from a uint16 word to packed flag bits, bitFlags maps (bit, flag) pairs
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def wordTable(bitFlags):
+        words = np.arange(1 << 16, dtype=np.uint32)
+        table = np.zeros(1 << 16, dtype=np.uint8)
+        for bit, flag in bitFlags:
+            table |= (((words >> bit) & 1) << LocalMasking.flagBits[flag]).astype(np.uint8)
+        return table
+
+    # lookup table from an int16 value (viewed as uint16) to a flag bit when the value fails a test
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def valueTable(test, flag):
+        values = np.arange(1 << 16, dtype=np.uint16).view(np.int16).astype(np.int32)
+        if test == "positive":
+            failed = values <= 0
+        else:
+            # zenith angles stored in 0.01 degrees, test is the maximum angle in degrees
+            failed = np.abs(values) >= int(round(float(test) * 100))
+        return (failed.astype(np.uint8) << LocalMasking.flagBits[flag])
+
+    # OR the table lookups of each (array, table) pair into one bitfield
+    @staticmethod
+    def packFlags(lookups, shape):
+        bits = np.zeros(shape, dtype=np.uint8)
+        buffer = np.empty(shape, dtype=np.uint8)
+        for arr, table in lookups:
+            arr = np.asarray(arr)
+            index = arr.view(np.uint16) if arr.dtype.itemsize == 2 else arr.astype(np.uint16)
+            np.take(table, index, out=buffer)
+            bits |= buffer
+        return bits
+
+    @staticmethod
+    def _finalize(ds, bits, fill, bands):
+        # fill pixels are masked on input in EE, only the flags from other products apply
+        if fill is not None:
+            bits[fill] = (bits[fill] & ~np.uint8(0b11)) | np.uint8(1 << LocalMasking.maskedBit)
+
+        invalid = bits != 0
+        out = ds.copy()
+        for name in bands:
+            out[name] = ds[name].astype(np.float32).where(~invalid)
+
+        dims = ds[bands[0]].dims
+        out["qaBits"] = (dims, bits)
+        out["qa"] = (dims, LocalMasking.priorityTable[bits])
+        return out
+
+    # align 1km state data with the 250m dataset, dates without state data pass every test
+    @staticmethod
+    def _alignState(ds1km, ds, names):
+        aligned = ds1km[names].reindex(time=ds["time"].values, fill_value=0)
+        return aligned.reindex(y=ds["y"].values, x=ds["x"].values, method="nearest")
+
+    @staticmethod
+    def applyModis(ds, ds1km=None, red="sur_refl_b01", nir="sur_refl_b02"):
+        lookups = [
+            (ds[red], LocalMasking.valueTable("positive", 2)),
+            (ds[nir], LocalMasking.valueTable("positive", 2)),
+            (ds["QC_250m"], LocalMasking.wordTable(((0, 3),))),
+        ]
+        if ds1km is not None:
+            state = LocalMasking._alignState(ds1km, ds, ["state_1km", "SensorZenith", "SolarZenith"])
+            lookups += [
+                (state["state_1km"], LocalMasking.wordTable(((10, 4), (2, 5), (12, 6)))),
+                (state["SensorZenith"], LocalMasking.valueTable(55, 7)),
+                (state["SolarZenith"], LocalMasking.valueTable(80, 8)),
+            ]
+
+        bits = LocalMasking.packFlags([(arr.values, table) for arr, table in lookups], ds[red].shape)
+        fill = (ds[red].values == LocalMasking.fillValue)
+        return LocalMasking._finalize(ds, bits, fill, [red, nir])
+
+    @staticmethod
+    def applyViirs(ds, red="I1", nir="I2"):
+        lookups = [
+            (ds[red], LocalMasking.valueTable("positive", 2)),
+            (ds[nir], LocalMasking.valueTable("positive", 2)),
+            (ds["QF4"], LocalMasking.wordTable(((1, 3), (2, 3)))),
+            (ds["QF1"], LocalMasking.wordTable(((2, 4),))),
+            (ds["QF2"], LocalMasking.wordTable(((3, 5), (5, 6)))),
+            (ds["SensorZenith"], LocalMasking.valueTable(55, 7)),
+            (ds["SolarZenith"], LocalMasking.valueTable(80, 8)),
+        ]
+
+        bits = LocalMasking.packFlags([(arr.values, table) for arr, table in lookups], ds[red].shape)
+        fill = (ds[red].values == LocalMasking.fillValue)
+        return LocalMasking._finalize(ds, bits, fill, [red, nir])
+
+    # boolean band for one qa flag value from the packed bitfield
+    @staticmethod
+    def hasFlag(bits, flag):
+        return (bits & np.uint8(1 << LocalMasking.flagBits[flag])) != 0
+
+
+@profileMethods
+class LocalRendvi:
+    """
+    Processing class mirroring rendvi.Rendvi on in-memory (time, y, x) xarray datasets.
+    Masked pixels are represented as NaN in the value band and flag bands are 0/1 uint8.
+    """
+    def __init__(self, ds, band=None, seed=0):
+        if isinstance(ds, xr.DataArray):
+            ds = ds.to_dataset(name=band if band is not None else ds.name)
+
+        if not ds.indexes['time'].is_monotonic_increasing:
+            ds = ds.sortby('time')
+
+        self.DS = ds
+
+        if band is None:
+            self.BAND = list(ds.data_vars)[0]
+        else:
+            self.BAND = band
+
+        self.SEED = seed
+        # set when the collection was produced or loaded by a rendvi.cache stage cache
+        self.cacheKey = None
+        return
+
+    def __repr__(self):
+        return 'Processing class for local xarray datasets'
+
+    @property
+    def dataset(self):
+        return self.DS
+
+    @property
+    def dates(self):
+        return [d.strftime("%Y-%m-%d") for d in self.getDates()]
+
+    def getDates(self):
+        return pd.DatetimeIndex(self.DS['time'].values)
+
+    def _keepBands(self, pattern, index=slice(None)):
+        return {name: self.DS[name].values[index] for name in LocalUtils.selectBands(self.DS, pattern)}
+
+    @cachedStage('dekads')
+    def getDekadImages(self, includeQa=True, qaBand="qa"):
+        times = self.getDates()
+        values = self.DS[self.BAND].values
+
+        # inclusive day range of every dekad of every year, calendarRange is inclusive on both
+        # ends so boundary days fall into two dekads while the year filter closes the last one
+        years = np.unique(times.year)
+        tables = LocalUtils.dekadTables(years)
+        jan1 = pd.to_datetime([f"{yr}-01-01" for yr in years]).values.astype('datetime64[D]').astype(np.int64)
+        first = jan1[:, np.newaxis] + tables[:, :-1] - 1
+        last = jan1[:, np.newaxis] + tables[:, 1:] - 1
+        last[:, -1] -= 1
+
+        # index range of the observations of each dekad, computed once for all dekads
+        days = times.values.astype('datetime64[D]').astype(np.int64)
+        lo = np.searchsorted(days, first.ravel(), side='left')
+        hi = np.searchsorted(days, last.ravel(), side='right')
+        keep = hi > lo
+        lo, hi = lo[keep], hi[keep]
+        outTimes = first.ravel()[keep].astype('datetime64[D]')
+        begins = tables[:, :-1].ravel()[keep]
+
+        composite = np.empty((lo.size,) + values.shape[1:], dtype=values.dtype)
+        if includeQa:
+            qa = self.DS[qaBand].values.astype(np.uint8, copy=False)
+            nObs = (hi - lo).max()
+            if nObs > 255:
+                raise ValueError(f"dekads with more than 255 observations ({nObs}) are not supported")
+            width = 4 if nObs < 16 else 8
+            table = LocalUtils.qaLaneTable(width)
+            codes = np.empty((lo.size,) + values.shape[1:], dtype=table.dtype)
+            nClear = np.empty((lo.size,) + values.shape[1:], dtype=np.uint16)
+
+        # one pass over the contiguous observations of each dekad
+        for i in range(lo.size):
+            stack = values[lo[i]:hi[i]]
+            # max value composite, equivalent to qualityMosaic on the band itself
+            np.fmax.reduce(stack, axis=0, out=composite[i])
+            if includeQa:
+                np.add.reduce(table[qa[lo[i]:hi[i]]], axis=0, out=codes[i])
+                np.add.reduce(np.isfinite(stack), axis=0, dtype=np.uint16, out=nClear[i])
+
+        bands = {self.BAND: composite}
+        if includeQa:
+            size = (hi - lo).astype(np.float32)[:, np.newaxis, np.newaxis]
+            pcts = [lane / size for lane in LocalUtils.unpackLanes(codes, width)]
+            for name, pct in zip(LocalUtils.qaBandNames, pcts):
+                bands[name] = pct.astype(np.float32)
+            bands["pctClear"] = (1 - np.sum(pcts, axis=0)).astype(np.float32)
+            bands["nClearObs"] = nClear
+
+        out = LocalUtils.buildDataset(self.DS, outTimes, bands)
+        out = out.assign_coords(begin=('time', begins))
+
+        return LocalRendvi(out, self.BAND, self.SEED)
+
+    # single streaming pass over the stack, see ClimatologyBuilder to fold in later years
+    def calcClimatology(self, chunkSize=100):
+        return ClimatologyBuilder(self.BAND, chunkSize=chunkSize).update(self.DS).result()
+
+    @cachedStage('despiked')
+    def applyDespike(self, window=30, step=10, offset=1, diffThresh=0.2, timeUnits="day", keepBandPattern="^(pct|nClear).*"):
+        days = LocalUtils.toDays(self.getDates(), timeUnits)
+        values = self.DS[self.BAND].values
+        n = days.size
+
+        rng = np.random.default_rng(self.SEED)
+        random = (rng.random(values.shape[1:]) - 0.5) * 2
+
+        include = window // step
+        idx = np.arange(include, n - include)
+        d = days[idx]
+
+        # index ranges of the fore and aft windows for every date, found in one pass
+        foreLo, foreHi = LocalUtils.windowBounds(days, d - (window - offset), d - (step - offset))
+        aftLo, aftHi = LocalUtils.windowBounds(days, d + (step + offset), d + (window + offset))
+
+        tempMax = np.fmax(LocalUtils.rangeReduce(np.fmax, values, foreLo, foreHi),
+                          LocalUtils.rangeReduce(np.fmax, values, aftLo, aftHi))
+        empty = ((foreHi - foreLo) + (aftHi - aftLo)) == 0
+        if empty.any():
+            tempMax[empty] = random
+
+        t = values[np.searchsorted(days, d - offset)]
+
+        despikeMask = t < (tempMax * 1.1)
+        valid = np.isfinite(t) & np.isfinite(tempMax)
+
+        bands = {self.BAND: np.where(despikeMask, t, np.nan).astype(values.dtype)}
+        bands.update(self._keepBands(keepBandPattern, idx))
+        bands["despiked"] = (valid & ~despikeMask).astype(np.uint8)
+
+        out = LocalUtils.buildDataset(self.DS, self.getDates()[idx], bands)
+
+        return LocalRendvi(out, self.BAND, self.SEED)
+
+    @cachedStage('backFilled')
+    def climatologyBackFill(self, climatology, nPeriods=5, step=10, keepBandPattern="^(pct|nClear).*"):
+        times = self.getDates()
+        days = LocalUtils.toDays(times)
+        values = self.DS[self.BAND].values.astype(np.float32)
+
+        climoMean = climatology[f"{self.BAND}_mean"].values
+        climoStd = climatology[f"{self.BAND}_stdDev"].values
+        dekads = LocalUtils.dekadOfYear(times)
+
+        nDays = ((nPeriods * step) + 5) * -1
+
+        # z-score of every dekad computed once against its own dekad of the climatology
+        mean, std = climoMean[dekads], climoStd[dekads]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z = (values - mean) / std
+        if "count" in climatology:
+            # same mask as Rendvi, which compares the stored (unscaled) count with 0.6, so only
+            # dekads without observations in the climatology are dropped
+            z = np.where(climatology["count"].values[dekads] > 0, z, np.nan)
+        valid = np.isfinite(z)
+
+        # rolling mean of the z-scores over the previous dekads within [t + nDays, t - 1)
+        lo, hi = LocalUtils.windowBounds(days, days + nDays, days - 1)
+        zSum = LocalUtils.windowSum(np.where(valid, z, 0), lo, hi)
+        zCount = LocalUtils.windowSum(valid, lo, hi)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            zScore = zSum / zCount
+        zScore[hi == lo] = 0
+
+        fillVal = mean + zScore * std
+        fillMask = np.isnan(values) & np.isfinite(fillVal)
+
+        outValues = np.where(fillMask, fillVal, values)
+        outFlags = fillMask.astype(np.uint8)
+
+        bands = {self.BAND: outValues.astype(np.float32)}
+        bands.update(self._keepBands(keepBandPattern))
+        bands["climatologyFilled"] = outFlags
+
+        out = LocalUtils.buildDataset(self.DS, times, bands)
+
+        return LocalRendvi(out, self.BAND, self.SEED)
+
+    @cachedStage('spatialSmoothed')
+    def spatialSmoothing(self, kernel, zThreshold=1, constraintBand='^clima.*', keepBandPattern="^(pct|nClear).*"):
+        # kernel is either a square kernel radius in pixels (as ee.Kernel.square) or a 2d footprint
+        if np.isscalar(kernel):
+            radius = int(kernel)
+            footprint = np.ones((2 * radius + 1, 2 * radius + 1), dtype=bool)
+        else:
+            footprint = np.asarray(kernel).astype(bool)
+        ry, rx = footprint.shape[0] // 2, footprint.shape[1] // 2
+
+        constraintNames = LocalUtils.selectBands(self.DS, constraintBand)
+        if len(constraintNames) == 0:
+            raise ValueError(f"No band matching constraintBand '{constraintBand}' in dataset")
+        constraint = self.DS[constraintNames[0]].values
+
+        values = self.DS[self.BAND].values
+
+        if footprint.all():
+            # square/rectangular kernels from summed-area tables over the whole stack
+            v = values.astype(np.float32)
+            mean, std, _ = LocalUtils.boxStats(v, ry, rx)
+            valid = np.isfinite(v)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                outside = np.where(std > 0, np.abs(v - mean) / std, 0)
+            toFill = (outside < zThreshold) | (constraint == 0)
+            # as Rendvi, outliers and masked pixels take the neighbourhood mean
+            outValues = np.where(toFill & valid, v, mean)
+            outFlags = (valid & ~toFill).astype(np.uint8)
+        else:
+            outValues, outFlags = [], []
+            for i in range(values.shape[0]):
+                v = values[i].astype(np.float32)
+                padded = np.pad(v, ((ry, ry), (rx, rx)), constant_values=np.nan)
+                windows = np.lib.stride_tricks.sliding_window_view(padded, footprint.shape)[..., footprint]
+                mean = LocalUtils.nanReduce(np.nanmean, windows, axis=-1)
+                std = LocalUtils.nanReduce(np.nanstd, windows, axis=-1)
+
+                valid = np.isfinite(v)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    outside = np.where(std > 0, np.abs(v - mean) / std, 0)
+                toFill = (outside < zThreshold) | (constraint[i] == 0)
+
+                outValues.append(np.where(toFill & valid, v, mean))
+                outFlags.append((valid & ~toFill).astype(np.uint8))
+
+        bands = {self.BAND: np.asarray(outValues, dtype=np.float32)}
+        bands.update(self._keepBands(keepBandPattern))
+        bands["spatialSmoothed"] = np.asarray(outFlags)
+
+        out = LocalUtils.buildDataset(self.DS, self.getDates(), bands)
+
+        return LocalRendvi(out, self.BAND, self.SEED)
+
+    def applySmoothing(self, window=30, step=10, maxStack=6, offset=1, timeUnits="day", keepBandPattern="^(pct|nClear).*"):
+        smoother = MovingLinearRegress(self, window=window, step=step, offset=offset,
+                                       timeUnits=timeUnits, maxStack=maxStack)
+
+        return smoother.smooth(keepBandPattern=keepBandPattern, flagName="temporalFilled")
+
+    def applyWhittaker(self, lmbda=10., order=2, vcurve=False, lambdas=None, keepBandPattern="^(pct|nClear).*"):
+        smoother = Whittaker(self, lmbda=lmbda, order=order, vcurve=vcurve, lambdas=lambdas)
+
+        return smoother.smooth(keepBandPattern=keepBandPattern, flagName="temporalFilled")
+
+    # run the standard processing chain on dekad composites as in scripts/export_rendvi.py
+    def runPipeline(self, climatology, kernel, despikeWindow=30, step=10, offset=1, nPeriods=5, zThreshold=1,
+                    smoothingWindow=50, maxStack=6):
+        despiked = self.applyDespike(window=despikeWindow, step=step, offset=offset,
+                                     keepBandPattern="^(pct|nClear).*")
+
+        backFilled = despiked.climatologyBackFill(climatology, nPeriods=nPeriods, step=step,
+                                                  keepBandPattern="^(de|pct|nClear).*")
+
+        spatialSmoothed = backFilled.spatialSmoothing(kernel, zThreshold=zThreshold,
+                                                      keepBandPattern="^(clima|de|pct|nClear).*")
+
+        smoothed = spatialSmoothed.applySmoothing(window=smoothingWindow, step=step, maxStack=maxStack, offset=offset,
+                                                  keepBandPattern="^(clima|de|pct|nClear|sp).*")
+
+        return smoothed
+
+    # reprocess only the trailing dekads that change when new dekads are added after the
+    # latest published output and merge them with the published dataset
+    def updateTrailing(self, published, climatology, kernel, despikeWindow=30, step=10, offset=1, nPeriods=5,
+                       zThreshold=1, smoothingWindow=50, maxStack=6):
+        if isinstance(published, LocalRendvi):
+            published = published.DS
+
+        settleDays, lookbackDays = Utils.incrementalWindows(despikeWindow=despikeWindow, step=step, offset=offset,
+                                                            nPeriods=nPeriods, smoothingWindow=smoothingWindow)
+
+        lastPublished = pd.Timestamp(published['time'].values.max())
+        start = lastPublished - pd.Timedelta(days=settleDays)
+        history = start - pd.Timedelta(days=lookbackDays)
+
+        trailing = LocalRendvi(self.DS.sel(time=slice(history, None)), self.BAND, self.SEED)
+
+        smoothed = trailing.runPipeline(climatology, kernel, despikeWindow=despikeWindow, step=step, offset=offset,
+                                        nPeriods=nPeriods, zThreshold=zThreshold, smoothingWindow=smoothingWindow,
+                                        maxStack=maxStack)
+
+        updated = smoothed.DS.sel(time=slice(start, None))
+        kept = published.sel(time=published['time'] < np.datetime64(start))
+
+        return LocalRendvi(xr.concat([kept, updated], dim='time', data_vars='all'), self.BAND, self.SEED)
+
+    def getTimeSeries(self, x, y, method="nearest"):
+        df = self.DS.sel(x=x, y=y, method=method).to_dataframe()
+        df["date"] = df.index
+        df.index = df.date
+        return df
@@ -0,0 +1,179 @@
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pathlib import Path
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+from rendvi.local import LocalUtils
+
+
+class LocalExporter:
+    """
+    Writes local outputs in the format of formatOutput in scripts/export_rendvi.py:
+    NDVI as int16 scaled by 10000 and the percent and flag bands as uint8 scaled by 100.
+    toCOG writes Cloud-Optimized GeoTIFFs with internal overviews. A GeoTIFF has one data
+    type and one overview resampling, so each dekad is written as one file per band group,
+    with the resampling taken from the same pyramiding policy dict as the asset export.
+    toZarr appends the dekads to a Zarr store in chunk-aligned blocks written in parallel.
+    Requires rioxarray for COGs and zarr for Zarr stores.
+    """
+    otherPattern = "^(clima|de|pct|sp|tem).*"
+    ndviScale = 0.0001
+    otherScale = 0.01
+    nodata = {'int16': np.iinfo(np.int16).min, 'uint8': np.iinfo(np.uint8).max}
+
+    # same policy as the asset export in scripts/export_rendvi.py
+    defaultPyramiding = {'.default': "mean", 'despiked': 'mode', 'climatologyFilled': 'mode',
+                         'temporalFilled': 'mode', 'spatialSmoothed': 'mode'}
+    # GDAL overview resampling of the EE pyramiding policies a COG can use
+    resampling = {'mean': 'AVERAGE', 'mode': 'MODE', 'sample': 'NEAREST'}
+
+    def __init__(self, outDir, prefix="reNDVI", suffix=None, crs="EPSG:4326", pyramiding=None, mask=None,
+                 metadata=None, maxWorkers=8, blockSize=512, overwrite=False):
+        self.outDir = Path(outDir).expanduser()
+        self.prefix = prefix
+        self.suffix = suffix
+        self.crs = crs
+        self.pyramiding = pyramiding if pyramiding is not None else dict(self.defaultPyramiding)
+        self.mask = mask
+        self.metadata = metadata if metadata is not None else {}
+        self.maxWorkers = maxWorkers
+        self.blockSize = blockSize
+        self.overwrite = overwrite
+        return
+
+    # scaled integer bands with nodata where values are missing or outside the mask
+    def formatOutput(self, ds, band='ndvi'):
+        if hasattr(ds, 'DS'):
+            band, ds = ds.BAND, ds.DS
+        keep = np.ones(ds[band].shape[1:], dtype=bool) if self.mask is None else np.asarray(self.mask, dtype=bool)
+
+        def _scale(arr, scale, dtype):
+            values = arr.values / scale
+            valid = np.isfinite(values) & keep
+            out = np.where(valid, np.trunc(np.where(valid, values, 0)), self.nodata[dtype]).astype(dtype)
+            return xr.DataArray(out, dims=arr.dims, attrs={'scale_factor': scale, '_FillValue': self.nodata[dtype]})
+
+        dataVars = {band: _scale(ds[band], self.ndviScale, 'int16')}
+        for name in LocalUtils.selectBands(ds, self.otherPattern):
+            dataVars[name] = _scale(ds[name], self.otherScale, 'uint8')
+
+        coords = {k: v for k, v in ds.coords.items() if set(v.dims) <= set(ds[band].dims)}
+        return xr.Dataset(dataVars, coords=coords, attrs=dict(self.metadata))
+
+    # same naming as ExportScheduler.addCollection
+    def outputName(self, date):
+        name = pd.Timestamp(date).strftime("%Y%m%d")
+        if self.prefix is not None:
+            name = f"{self.prefix}_" + name
+        if self.suffix is not None:
+            name = name + f"_{self.suffix}"
+        return name
+
+    def policy(self, name):
+        return self.pyramiding.get(name, self.pyramiding.get('.default', 'mean'))
+
+    # bands grouped by (data type, pyramiding policy), one COG per group and dekad
+    def bandGroups(self, ds):
+        groups = {}
+        for name, var in ds.data_vars.items():
+            policy = self.policy(name)
+            if policy not in self.resampling:
+                raise ValueError(f"pyramiding policy '{policy}' of band '{name}' is not supported for COGs, "
+                                 f"use one of {list(self.resampling)}")
+            groups.setdefault((str(var.dtype), policy), []).append(name)
+        return {f"{dtype}_{policy}" if len(names) > 1 else names[0]: names
+                for (dtype, policy), names in groups.items()}
+
+    def _writeCOG(self, step, names, path, rasterKwargs):
+        first = step[names[0]]
+        image = step[names].reset_coords(drop=True).to_array('band')
+        image.attrs = {'scale_factor': first.attrs['scale_factor'], 'long_name': tuple(names)}
+        image = image.rio.write_crs(self.crs).rio.write_nodata(first.attrs['_FillValue'])
+
+        # write next to the target and rename so an interrupted export leaves no partial COG
+        tmp = path.with_name(path.stem + '.tmp.tif')
+        image.rio.to_raster(tmp, driver="COG", BLOCKSIZE=self.blockSize,
+                            OVERVIEW_RESAMPLING=self.resampling[self.policy(names[0])],
+                            tags=dict(self.metadata), **rasterKwargs)
+        os.replace(tmp, path)
+        return path
+
+    def toCOG(self, collection, band='ndvi', **rasterKwargs):
+        try:
+            import rioxarray  # noqa: F401, registers the .rio accessor
+        except ImportError:
+            raise ImportError("writing COGs requires rioxarray, install it with `pip install rioxarray`")
+        self.outDir.mkdir(parents=True, exist_ok=True)
+        out = self.formatOutput(collection, band)
+        groups = self.bandGroups(out)
+        rasterKwargs = {'COMPRESS': 'DEFLATE', **rasterKwargs}
+
+        todo = []
+        for t, group in product(range(out.sizes['time']), groups):
+            path = self.outDir / f"{self.outputName(out['time'].values[t])}_{group}.tif"
+            if self.overwrite or not path.exists():
+                todo.append((t, groups[group], path))
+
+        # GDAL releases the GIL while encoding so threads are enough here
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            futures = [executor.submit(self._writeCOG, out.isel(time=t), names, path, rasterKwargs)
+                       for t, names, path in todo]
+            return [future.result() for future in futures]
+
+    def toZarr(self, collection, store, band='ndvi', timeChunk=1):
+        try:
+            import zarr  # noqa: F401
+        except ImportError:
+            raise ImportError("writing Zarr stores requires zarr, install it with `pip install zarr`")
+        store = str(Path(store).expanduser())
+        out = self.formatOutput(collection, band)
+        dims = out[band].dims
+
+        start = 0
+        if Path(store).exists() and not self.overwrite:
+            stored = pd.DatetimeIndex(xr.open_zarr(store)['time'].values)
+            # dates already in the store are skipped so re-running an export is harmless
+            out = out.isel(time=~pd.DatetimeIndex(out['time'].values).isin(stored))
+            if out.sizes['time'] == 0:
+                return store
+            if pd.Timestamp(out['time'].values.min()) <= stored.max():
+                raise ValueError(f"appended dates must be after the last stored date {stored.max().date()}")
+            start = stored.size
+
+        # xarray applies scale_factor/_FillValue when writing, so both steps write the decoded values
+        decoded = xr.decode_cf(out)
+
+        # write the layout with missing values first, chunks equal to the fill value are not stored
+        chunks = tuple(timeChunk if d == 'time' else self.blockSize for d in dims)
+        template = decoded.copy(data={name: np.broadcast_to(var.dtype.type(np.nan), var.shape)
+                                      for name, var in decoded.data_vars.items()})
+        if start == 0:
+            for var in template.data_vars.values():
+                var.encoding['chunks'] = chunks
+            template.to_zarr(store, mode='w')
+        else:
+            template.to_zarr(store, append_dim='time')
+
+        # then fill the chunk-aligned blocks in parallel, each block touches its own chunks only
+        data = decoded.drop_vars([k for k in decoded.coords if k not in dims])
+        for var in data.variables.values():
+            var.encoding = {}
+
+        def _write(block):
+            region = {d: slice(s.start + start, s.stop + start) if d == 'time' else s for d, s in block.items()}
+            data.isel(block).to_zarr(store, region=region, mode='r+')
+            return
+
+        # block edges on the chunk boundaries of the store, an append starting inside a time chunk
+        # gets a short first block so no two threads rewrite the same chunk
+        def _blocks(size, chunk, offset=0):
+            edges = sorted({0, size, *range(-offset % chunk, size, chunk)})
+            return [slice(lo, hi) for lo, hi in zip(edges[:-1], edges[1:])]
+
+        ranges = [_blocks(out.sizes[d], c, start if d == 'time' else 0) for d, c in zip(dims, chunks)]
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            list(executor.map(_write, [dict(zip(dims, block)) for block in product(*ranges)]))
+
+        return store
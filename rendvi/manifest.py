@@ -0,0 +1,93 @@
+import json
+import sqlite3
+import hashlib
+import datetime
+import threading
+from pathlib import Path
+
+
+class ExportManifest:
+    """
+    SQLite record of every planned export output keyed by asset id, with its date, a hash
+    of the output parameters, task id, state, attempts, duration and EECU usage. Passed to
+    ExportScheduler, reruns skip outputs completed with the same parameters, keep tracking
+    tasks still running from an earlier run and resubmit failed or cancelled outputs, so an
+    interrupted backfill can be restarted with the same call.
+    """
+    columns = ('assetId', 'date', 'paramHash', 'taskId', 'state', 'attempts', 'submitted',
+               'finished', 'duration', 'eecu', 'error')
+
+    def __init__(self, path="~/.rendvi/exports.sqlite"):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # the scheduler starts exports from a thread pool, writes are serialized by the lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS outputs ("
+                "assetId TEXT PRIMARY KEY, date TEXT, paramHash TEXT, taskId TEXT, state TEXT, "
+                "attempts INTEGER DEFAULT 0, submitted REAL, finished REAL, duration REAL, eecu REAL, error TEXT)"
+            )
+        return
+
+    def __repr__(self):
+        return f"ExportManifest({self.path}, {self.summary})"
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM outputs").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+        return
+
+    # hash of the parameters of one output (date, asset id, bands and export parameters), not of
+    # the image expression which holds the whole collection and changes with the date range
+    @staticmethod
+    def parameterHash(**params):
+        payload = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def get(self, assetId):
+        row = self._conn.execute("SELECT * FROM outputs WHERE assetId = ?", (assetId,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def records(self, state=None):
+        query, args = "SELECT * FROM outputs", ()
+        if state is not None:
+            query, args = query + " WHERE state = ?", (state,)
+        return [dict(row) for row in self._conn.execute(query + " ORDER BY date", args)]
+
+    # insert or update the record of an ExportJob
+    def record(self, job):
+        date = job.date.isoformat() if isinstance(job.date, (datetime.date, datetime.datetime)) else job.date
+        values = (job.assetId, date, job.paramHash, job.taskId, job.state, job.attempts, job.startTime,
+                  job.endTime, job.duration, job.eecu, job.error)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO outputs ({', '.join(self.columns)}) "
+                f"VALUES ({', '.join('?' * len(self.columns))})", values)
+        return
+
+    @property
+    def summary(self):
+        rows = self._conn.execute("SELECT state, COUNT(*) FROM outputs GROUP BY state").fetchall()
+        return {state: count for state, count in rows}
+
+    # aggregate counts, durations, EECU usage and completed outputs per hour of wall time
+    def stats(self):
+        row = self._conn.execute(
+            "SELECT COUNT(*), AVG(duration), SUM(duration), SUM(eecu), AVG(eecu), MIN(submitted), MAX(finished) "
+            "FROM outputs WHERE state = 'COMPLETED'").fetchone()
+        completed, meanDuration, totalDuration, totalEecu, meanEecu, first, last = row
+        wallHours = (last - first) / 3600. if completed and first is not None and last is not None else None
+        return {
+            'states': self.summary,
+            'completed': completed,
+            'meanDuration': meanDuration,
+            'totalDuration': totalDuration,
+            'totalEecu': totalEecu,
+            'meanEecu': meanEecu,
+            'outputsPerHour': completed / wallHours if wallHours else None,
+        }
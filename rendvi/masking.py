@@ -28,19 +28,25 @@ class Masking:
                 .rightShift(start)
 
     @staticmethod
-    def applyModis(coll, coll2):
+    def applyModis(coll, coll2, method="filter"):
         """
         Function to apply quality masking for the MXD09GQ datasets. Uses both
+        the 250m QC and the 1km state/geometry bands of the matching MXD09GA image.
+        method="filter" looks up the 1km image of every date with filterDate,
+        method="join" pairs both collections once with a saveFirst join on the date.
         """
         def _modisqa(img):
-            t = ee.Date(img.get('system:time_start'))
+            if method == "join":
+                count = ee.Number(ee.Algorithms.If(img.get('state'), 1, 0))
+                largeScale = ee.Image(ee.Algorithms.If(count.eq(1), img.get('state'), ee.Image(0)))
+            else:
+                t = ee.Date(img.get('system:time_start'))
+                count = ee.Number(coll2.filterDate(t, t.advance(1, 'day')).size())
+                largeScale = ee.Image(coll2.filterDate(
+                    t, t.advance(1, 'day')).first())
 
             qaflags = img.mask().select([0]).Not().rename('qa')
 
-            count = ee.Number(coll2.filterDate(t, t.advance(1, 'day')).size())
-            largeScale = ee.Image(coll2.filterDate(
-                t, t.advance(1, 'day')).first())
-
             cloudMask = ee.Image(ee.Algorithms.If(count.eq(1), Masking.extractBits(
                 largeScale.select('state_1km'), 10, end=11, newName='cloud_qa').Not(), ee.Image(1)))
             shadowMask = ee.Image(ee.Algorithms.If(count.eq(1),  Masking.extractBits(
@@ -79,6 +85,13 @@ class Masking:
             # get image from that date with poor data masked
             return img.updateMask(finalMask).addBands(qaflags)
 
+        if method == "join":
+            # the daily 250m and 1km granules share the same start time
+            joined = ee.Join.saveFirst(matchKey='state', outer=True).apply(
+                primary=coll, secondary=coll2,
+                condition=ee.Filter.equals(leftField='system:time_start', rightField='system:time_start'))
+            coll = ee.ImageCollection(joined)
+
         out = coll.map(_modisqa)
 
         return out
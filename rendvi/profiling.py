@@ -0,0 +1,156 @@
+import ee
+import json
+import time
+import warnings
+import tracemalloc
+import contextlib
+import pandas as pd
+from pathlib import Path
+
+# profiler used by the methods wrapped with rendvi.decorators.profileMethods
+_activeProfiler = None
+
+
+def getProfiler():
+    return _activeProfiler
+
+
+def setProfiler(profiler):
+    global _activeProfiler
+    _activeProfiler = profiler
+    return
+
+
+@contextlib.contextmanager
+def useProfiler(profiler=None):
+    if profiler is None:
+        profiler = Profiler()
+    previous = getProfiler()
+    setProfiler(profiler)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        setProfiler(previous)
+
+
+class Profiler:
+    """
+    Records wall time and getInfo round trips for every Rendvi/LocalRendvi method call,
+    the serialized graph size and node count of EE outputs, and peak memory and throughput
+    for the local engine. Nested calls are recorded separately with inclusive totals.
+    Outputs with graphs larger than graphWarnBytes raise a warning before anything is
+    submitted, the EE request payload limit is ~10MB.
+    """
+    def __init__(self, graphStats=True, memory=True, graphWarnBytes=8e6):
+        self.graphStats = graphStats
+        self.memory = memory
+        self.graphWarnBytes = graphWarnBytes
+        self.records = []
+        self._stack = []
+        self._getInfo = None
+        self._tracing = False
+        return
+
+    # count client round trips by wrapping ee.ComputedObject.getInfo while active,
+    # subclasses call it through super() so each request is counted once
+    def start(self):
+        if self._getInfo is not None:
+            return
+        self._getInfo = ee.ComputedObject.getInfo
+        original = self._getInfo
+        profiler = self
+
+        def getInfo(obj, *args, **kwargs):
+            for record in profiler._stack:
+                record['getInfoCalls'] += 1
+            return original(obj, *args, **kwargs)
+
+        ee.ComputedObject.getInfo = getInfo
+
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        return
+
+    def stop(self):
+        if self._getInfo is not None:
+            ee.ComputedObject.getInfo = self._getInfo
+            self._getInfo = None
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        return
+
+    # carry the traced peak up to every open record before the peak is reset
+    def _foldPeak(self):
+        _, peak = tracemalloc.get_traced_memory()
+        for record in self._stack:
+            record['_peak'] = max(record['_peak'], peak)
+        tracemalloc.reset_peak()
+        return
+
+    def enter(self, obj, method):
+        record = {
+            'method': f"{type(obj).__name__}.{method}",
+            'engine': 'local' if hasattr(obj, 'DS') else 'ee',
+            'depth': len(self._stack),
+            'getInfoCalls': 0,
+        }
+        if tracemalloc.is_tracing():
+            self._foldPeak()
+            record['_start'] = tracemalloc.get_traced_memory()[0]
+            record['_peak'] = record['_start']
+        if hasattr(obj, 'DS'):
+            record['inputBytes'] = int(obj.DS.nbytes)
+            record['inputPixels'] = int(obj.DS[obj.BAND].size) if obj.BAND in obj.DS else None
+        self._stack.append(record)
+        record['_t0'] = time.perf_counter()
+        return record
+
+    def exit(self, record, result):
+        record['wallTime'] = time.perf_counter() - record.pop('_t0')
+        if tracemalloc.is_tracing() and '_start' in record:
+            self._foldPeak()
+            record['peakMemory'] = record.pop('_peak') - record.pop('_start')
+        self._stack.remove(record)
+
+        if hasattr(result, 'DS'):
+            record['outputBytes'] = int(result.DS.nbytes)
+            if record.get('inputPixels') and record['wallTime'] > 0:
+                record['pixelsPerSecond'] = record['inputPixels'] / record['wallTime']
+        elif self.graphStats:
+            graph = result.IC if hasattr(result, 'IC') else result
+            if isinstance(graph, ee.ComputedObject):
+                serialized = graph.serialize()
+                record['graphBytes'] = len(serialized)
+                record['graphNodes'] = serialized.count('"functionInvocationValue"')
+                if record['graphBytes'] > self.graphWarnBytes:
+                    warnings.warn(f"{record['method']} produced a {record['graphBytes'] / 1e6:.1f}MB expression graph, "
+                                  "requests over ~10MB will be rejected")
+
+        self.records.append(record)
+        return
+
+    def toJSON(self, path=None):
+        out = json.dumps(self.records, indent=2, default=str)
+        if path is not None:
+            Path(path).expanduser().write_text(out)
+        return out
+
+    def toDataFrame(self):
+        return pd.DataFrame(self.records)
+
+    # per-method totals, one row per method sorted by total wall time
+    def summary(self):
+        df = self.toDataFrame()
+        if len(df) == 0:
+            return df
+        aggs = {'wallTime': ['count', 'sum', 'mean', 'max'], 'getInfoCalls': 'sum'}
+        for col, agg in (('graphBytes', 'max'), ('graphNodes', 'max'), ('peakMemory', 'max'), ('pixelsPerSecond', 'mean')):
+            if col in df.columns:
+                aggs[col] = agg
+        table = df.groupby('method').agg(aggs)
+        table.columns = ['calls', 'totalTime', 'meanTime', 'maxTime'] + list(table.columns[4:].get_level_values(0))
+        return table.sort_values('totalTime', ascending=False)
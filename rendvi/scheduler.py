@@ -0,0 +1,281 @@
+import ee
+import time
+import datetime
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from rendvi.manifest import ExportManifest
+
+
+# list the ids of the assets in a folder/collection, following pagination
+def listAssets(parent):
+    ids = set()
+    params = {'parent': parent.rstrip('/')}
+    while True:
+        try:
+            resp = ee.data.listAssets(params)
+        except ee.EEException:
+            # the folder/collection does not exist yet
+            break
+        ids.update(asset.get('id', asset.get('name')) for asset in resp.get('assets', []))
+        token = resp.get('nextPageToken')
+        if not token:
+            break
+        params['pageToken'] = token
+    return ids
+
+
+class ExportJob:
+    def __init__(self, image, assetId, description, date=None):
+        self.image = image
+        self.assetId = assetId
+        self.description = description
+        self.date = date
+
+        self.taskId = None
+        self.state = 'PENDING'
+        self.attempts = 0
+        self.error = None
+        self.notBefore = 0
+        self.startTime = None
+        self.endTime = None
+        self.duration = None
+        self.eecu = None
+        self.paramHash = None
+        self.replace = False
+        return
+
+    def __repr__(self):
+        return f'ExportJob({self.description}, {self.state})'
+
+
+class ExportScheduler:
+    """
+    Submits image exports to EE assets through a bounded thread pool, keeping at most
+    maxConcurrent tasks queued or running, polling the status of the active tasks and
+    retrying failures with exponential backoff. Assets that already exist are skipped, or
+    deleted and exported again with overwrite=True (e.g. dekads revised by updateTrailing).
+    With a manifest (an ExportManifest or a path to one) every output is recorded so a
+    rerun skips completed outputs and resumes tracking tasks started by an earlier run.
+    Outputs completed with other parameters are exported again when their asset no longer
+    exists or with overwrite=True, skipExisting keeps existing assets as they are.
+    """
+    activeStates = ('UNSUBMITTED', 'READY', 'RUNNING', 'CANCEL_REQUESTED')
+    failedStates = ('FAILED',)
+
+    def __init__(self, region, scale=1000, crs='EPSG:4326', pyramiding=None, maxConcurrent=20, maxWorkers=8,
+                 maxRetries=3, backoff=60, pollInterval=30, skipExisting=True, overwrite=False, verbose=True,
+                 manifest=None):
+        # get serializable geometry for export once instead of per image
+        if isinstance(region, ee.Geometry):
+            region = region.bounds().getInfo()['coordinates']
+        self.region = region
+
+        self.scale = scale
+        self.crs = crs
+        self.pyramiding = pyramiding if pyramiding is not None else {'.default': 'mean'}
+        self.maxConcurrent = maxConcurrent
+        self.maxWorkers = maxWorkers
+        self.maxRetries = maxRetries
+        self.backoff = backoff
+        self.pollInterval = pollInterval
+        self.skipExisting = skipExisting
+        self.overwrite = overwrite
+        self.verbose = verbose
+        self.manifest = ExportManifest(manifest) if isinstance(manifest, (str, Path)) else manifest
+
+        self.jobs = []
+        self._existing = {}
+        return
+
+    def _log(self, msg):
+        if self.verbose:
+            print(f"{datetime.datetime.now()}: {msg}")
+        return
+
+    # list the assets in a folder/collection once
+    def existingAssets(self, parent):
+        parent = parent.rstrip('/')
+        if parent not in self._existing:
+            self._existing[parent] = listAssets(parent)
+        return self._existing[parent]
+
+    # parameters that define an output, hashed for the manifest
+    def _exportParams(self, assetId, date=None, bands=None):
+        return dict(assetId=assetId, date=date, bands=bands, scale=self.scale, crs=self.crs, region=self.region,
+                    pyramiding=self.pyramiding)
+
+    def _record(self, job):
+        if self.manifest is not None:
+            self.manifest.record(job)
+        return
+
+    # pick up the manifest record of an output
+    def _resume(self, job):
+        previous = self.manifest.get(job.assetId)
+        if previous is None:
+            return
+        if previous['state'] == 'COMPLETED' and previous['paramHash'] == job.paramHash and not self.overwrite:
+            job.state = 'SKIPPED'
+        elif previous['state'] in self.activeStates and previous['taskId'] is not None:
+            # still queued or running from an earlier run, poll it instead of submitting a
+            # duplicate export of the same asset whatever parameters it was started with
+            job.taskId = previous['taskId']
+            job.state = previous['state']
+            job.attempts = previous['attempts']
+            job.startTime = previous['submitted']
+        return previous
+
+    def addJob(self, image, assetId, description=None, date=None, bands=None):
+        if description is None:
+            description = assetId.rstrip('/').split('/')[-1]
+        job = ExportJob(image, assetId, description, date)
+
+        parent = assetId.rsplit('/', 1)[0]
+        if (self.overwrite or self.skipExisting) and assetId in self.existingAssets(parent):
+            if self.overwrite:
+                job.replace = True
+            else:
+                job.state = 'SKIPPED'
+
+        if self.manifest is not None:
+            job.paramHash = ExportManifest.parameterHash(**self._exportParams(assetId, date, bands))
+            previous = self._resume(job) if job.state == 'PENDING' else self.manifest.get(assetId)
+            # completed records are kept as they are so the throughput statistics stay intact
+            if previous is None or previous['state'] != 'COMPLETED':
+                self._record(job)
+
+        self.jobs.append(job)
+        return job
+
+    def addCollection(self, collection, collectionAsset, prefix=None, suffix=None, metadata=None, ascending=False):
+        collection = collection.sort('system:time_start', ascending)
+
+        # all timestamps (and the band names hashed for the manifest) in one request instead of one per image
+        bands = ee.Algorithms.If(collection.size().gt(0), collection.first().bandNames(), [])
+        times, bands = ee.List([collection.aggregate_array('system:time_start'), bands]).getInfo()
+        images = collection.toList(len(times))
+
+        if not collectionAsset.endswith('/'):
+            collectionAsset += '/'
+
+        jobs = []
+        for i, t in enumerate(times):
+            img = ee.Image(images.get(i))
+
+            date = datetime.datetime.utcfromtimestamp(t / 1e3)
+            exportName = date.strftime("%Y%m%d")
+            if prefix is not None:
+                exportName = f"{prefix}_" + exportName
+            if suffix is not None:
+                exportName = exportName + f"_{suffix}"
+            assetId = collectionAsset + exportName
+
+            if metadata is not None:
+                img = img.set(metadata)
+
+            jobs.append(self.addJob(img, assetId, description=exportName, date=date, bands=bands))
+
+        return jobs
+
+    def _start(self, job):
+        job.attempts += 1
+        try:
+            if job.replace:
+                # an export cannot write over an existing asset
+                ee.data.deleteAsset(job.assetId)
+                job.replace = False
+                self._log(f"deleted {job.assetId} to export it again")
+            task = ee.batch.Export.image.toAsset(job.image,
+                                                 description=job.description,
+                                                 assetId=job.assetId,
+                                                 scale=self.scale,
+                                                 region=self.region,
+                                                 maxPixels=1e13,
+                                                 crs=self.crs,
+                                                 pyramidingPolicy=self.pyramiding
+                                                 )
+            task.start()
+            job.taskId = task.id
+            job.state = 'READY'
+            job.startTime = time.time()
+            self._log(f"started export for {job.description} (attempt {job.attempts})")
+        except Exception as e:
+            job.error = str(e)
+            self._retry(job)
+        self._record(job)
+        return job
+
+    def _retry(self, job):
+        if job.attempts <= self.maxRetries:
+            job.state = 'PENDING'
+            job.notBefore = time.time() + self.backoff * 2 ** (job.attempts - 1)
+            self._log(f"export for {job.description} failed ({job.error}), retrying")
+        else:
+            job.state = 'FAILED'
+            job.endTime = time.time()
+            self._log(f"export for {job.description} failed after {job.attempts} attempts: {job.error}")
+        return
+
+    # update the state of all active jobs, getTaskStatus looks up each task id in turn so
+    # only the active tasks are polled
+    def poll(self):
+        active = [job for job in self.jobs if job.state in self.activeStates and job.taskId is not None]
+        if len(active) == 0:
+            return
+        statuses = {s['id']: s for s in ee.data.getTaskStatus([job.taskId for job in active])}
+        for job in active:
+            status = statuses.get(job.taskId, {})
+            state = status.get('state', job.state)
+            job.eecu = status.get('batch_eecu_usage_seconds', job.eecu)
+            if state in self.failedStates:
+                job.error = status.get('error_message')
+                self._retry(job)
+            else:
+                job.state = state
+                if state not in self.activeStates:
+                    job.endTime = time.time()
+                    # run time on the server when reported, otherwise since submission
+                    if 'start_timestamp_ms' in status and 'update_timestamp_ms' in status:
+                        job.duration = (status['update_timestamp_ms'] - status['start_timestamp_ms']) / 1e3
+                    elif job.startTime is not None:
+                        job.duration = job.endTime - job.startTime
+            self._record(job)
+        return
+
+    @property
+    def summary(self):
+        counts = {}
+        for job in self.jobs:
+            counts[job.state] = counts.get(job.state, 0) + 1
+        return counts
+
+    def run(self, wait=True):
+        queue = deque(job for job in self.jobs if job.state == 'PENDING')
+
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as pool:
+            while True:
+                nActive = sum(job.state in self.activeStates for job in self.jobs)
+                capacity = len(queue) if self.maxConcurrent is None else max(self.maxConcurrent - nActive, 0)
+
+                now = time.time()
+                ready = [job for job in queue if job.notBefore <= now][:capacity]
+                for job in ready:
+                    queue.remove(job)
+                list(pool.map(self._start, ready))
+                queue.extend(job for job in ready if job.state == 'PENDING')
+
+                if not wait and (self.maxConcurrent is None or len(queue) == 0):
+                    break
+
+                time.sleep(self.pollInterval)
+                self.poll()
+                queue.extend(job for job in self.jobs if job.state == 'PENDING' and job not in queue)
+
+                if len(queue) == 0 and not any(job.state in self.activeStates for job in self.jobs):
+                    break
+
+        self._log(f"export summary: {self.summary}")
+        if self.manifest is not None:
+            self._log(f"manifest statistics: {self.manifest.stats()}")
+        return self.summary
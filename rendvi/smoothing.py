@@ -1,37 +1,352 @@
 import ee
+import warnings
+import numpy as np
+import pandas as pd
+import xarray as xr
 
 
 class Smoother:
-    def __init__(self,collection,window,xBand=None,yBand=None):
-        self.offset = window / 2.
-        self.xBand = xBand
-        self.yBand = yBand
+    # conversion factors from the EE time units to milliseconds
+    unitMillis = {'day': 86400000, 'week': 604800000, 'hour': 3600000,
+                  'minute': 60000, 'second': 1000}
+
+    def __init__(self, collection, window=30, xBand=None, yBand=None, step=10, offset=1, timeUnits="day"):
+        self.collection = collection
+        self.window = window
+        self.step = step
+        self.offset = offset
+        self.timeUnits = timeUnits
+        self.xBand = xBand if xBand is not None else 't'
+        self.yBand = yBand if yBand is not None else collection.BAND
+
+        # Rendvi wraps an ee.ImageCollection as IC, LocalRendvi wraps an xarray dataset as DS
+        self.isLocal = hasattr(collection, 'DS')
         return
 
+    # time of each observation in time units relative to the first observation
+    def _localTimes(self):
+        times = self.collection.getDates()
+        if len(times) == 0:
+            return np.array([])
+        unit = pd.Timedelta(self.unitMillis[self.timeUnits], 'ms')
+        return np.asarray((times - times[0]) / unit, dtype=np.float64)
+
+    # build the output collection of smoothed values, kept bands and a gap filled flag
+    def _localOutput(self, smoothed, idx, keepBandPattern, flagName):
+        ds = self.collection.DS.isel(time=idx)
+        dims = ds[self.yBand].dims
+
+        out = xr.Dataset({self.yBand: (dims, smoothed.astype(np.float32))}, coords=ds.coords, attrs=ds.attrs)
+        for name, arr in self.collection._keepBands(keepBandPattern, idx).items():
+            out[name] = (dims, arr)
+        if flagName is not None:
+            out[flagName] = (dims, (np.isnan(ds[self.yBand].values) & np.isfinite(smoothed)).astype(np.uint8))
+
+        return type(self.collection)(out, self.yBand, self.collection.SEED)
+
+    def smooth(self, keepBandPattern=None, flagName="temporalFilled"):
+        if self.isLocal:
+            return self._smoothLocal(keepBandPattern, flagName)
+        else:
+            return self._smoothEE(keepBandPattern, flagName)
+
+
 class MovingLinearRegress(Smoother):
-    def __init__(self,*args,**kwargs):
-        super(MovingLinearRegress, self).__init__(*args,**kwargs)
+    """
+    Moving window linear regression smoother. A line is fit to every window centered on the
+    dates of the collection using rolling sums of t, y, ty and t^2 computed once over the
+    sorted series, and each date takes the median of the fits from the windows it falls in.
+    For ee.ImageCollections the sums are accumulated as arrays and the windows are resolved
+    with server side list operations, so the computation graph does not grow with the dates.
+    """
+    def __init__(self, *args, maxStack=6, **kwargs):
+        super(MovingLinearRegress, self).__init__(*args, **kwargs)
+        self.maxStack = maxStack
         return
 
-    # Function to smooth the despiked dekad time series
-def smooth(self, d):
-        def applyFit(img):
-            return img.select('time').multiply(fit.select('scale')).add(fit.select('offset'))\
-                .set('system:time_start', img.get('system:time_start')).rename('ndvi')
+    # index ranges of the windows centered on each date and the dates smoothed
+    def _windows(self, days):
+        windowRange = self.window // 2
+        include = self.window // self.step
+        idx = np.arange(include, days.size - include)
+
+        lo = np.searchsorted(days, days[idx] - (windowRange - self.offset))
+        hi = np.searchsorted(days, days[idx] + (windowRange + self.offset))
+
+        return idx, lo, hi
+
+    # windows [first, last] that evaluate a fit at each date, only the first maxStack
+    # dates of a window are evaluated which mirrors toList(maxStack) in Rendvi.applySmoothing
+    def _overlaps(self, idx, lo, hi):
+        ends = np.minimum(hi, lo + self.maxStack)
+        first = np.searchsorted(ends, idx, side='right')
+        last = np.searchsorted(lo, idx, side='right') - 1
+        return first, last
+
+    def _smoothLocal(self, keepBandPattern, flagName, blockSize=64):
+        days = self._localTimes()
+        values = self.collection.DS[self.yBand].values
+        idx, lo, hi = self._windows(days)
+
+        shape = (-1,) + (1,) * (values.ndim - 1)
+        valid = np.isfinite(values)
+        x = np.where(valid, days.reshape(shape), 0)
+        y = np.where(valid, values, 0).astype(np.float64)
+
+        # cumulative sums padded with a leading zero so window sums are cum[hi] - cum[lo]
+        def _windowSum(a):
+            cum = np.concatenate([np.zeros((1,) + a.shape[1:]), np.cumsum(a, axis=0, dtype=np.float64)])
+            return cum[hi] - cum[lo]
+
+        n = _windowSum(valid)
+        sx = _windowSum(x)
+        sy = _windowSum(y)
+        sxy = _windowSum(x * y)
+        sxx = _windowSum(x * x)
+        del x, y
+
+        den = n * sxx - sx * sx
+        fitted = (n > 1) & (den > 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            scale = np.where(fitted, (n * sxy - sx * sy) / den, np.nan)
+            intercept = (sy - scale * sx) / n
+
+        first, last = self._overlaps(idx, lo, hi)
+        nFits = (last - first + 1).max() if idx.size > 0 else 0
+
+        smoothed = np.full((idx.size,) + values.shape[1:], np.nan)
+        for b in range(0, idx.size, blockSize):
+            block = slice(b, b + blockSize)
+            xj = days[idx[block]].reshape(shape)
+            fits = np.full((nFits,) + smoothed[block].shape, np.nan)
+            for k in range(nFits):
+                w = np.minimum(first[block] + k, max(lo.size - 1, 0))
+                inRange = (first[block] + k) <= last[block]
+                fits[k][inRange] = (scale[w] * xj + intercept[w])[inRange]
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                smoothed[block] = np.nanmedian(fits, axis=0)
+
+        return self._localOutput(smoothed, idx, keepBandPattern, flagName)
+
+    def _smoothEE(self, keepBandPattern, flagName):
+        ic = self.collection.IC.sort('system:time_start')
+        unit = self.unitMillis[self.timeUnits]
+        windowRange = self.window // 2
+        include = self.window // self.step
+
+        # window membership is resolved server side so the graph size does not grow with the dates
+        millis = ic.aggregate_array('system:time_start')
+        nDates = millis.size()
+        t0 = ee.Date(millis.get(0))
+        names = ['n', 'sx', 'sy', 'sxy', 'sxx']
+
+        def _terms(img):
+            x = ee.Image(img.date().difference(t0, self.timeUnits)).double()
+            y = img.select(self.yBand).double()
+            valid = y.mask().gt(0).double()
+            y = y.unmask(0)
+            xv = x.multiply(valid)
+            return ee.Image.cat([valid, xv, y, xv.multiply(y), xv.multiply(x)]).rename(names)
 
-        d = ee.Date(d)
+        # (T + 1) x 5 array of the per date terms accumulated along the time axis, padded with
+        # a leading row of zeros so window sums are cumulative[hi] - cumulative[lo]
+        cumulative = ee.Image(ee.Array([[0] * len(names)], ee.PixelType.double()))\
+            .arrayCat(ic.map(_terms).toArray().arrayAccum(0, ee.Reducer.sum()), 0)
 
-        window = despiked.filterDate(
-            d.advance(-self.offset, 'day'), d.advance(self.offset, 'day'))
+        # index range [lo, hi) of the window centered on each smoothed date, see _windows
+        centers = ee.List.sequence(include, nDates.subtract(include + 1))
 
-        fit = window.select([self.xBand, self.yBand])\
-            .reduce(ee.Reducer.linearFit())
+        def _bounds(i):
+            t = ee.Number(millis.get(i))
+            lo = millis.filter(ee.Filter.lt('item', t.subtract((windowRange - self.offset) * unit))).size()
+            hi = millis.filter(ee.Filter.lt('item', t.add((windowRange + self.offset) * unit))).size()
+            return ee.List([lo, hi])
 
-        out = window.map(applyFit).toList(5)
+        bounds = centers.map(_bounds)
+        windowLo = bounds.map(lambda b: ee.List(b).get(0))
+        windowEnd = bounds.map(lambda b: ee.Number(ee.List(b).get(1)).min(ee.Number(ee.List(b).get(0))
+                                                                             .add(self.maxStack)))
+        nWindows = centers.size()
 
-        return out
+        def _windowFit(b):
+            lo, hi = ee.Number(ee.List(b).get(0)), ee.Number(ee.List(b).get(1))
+            sums = cumulative.arraySlice(0, hi, hi.add(1)).subtract(cumulative.arraySlice(0, lo, lo.add(1)))\
+                .arrayProject([1]).arrayFlatten([names])
+
+            n = sums.select('n')
+            den = n.multiply(sums.select('sxx')).subtract(sums.select('sx').pow(2))
+            scale = n.multiply(sums.select('sxy')).subtract(sums.select('sx').multiply(sums.select('sy')))\
+                .divide(den)
+            intercept = sums.select('sy').subtract(scale.multiply(sums.select('sx'))).divide(n)
+            fitted = n.gt(1).And(den.gt(0))
+            return ee.Image.cat([scale, intercept, fitted]).double()
+
+        # W x 3 array of the scale, intercept and fit flag of every window
+        fits = ee.ImageCollection.fromImages(bounds.map(_windowFit)).toArray()
+
+        images = ic.toList(nDates)
+
+        def _smoothDate(i):
+            i = ee.Number(i)
+            t = ee.Number(millis.get(i))
+            x = ee.Date(t).difference(t0, self.timeUnits)
+
+            # windows [first, last] evaluating a fit at this date, see _overlaps
+            first = windowEnd.filter(ee.Filter.lte('item', i)).size()
+            last = windowLo.filter(ee.Filter.lte('item', i)).size().subtract(1)
+            start = first.min(nWindows.subtract(1))
+            rows = fits.arraySlice(0, start, last.add(1).max(start.add(1)))
+
+            candidates = rows.arraySlice(1, 0, 1).multiply(x).add(rows.arraySlice(1, 1, 2)).arrayProject([0])
+            fitted = rows.arraySlice(1, 2, 3).arrayProject([0]).multiply(last.gte(first))
+
+            # median of the fitted candidates, the others are sorted past the end
+            nFits = fitted.arrayReduce(ee.Reducer.sum(), [0]).arrayGet([0])
+            ordered = candidates.add(fitted.Not().multiply(1e30)).arraySort()
+            middle = nFits.subtract(1).divide(2).max(0)
+            reducedLine = ordered.arrayGet(middle.floor().int()).add(ordered.arrayGet(middle.ceil().int()))\
+                .divide(2).updateMask(nFits.gt(0)).rename(self.yBand)
+
+            tImg = ee.Image(images.get(i))
+            bands = [reducedLine]
+            if keepBandPattern is not None:
+                bands.append(tImg.select(keepBandPattern))
+            if flagName is not None:
+                bands.append(tImg.select(self.yBand).mask().Not().And(reducedLine.mask())
+                             .unmask(0).rename(flagName))
+            return ee.Image.cat(bands).set('system:time_start', t)
+
+        outImages = centers.map(_smoothDate)
+
+        return type(self.collection)(ee.ImageCollection.fromImages(outImages), self.yBand, self.collection.SEED)
 
 
 class Whittaker(Smoother):
-    def __init__(self,):
+    """
+    Weighted Whittaker-Eilers smoother solving (W + lambda D'D) z = W y for every pixel with
+    a banded LDL' factorization vectorized across the pixels of a chunk. Weights come from
+    the fraction of clear observations (pctClear) and are zero where no clear observation
+    (nClearObs) or value exists. Pixels sharing a weight pattern share a factorization.
+    Only available for local collections.
+    """
+    def __init__(self, *args, lmbda=10., order=2, weightBand="pctClear", countBand="nClearObs",
+                 vcurve=False, lambdas=None, **kwargs):
+        super(Whittaker, self).__init__(*args, **kwargs)
+        if not self.isLocal:
+            raise TypeError("Whittaker smoothing is only available for local collections (LocalRendvi), "
+                            "use MovingLinearRegress for ee.ImageCollections")
+        self.lmbda = lmbda
+        self.order = order
+        self.weightBand = weightBand
+        self.countBand = countBand
+        self.vcurve = vcurve
+        self.lambdas = lambdas if lambdas is not None else 10 ** np.arange(-1, 4.25, 0.25)
         return
+
+    # band diagonals of the penalty D'D where D is the difference matrix of the given order
+    @staticmethod
+    def _penaltyBands(n, order):
+        if n <= order:
+            raise ValueError(f"Whittaker smoothing of order {order} needs more than {order} dates, got {n}")
+        D = np.diff(np.eye(n), n=order, axis=0)
+        P = D.T @ D
+        return [np.diagonal(P, -k).copy() for k in range(order + 1)]
+
+    # banded LDL' factorization of matrices given as lower band diagonals, shape (n - k, pixels)
+    @staticmethod
+    def _factor(bands):
+        m = len(bands) - 1
+        n, nPix = bands[0].shape
+        d = np.zeros((n, nPix))
+        L = [None] + [np.zeros((n - k, nPix)) for k in range(1, m + 1)]
+        for i in range(n):
+            di = bands[0][i].copy()
+            for k in range(1, min(m, i) + 1):
+                di -= L[k][i - k] ** 2 * d[i - k]
+            d[i] = di
+            for k in range(1, min(m, n - 1 - i) + 1):
+                lik = bands[k][i].copy()
+                for j in range(1, min(m - k, i) + 1):
+                    lik -= L[k + j][i - j] * L[j][i - j] * d[i - j]
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    L[k][i] = lik / di
+        return d, L
+
+    # solve L D L' z = b with factors gathered per pixel by index
+    @staticmethod
+    def _solve(d, L, b, index=slice(None)):
+        m = len(L) - 1
+        n = b.shape[0]
+        u = np.zeros_like(b)
+        for i in range(n):
+            ui = b[i].copy()
+            for k in range(1, min(m, i) + 1):
+                ui -= L[k][i - k][index] * u[i - k]
+            u[i] = ui
+        with np.errstate(invalid='ignore', divide='ignore'):
+            v = u / d[:, index]
+        z = np.zeros_like(b)
+        for i in range(n - 1, -1, -1):
+            zi = v[i].copy()
+            for k in range(1, min(m, n - 1 - i) + 1):
+                zi -= L[k][i][index] * z[i + k]
+            z[i] = zi
+        return z
+
+    # fit all pixels for a scalar or per pixel lambda
+    def _fit(self, y, w, lmbda, penalty):
+        lmbda = np.asarray(lmbda, dtype=np.float64)
+        if lmbda.ndim == 0:
+            # pixels with identical weights share one factorization
+            patterns, index = np.unique(w, axis=1, return_inverse=True)
+            index = index.reshape(-1)
+            bands = [patterns + lmbda * penalty[0][:, np.newaxis]] + \
+                [lmbda * np.repeat(p[:, np.newaxis], patterns.shape[1], axis=1) for p in penalty[1:]]
+        else:
+            index = slice(None)
+            bands = [w + lmbda * penalty[0][:, np.newaxis]] + \
+                [lmbda * p[:, np.newaxis] for p in penalty[1:]]
+            bands = [np.broadcast_to(b, (b.shape[0], w.shape[1])) for b in bands]
+        d, L = self._factor(bands)
+        return self._solve(d, L, w * y, index)
+
+    # pick a lambda per pixel at the minimum of the V-curve (Frasso and Eilers, 2015)
+    def _vcurve(self, y, w, penalty):
+        logLambdas = np.log10(self.lambdas)
+        fidelity, roughness = [], []
+        for lmbda in self.lambdas:
+            z = self._fit(y, w, lmbda, penalty)
+            fidelity.append(np.log10((w * (y - z) ** 2).sum(axis=0) + 1e-12))
+            roughness.append(np.log10((np.diff(z, n=self.order, axis=0) ** 2).sum(axis=0) + 1e-12))
+        fidelity, roughness = np.array(fidelity), np.array(roughness)
+
+        distance = np.sqrt(np.diff(fidelity, axis=0) ** 2 + np.diff(roughness, axis=0) ** 2) \
+            / np.diff(logLambdas)[:, np.newaxis]
+        best = np.nanargmin(np.where(np.isfinite(distance), distance, np.inf), axis=0)
+        return 10 ** ((logLambdas[best] + logLambdas[best + 1]) / 2)
+
+    def _smoothLocal(self, keepBandPattern, flagName):
+        ds = self.collection.DS
+        values = ds[self.yBand].values
+        shape = values.shape
+        n = shape[0]
+        y = values.reshape(n, -1).astype(np.float64)
+
+        w = np.isfinite(y).astype(np.float64)
+        if self.weightBand is not None and self.weightBand in ds:
+            w *= np.clip(np.nan_to_num(ds[self.weightBand].values.reshape(n, -1)), 0, 1)
+        if self.countBand is not None and self.countBand in ds:
+            w *= ds[self.countBand].values.reshape(n, -1) > 0
+        y = np.where(w > 0, y, 0)
+
+        penalty = self._penaltyBands(n, self.order)
+        lmbda = self._vcurve(y, w, penalty) if self.vcurve else self.lmbda
+        z = self._fit(y, w, lmbda, penalty)
+
+        # not enough weighted observations to constrain the fit
+        z[:, (w > 0).sum(axis=0) <= self.order] = np.nan
+
+        self.lmbdaImage = np.broadcast_to(lmbda, (y.shape[1],)).reshape(shape[1:])
+
+        return self._localOutput(z.reshape(shape), np.arange(n), keepBandPattern, flagName)
@@ -0,0 +1,129 @@
+import os
+import numpy as np
+import xarray as xr
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from rendvi.local import LocalRendvi
+
+
+# open a path lazily so workers only read their own tile, datasets are used as is
+def _openSource(source):
+    if isinstance(source, (str, Path)):
+        path = str(Path(source).expanduser())
+        return xr.open_zarr(path) if path.rstrip('/').endswith('.zarr') else xr.open_dataset(path)
+    return source
+
+
+# runs in the worker processes, module level so it can be pickled
+def _runTile(source, climatology, read, crop, band, seed, kernel, pipelineKwargs):
+    ds = _openSource(source).isel(read).load()
+    climo = _openSource(climatology).isel(read).load()
+    smoothed = LocalRendvi(ds, band, seed).runPipeline(climo, kernel, **pipelineKwargs)
+    return smoothed.DS.isel(crop)
+
+
+class TileScheduler:
+    """
+    Splits a local (time, y, x) stack into spatial tiles and runs LocalRendvi.runPipeline
+    on each one in a process pool. Every tile is read with a halo of the spatialSmoothing
+    kernel radius so the stitched output matches a single run over the full stack; the
+    temporal stages are per pixel and need no overlap. Sources given as a Zarr/netCDF path
+    are opened by each worker, so only one tile per worker is held in memory.
+    Pixels with no despike neighbours get a seeded random fill that is drawn per tile.
+    """
+    def __init__(self, tileSize=512, maxWorkers=None, verbose=False):
+        self.tileSize = tileSize
+        self.maxWorkers = maxWorkers if maxWorkers is not None else os.cpu_count()
+        self.verbose = verbose
+        return
+
+    # halo in pixels (y, x) needed by spatialSmoothing for the kernel
+    @staticmethod
+    def kernelHalo(kernel):
+        if np.isscalar(kernel):
+            return int(kernel), int(kernel)
+        footprint = np.asarray(kernel)
+        return footprint.shape[0] // 2, footprint.shape[1] // 2
+
+    # index slices of a bounding box (xmin, ymin, xmax, ymax) or ee.Geometry on the grid
+    @staticmethod
+    def regionSlices(ds, region, dims=('y', 'x')):
+        if hasattr(region, 'bounds'):
+            coords = np.array(region.bounds().getInfo()['coordinates'][0])
+            region = (*coords.min(axis=0), *coords.max(axis=0))
+        xmin, ymin, xmax, ymax = region
+        slices = {}
+        for dim, lo, hi in ((dims[0], ymin, ymax), (dims[1], xmin, xmax)):
+            idx = np.where((ds[dim].values >= lo) & (ds[dim].values <= hi))[0]
+            if idx.size == 0:
+                raise ValueError(f"region {region} does not overlap the dataset along '{dim}'")
+            slices[dim] = slice(int(idx[0]), int(idx[-1]) + 1)
+        return slices
+
+    # (read, crop) pairs, read includes the halo and crop selects the tile from the read window.
+    # tiles cover shape starting at offset, the halo may reach outside it up to bounds
+    def tiles(self, shape, halo, dims=('y', 'x'), offset=(0, 0), bounds=None):
+        bounds = shape if bounds is None else bounds
+        out = []
+        for y0 in range(0, shape[0], self.tileSize):
+            for x0 in range(0, shape[1], self.tileSize):
+                read, crop = {}, {}
+                for i, start in enumerate((y0, x0)):
+                    start = offset[i] + start
+                    stop = min(start + self.tileSize, offset[i] + shape[i])
+                    lo, hi = max(start - halo[i], 0), min(stop + halo[i], bounds[i])
+                    read[dims[i]] = slice(lo, hi)
+                    crop[dims[i]] = slice(start - lo, stop - lo)
+                out.append((read, crop))
+        return out
+
+    def run(self, source, climatology, kernel, band='ndvi', seed=0, region=None, **pipelineKwargs):
+        if isinstance(source, LocalRendvi):
+            source, band, seed = source.DS, source.BAND, source.SEED
+        ds = _openSource(source)
+        dims = tuple(d for d in ds[band].dims if d != 'time')
+
+        window = self.regionSlices(ds, region, dims) if region is not None else {d: slice(0, ds.sizes[d]) for d in dims}
+        shape = tuple(window[d].stop - window[d].start for d in dims)
+        offset = tuple(window[d].start for d in dims)
+        tiles = self.tiles(shape, self.kernelHalo(kernel), dims, offset, tuple(ds.sizes[d] for d in dims))
+
+        # in-memory inputs are sliced here, paths are passed through and read by the workers
+        inMemory = not isinstance(source, (str, Path))
+        results = {}
+        with ProcessPoolExecutor(max_workers=self.maxWorkers) as executor:
+            futures = {}
+            for i, (read, crop) in enumerate(tiles):
+                src = ds.isel(read) if inMemory else source
+                climo = _openSource(climatology).isel(read) if not isinstance(climatology, (str, Path)) else climatology
+                readArg = {d: slice(None) for d in dims} if inMemory else read
+                futures[executor.submit(_runTile, src, climo, readArg, crop, band, seed, kernel, pipelineKwargs)] = i
+            for n, future in enumerate(as_completed(futures)):
+                results[futures[future]] = future.result()
+                if self.verbose:
+                    print(f"finished tile {n + 1}/{len(tiles)}")
+
+        template = ds[band].isel(time=0, drop=True).isel(window).reset_coords(drop=True)
+        stitched = self.stitch([results[i] for i in range(len(tiles))], tiles, template, offset)
+        return LocalRendvi(stitched, band, seed)
+
+    # place the cropped tiles into full size arrays on the grid of template
+    @staticmethod
+    def stitch(parts, tiles, template, offset=(0, 0)):
+        dims = tuple(template.dims)
+        first = parts[0]
+        dataVars = {}
+        for name, var in first.data_vars.items():
+            shape = tuple(template.sizes[d] if d in dims else var.sizes[d] for d in var.dims)
+            arr = np.empty(shape, dtype=var.dtype)
+            for part, (read, crop) in zip(parts, tiles):
+                index = tuple(slice(read[d].start - offset[dims.index(d)] + crop[d].start,
+                                    read[d].start - offset[dims.index(d)] + crop[d].stop) if d in dims else slice(None)
+                              for d in var.dims)
+                arr[index] = part[name].values
+            dataVars[name] = (var.dims, arr)
+
+        coords = {k: v for k, v in first.coords.items() if not set(v.dims) & set(dims)}
+        coords.update({k: v for k, v in template.coords.items()})
+        return xr.Dataset(dataVars, coords=coords, attrs=first.attrs)
+
@@ -0,0 +1,151 @@
+import ee
+import time
+import datetime
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TimeSeriesExtractor:
+    """
+    Extracts time series at many sites from an ImageCollection. Requests are split into
+    batches of sites and date ranges so each stays under maxElements, batches run
+    concurrently and the results are returned as one tidy DataFrame with a row per site
+    and date. Sites can be an ee.FeatureCollection, a GeoDataFrame or a list of (lon, lat).
+    """
+    # errors where a smaller request is likely to succeed
+    splitErrors = ('timed out', 'memory limit', 'accumulating over', 'too large', 'too many elements')
+
+    def __init__(self, collection, scale=250, bands=None, reducer=None, idField='siteId', maxElements=1e6,
+                 sitesPerBatch=500, maxWorkers=8, maxRetries=3, backoff=5, tileScale=1, nodata=-32768,
+                 verbose=False):
+        self.scale = scale
+        self.reducer = reducer if reducer is not None else ee.Reducer.mean()
+        self.idField = idField
+        self.maxElements = int(maxElements)
+        self.sitesPerBatch = sitesPerBatch
+        self.maxWorkers = maxWorkers
+        self.maxRetries = maxRetries
+        self.backoff = backoff
+        self.tileScale = tileScale
+        self.nodata = nodata
+        self.verbose = verbose
+
+        if bands is None:
+            bands = ee.Image(collection.first()).bandNames().getInfo()
+        self.bands = list(bands)
+        self.collection = collection.select(self.bands)
+
+        # reducer must have a single output. reduceRegions names the properties after the bands
+        # for multi-band images but after the reducer output (e.g. 'mean') for a single band
+        if len(self.bands) == 1:
+            self.reducer = self.reducer.setOutputs(self.bands)
+        return
+
+    def _log(self, msg):
+        if self.verbose:
+            print(f"{datetime.datetime.now()}: {msg}")
+        return
+
+    # client side list of (id, ee.FeatureCollection batch) pairs
+    def _siteBatches(self, sites):
+        if isinstance(sites, ee.Geometry):
+            sites = ee.FeatureCollection([ee.Feature(sites, {self.idField: 0})])
+
+        if isinstance(sites, ee.FeatureCollection):
+            # site ids in one request, each batch is a server side filter of the collection
+            ids = sites.aggregate_array(self.idField).getInfo()
+            return [(ids[i:i + self.sitesPerBatch],
+                     sites.filter(ee.Filter.inList(self.idField, ids[i:i + self.sitesPerBatch])))
+                    for i in range(0, len(ids), self.sitesPerBatch)]
+
+        if hasattr(sites, 'geometry') and hasattr(sites, '__geo_interface__'):
+            # GeoDataFrame, use the id column if it exists otherwise the index
+            ids = sites[self.idField].tolist() if self.idField in sites.columns else sites.index.tolist()
+            geoms = [g.__geo_interface__ for g in sites.geometry.to_crs(epsg=4326)]
+        else:
+            ids = list(range(len(sites)))
+            geoms = [{'type': 'Point', 'coordinates': list(xy)} for xy in sites]
+
+        batches = []
+        for i in range(0, len(ids), self.sitesPerBatch):
+            features = [ee.Feature(ee.Geometry(g), {self.idField: sid})
+                        for sid, g in zip(ids[i:i + self.sitesPerBatch], geoms[i:i + self.sitesPerBatch])]
+            batches.append((ids[i:i + self.sitesPerBatch], ee.FeatureCollection(features)))
+        return batches
+
+    # split the dates so sites x dates x columns stays under maxElements
+    def _dateBatches(self, times, nSites):
+        nColumns = len(self.bands) + 2
+        perRequest = max(self.maxElements // (nSites * nColumns), 1)
+        return [times[i:i + perRequest] for i in range(0, len(times), perRequest)]
+
+    def _request(self, collection, sites, times):
+        selectors = [self.idField, 'time'] + self.bands
+        defaults = ee.Dictionary.fromLists(self.bands, ee.List.repeat(self.nodata, len(self.bands)))
+
+        def _reduce(img):
+            t = img.get('system:time_start')
+            reduced = img.reduceRegions(collection=sites, reducer=self.reducer,
+                                        scale=self.scale, tileScale=self.tileScale)
+
+            # masked pixels leave the band property unset, fill with nodata so the row is kept
+            def _fill(f):
+                props = defaults.combine(f.toDictionary(), True)
+                return ee.Feature(None, props).set('time', t)
+            return reduced.map(_fill)
+
+        window = collection.filterDate(ee.Date(int(times[0])), ee.Date(int(times[-1]) + 1))
+        table = window.map(_reduce).flatten()
+
+        # columnar result in one dictionary instead of a list of features
+        result = table.reduceColumns(ee.Reducer.toList().repeat(len(selectors)), selectors).get('list').getInfo()
+        return pd.DataFrame(dict(zip(selectors, result)), columns=selectors)
+
+    def _run(self, collection, ids, sites, times, attempt=0):
+        try:
+            return [self._request(collection, sites, times)]
+        except ee.EEException as e:
+            msg = str(e).lower()
+            if any(err in msg for err in self.splitErrors) and (len(ids) > 1 or len(times) > 1):
+                # halve the dates first, then the sites, and try both halves
+                self._log(f"splitting batch of {len(ids)} sites x {len(times)} dates: {e}")
+                if len(times) > 1:
+                    half = len(times) // 2
+                    return (self._run(collection, ids, sites, times[:half]) +
+                            self._run(collection, ids, sites, times[half:]))
+                half = len(ids) // 2
+                left = sites.filter(ee.Filter.inList(self.idField, ids[:half]))
+                right = sites.filter(ee.Filter.inList(self.idField, ids[half:]))
+                return self._run(collection, ids[:half], left, times) + self._run(collection, ids[half:], right, times)
+            if attempt < self.maxRetries:
+                self._log(f"retrying batch of {len(ids)} sites x {len(times)} dates: {e}")
+                time.sleep(self.backoff * 2 ** attempt)
+                return self._run(collection, ids, sites, times, attempt + 1)
+            raise
+
+    def extract(self, sites, start=None, end=None):
+        collection = self.collection
+        if start is not None:
+            collection = collection.filter(ee.Filter.gte('system:time_start', ee.Date(start).millis()))
+        if end is not None:
+            collection = collection.filter(ee.Filter.lt('system:time_start', ee.Date(end).millis()))
+
+        # all timestamps in one request, the date batches are built client side
+        times = np.unique(collection.aggregate_array('system:time_start').getInfo())
+
+        requests = []
+        for ids, batch in self._siteBatches(sites):
+            for dates in self._dateBatches(times, len(ids)):
+                requests.append((collection, ids, batch, dates))
+        self._log(f"extracting {len(times)} dates in {len(requests)} requests")
+
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as pool:
+            frames = pool.map(lambda args: self._run(*args), requests)
+            frames = [df for result in frames for df in result]
+
+        df = pd.concat(frames, ignore_index=True) if len(frames) else pd.DataFrame(columns=[self.idField, 'time'] + self.bands)
+        df[self.bands] = df[self.bands].astype(float).replace(self.nodata, np.nan)
+        df['date'] = pd.to_datetime(df['time'].astype('int64'), unit='ms')
+        df = df.drop(columns='time').sort_values([self.idField, 'date'])
+        return df[[self.idField, 'date'] + self.bands].reset_index(drop=True)
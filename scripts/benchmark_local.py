@@ -0,0 +1,200 @@
+import sys
+import json
+import time
+import fire
+import datetime
+import subprocess
+import numpy as np
+import pandas as pd
+import xarray as xr
+from pathlib import Path
+
+from rendvi.local import LocalRendvi, LocalMasking
+from rendvi.forecast import Harmonics
+from rendvi.profiling import Profiler, useProfiler
+
+# per sensor settings for the synthetic cubes: pixel size (deg), clear-sky probability,
+# NDVI noise and seasonal amplitude
+SENSORS = {
+    "modis": dict(res=0.0025, clear=0.55, noise=0.04, amplitude=0.25),
+    "viirs": dict(res=0.005, clear=0.6, noise=0.03, amplitude=0.22),
+}
+# qa flag values as written by Masking.applyModis/applyViirs and their relative frequency
+QA_FLAGS = np.array([3, 4, 5, 6, 7, 8])
+QA_WEIGHTS = np.array([0.15, 0.5, 0.15, 0.05, 0.1, 0.05])
+
+
+def syntheticCube(sensor="modis", years=3, size=64, seed=0):
+    """Daily NDVI/qa cube with a seasonal cycle, spatially clumped clouds and spikes."""
+    cfg = SENSORS[sensor]
+    rng = np.random.default_rng(seed)
+    times = pd.date_range("2001-01-01", periods=int(365.25 * years), freq="D")
+    nt = times.size
+
+    phase = rng.uniform(0, 2 * np.pi, (size, size)).astype(np.float32)
+    base = rng.uniform(0.2, 0.6, (size, size)).astype(np.float32)
+    doy = times.dayofyear.values.astype(np.float32)[:, None, None]
+    ndvi = base + cfg["amplitude"] * np.sin(2 * np.pi * doy / 365. + phase)
+    ndvi += rng.normal(0, cfg["noise"], ndvi.shape).astype(np.float32)
+
+    # clouds come in blocks of pixels rather than independently per pixel
+    block = 8
+    coarse = -(-size // block)
+    cloudy = rng.random((nt, coarse, coarse)) > cfg["clear"]
+    cloudy = np.repeat(np.repeat(cloudy, block, axis=1), block, axis=2)[:, :size, :size]
+    qa = np.where(cloudy, rng.choice(QA_FLAGS, cloudy.shape, p=QA_WEIGHTS), 0).astype(np.uint8)
+
+    # occasional undetected cloud spikes the despike stage should remove
+    spikes = (rng.random(ndvi.shape) < 0.01) & (qa == 0)
+    ndvi[spikes] -= 0.3
+    ndvi[qa > 0] = np.nan
+
+    lon = 36 + cfg["res"] * np.arange(size)
+    lat = 1 - cfg["res"] * np.arange(size)
+    return xr.Dataset({"ndvi": (("time", "y", "x"), ndvi.astype(np.float32)),
+                       "qa": (("time", "y", "x"), qa)},
+                      coords={"time": times, "y": lat, "x": lon})
+
+
+def syntheticRaw(sensor="modis", years=3, size=64, seed=0):
+    """Daily raw reflectance and QA words for the masking stage, state data shares the 250m grid."""
+    rng = np.random.default_rng(seed)
+    times = pd.date_range("2001-01-01", periods=int(365.25 * years), freq="D")
+    shape = (times.size, size, size)
+    dims = ("time", "y", "x")
+    coords = {"time": times, "y": np.arange(size, dtype=float), "x": np.arange(size, dtype=float)}
+
+    red = rng.integers(-100, 4000, shape, dtype=np.int16)
+    nir = rng.integers(-100, 6000, shape, dtype=np.int16)
+    sensorZ = rng.integers(-6500, 6500, shape, dtype=np.int16)
+    solarZ = rng.integers(-9000, 9000, shape, dtype=np.int16)
+    if sensor == "viirs":
+        return xr.Dataset({"I1": (dims, red), "I2": (dims, nir),
+                           "QF1": (dims, rng.integers(0, 256, shape, dtype=np.uint8)),
+                           "QF2": (dims, rng.integers(0, 256, shape, dtype=np.uint8)),
+                           "QF4": (dims, rng.integers(0, 256, shape, dtype=np.uint8)),
+                           "SensorZenith": (dims, sensorZ), "SolarZenith": (dims, solarZ)}, coords=coords)
+    return xr.Dataset({"sur_refl_b01": (dims, red), "sur_refl_b02": (dims, nir),
+                       "QC_250m": (dims, rng.integers(0, 1 << 16, shape, dtype=np.uint16)),
+                       "state_1km": (dims, rng.integers(0, 1 << 16, shape, dtype=np.uint16)),
+                       "SensorZenith": (dims, sensorZ), "SolarZenith": (dims, solarZ)}, coords=coords)
+
+
+def maskRaw(s):
+    raw = s["raw"]
+    return LocalMasking.applyViirs(raw) if "QF1" in raw else LocalMasking.applyModis(raw, raw)
+
+
+# stages in pipeline order, each takes the outputs of earlier stages
+STAGES = [
+    ("masking", maskRaw),
+    ("dekads", lambda s: LocalRendvi(s["cube"], "ndvi").getDekadImages()),
+    ("climatology", lambda s: s["dekads"].calcClimatology()),
+    ("despike", lambda s: s["dekads"].applyDespike(window=30, step=10)),
+    ("backFill", lambda s: s["despike"].climatologyBackFill(s["climatology"], keepBandPattern="^(de|pct|nClear).*")),
+    ("spatialSmoothing", lambda s: s["backFill"].spatialSmoothing(3, keepBandPattern="^(clima|de|pct|nClear).*")),
+    ("temporalSmoothing", lambda s: s["spatialSmoothing"].applySmoothing(window=50, keepBandPattern="^(clima|de|pct|nClear|sp).*")),
+    ("whittaker", lambda s: s["spatialSmoothing"].applyWhittaker(lmbda=10.)),
+    ("harmonics", lambda s: Harmonics().fit(s["temporalSmoothing"])),
+]
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=Path(__file__).parent).decode().strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return "unknown"
+
+
+def runCase(sensor, years, size, repeats, stages):
+    state = {"cube": syntheticCube(sensor, years, size)}
+    if stages is None or "masking" in stages:
+        state["raw"] = syntheticRaw(sensor, years, size)
+    results = []
+    for name, func in STAGES:
+        if stages is not None and name not in stages:
+            continue
+        timings = []
+        for _ in range(repeats):
+            profiler = Profiler(graphStats=False)
+            with useProfiler(profiler):
+                t0 = time.perf_counter()
+                state[name] = func(state)
+                timings.append(time.perf_counter() - t0)
+        top = [r for r in profiler.records if r["depth"] == 0]
+        results.append(dict(sensor=sensor, years=years, size=size, stage=name, seconds=min(timings),
+                            peakMemory=max((r.get("peakMemory", 0) for r in top), default=None)))
+    return results
+
+
+def compare(current, history, commit, tolerance):
+    keys = ["sensor", "years", "size", "stage"]
+    previous = history[history.commit != commit]
+    if len(previous) == 0:
+        current["previous"] = np.nan
+    else:
+        # latest run of each case from another commit
+        previous = previous.sort_values("timestamp").groupby(keys).last()[["seconds", "commit"]]
+        previous.columns = ["previous", "previousCommit"]
+        current = current.join(previous, on=keys)
+    current["change"] = current.seconds / current.previous - 1
+    current["regression"] = current.change > tolerance
+    return current
+
+
+# comma separated string (or list/tuple/scalar as parsed by fire) to a list of values
+def asList(value, cast):
+    if isinstance(value, str):
+        value = value.split(",")
+    elif not isinstance(value, (list, tuple)):
+        value = [value]
+    return [cast(v) for v in value]
+
+
+def main(sensors="modis,viirs", years="1,3", sizes="32,128", repeats=3, stages=None,
+         history="rendvi_benchmarks.jsonl", tolerance=0.2, failOnRegression=False):
+    """
+    Time each local pipeline stage on synthetic cubes for every combination of sensor,
+    series length (years) and tile size (pixels per side), append the results to the
+    history file and flag stages that slowed down by more than tolerance since the last
+    run on a different commit.
+    """
+    sensors = asList(sensors, str)
+    years = asList(years, int)
+    sizes = asList(sizes, int)
+    stages = asList(stages, str) if stages is not None else None
+
+    commit = gitCommit()
+    timestamp = datetime.datetime.now().isoformat()
+
+    results = []
+    for sensor in sensors:
+        for y in years:
+            for size in sizes:
+                results.extend(runCase(sensor, y, size, repeats, stages))
+    current = pd.DataFrame(results)
+
+    history = Path(history)
+    past = pd.read_json(history, lines=True) if history.is_file() and history.stat().st_size > 0 else pd.DataFrame(
+        columns=list(current.columns) + ["commit", "timestamp"])
+    report = compare(current, past, commit, tolerance)
+
+    with open(history, "a") as dst:
+        for record in results:
+            dst.write(json.dumps(dict(record, commit=commit, timestamp=timestamp)) + "\n")
+
+    with pd.option_context("display.width", 200, "display.max_rows", None):
+        print(report.to_string(index=False, float_format=lambda v: f"{v:.4g}"))
+
+    regressions = report[report.regression]
+    if len(regressions):
+        print(f"{len(regressions)} stages slowed down by more than {tolerance:.0%}")
+        if failOnRegression:
+            sys.exit(1)
+
+    return
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -1,11 +1,16 @@
 import os
+import time
 import fire
 import requests
-import subprocess
 import datetime
 import asyncio
 from pathlib import Path
-from zipfile import ZipFile
+from zipfile import ZipFile, BadZipFile
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_URL = "https://edcintl.cr.usgs.gov/downloads/sciweb1/shared/fews/web/africa/east/dekadal/emodis/ndvi_c6/temporallysmoothedndvi/downloads/dekadal"
+CHUNK_SIZE = 1024 * 1024
 
 
 def decode_date(string: str):
@@ -22,7 +27,7 @@ def decode_date(string: str):
         return dt
       except ValueError:
         continue
-  raise argparse.ArgumentTypeError(
+  raise ValueError(
       'Invalid value for property of type "date": "%s".' % string)
 
 def dekad_to_datetime(dekad: int, year: int) -> datetime.datetime:
@@ -37,31 +42,89 @@ def dekad_to_datetime(dekad: int, year: int) -> datetime.datetime:
 
     return datetime.datetime.strptime(f'{year}-{julian_date}', '%Y-%j')
 
-def pull_emodis(working_dir: Path, dekad: int, year: int) -> str:
+
+class StageTimer:
+    """Collects wall clock durations per pipeline stage."""
+    def __init__(self):
+        self.durations = {}
+        self.start = time.perf_counter()
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.durations.setdefault(stage, []).append(seconds)
+
+    def summary(self) -> str:
+        lines = [f"total wall time: {time.perf_counter() - self.start:.1f}s"]
+        for stage, values in self.durations.items():
+            lines.append(f"{stage}: n={len(values)} total={sum(values):.1f}s "
+                         f"mean={sum(values) / len(values):.1f}s max={max(values):.1f}s")
+        return "\n".join(lines)
+
+
+def make_session(pool_size: int) -> requests.Session:
+    # one session shared by all downloads so connections are pooled and reused
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def pull_emodis(session: requests.Session, working_dir: Path, dekad: int, year: int, timeout: int = 300) -> Path:
     yr = str(year)[-2:]
     dk = f"{dekad:02d}"
     fname = f"ea{yr}{dk}.zip"
-    url = f"https://edcintl.cr.usgs.gov/downloads/sciweb1/shared/fews/web/africa/east/dekadal/emodis/ndvi_c6/temporallysmoothedndvi/downloads/dekadal/{fname}"
+    url = f"{BASE_URL}/{fname}"
     output_file = working_dir / fname
 
-    if output_file.is_file() is False:
-        with requests.Session() as session:
-            resp = session.get(url)
-            if resp.status_code == 200:
-                output_file.write_bytes(resp.content)
+    if output_file.is_file():
+        return output_file
+
+    # stream to a partial file and resume from its size if a previous run was interrupted
+    partial_file = output_file.with_suffix(".zip.part")
+    offset = partial_file.stat().st_size if partial_file.is_file() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as resp:
+        if resp.status_code == 416:
+            # partial file already holds the full content
+            pass
+        elif resp.status_code in (200, 206):
+            mode = "ab" if resp.status_code == 206 else "wb"
+            with open(partial_file, mode) as dst:
+                for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                    dst.write(chunk)
+        else:
+            raise RuntimeError(f"download of {url} failed with status {resp.status_code}")
 
-        with ZipFile(str(output_file), "r") as zip_obj:
+    os.replace(str(partial_file), str(output_file))
+    return output_file
+
+def unzip_emodis(zip_file: Path, working_dir: Path) -> Path:
+    tif_file = zip_file.with_suffix(".tif")
+    if tif_file.is_file():
+        return tif_file
+
+    try:
+        with ZipFile(str(zip_file), "r") as zip_obj:
             # Extract all the contents of zip file to the working directory
             zip_obj.extractall(str(working_dir))
+    except BadZipFile:
+        # corrupt download, remove so the next run fetches it again
+        zip_file.unlink()
+        raise
 
-    return output_file.with_suffix(".tif")
+    return tif_file
 
+async def run_command(cmd: str) -> str:
+    proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    out, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"command '{cmd}' failed: {out.decode(errors='ignore')}")
+    return out.decode(errors='ignore')
 
-def push_to_ee(file: Path, gcs_bucket: str, ee_collection: str, date: datetime.datetime) -> None:
+async def push_to_ee(file: Path, gcs_bucket: str, ee_collection: str, date: datetime.datetime) -> None:
     # first push the file to GCS
     cmd = "gsutil cp {0} {1}".format(str(file.with_suffix(".*")),gcs_bucket)
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    out, err = proc.communicate()
+    await run_command(cmd)
 
     fname = file.name
     bucket_obj = f'{gcs_bucket}/{fname}'
@@ -69,25 +132,124 @@ def push_to_ee(file: Path, gcs_bucket: str, ee_collection: str, date: datetime.d
     property_str = f"--time_start {date.strftime('%Y-%m-%d')}"
 
     cmd = f"earthengine upload image --asset_id={ee_asset} {property_str} {bucket_obj}"
-    proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    out, err = proc.communicate()
+    await run_command(cmd)
 
     return
 
-async def pipeline(working_dir: Path, gcs_bucket: str, ee_collection: str, dekad: int, year: int,verbose: bool=False):
-    if verbose: print(f"{datetime.datetime.now()}: Starting download for dekad #{dekad} in {year}")
-    f = pull_emodis(working_dir,dekad,year)
 
-    if verbose: print(f"{datetime.datetime.now()}: Starting upload to GCS/EE for dekad #{dekad} in {year}")
-    date = dekad_to_datetime(dekad,year)
-    push_to_ee(f,gcs_bucket,ee_collection,date)
+class IngestPipeline:
+    """
+    Concurrent download -> unzip -> upload pipeline. Each stage has its own worker pool and
+    bounded queue so downloads keep the connection busy while earlier dekads are unzipped
+    and uploaded.
+    """
+    def __init__(self, working_dir: Path, gcs_bucket: str, ee_collection: str, max_downloads: int = 4,
+                 max_unzips: int = 2, max_uploads: int = 4, verbose: bool = False):
+        self.working_dir = working_dir
+        self.gcs_bucket = gcs_bucket
+        self.ee_collection = ee_collection
+        self.max_downloads = max_downloads
+        self.max_unzips = max_unzips
+        self.max_uploads = max_uploads
+        self.verbose = verbose
 
-    if verbose: print(f"{datetime.datetime.now()}: process finished\n")
-    return
+        self.session = make_session(max_downloads)
+        self.executor = ThreadPoolExecutor(max_workers=max_downloads + max_unzips)
+        self.timer = StageTimer()
+        self.failures = []
 
+    def log(self, msg: str) -> None:
+        if self.verbose: print(f"{datetime.datetime.now()}: {msg}")
 
-def main(gcs_bucket: str, ee_collection: str, start_time: str="2000-01-01", end_time: str="2000-01-31", working_dir: str="./", cleanup: bool=False, verbose: bool=False) -> None:
-# def main(working_dir: Path, dekad: int, year: int) -> None:
+    async def timed(self, stage: str, label: str, coro):
+        t0 = time.perf_counter()
+        result = await coro
+        self.timer.record(stage, time.perf_counter() - t0)
+        self.log(f"finished {stage} for {label} in {time.perf_counter() - t0:.1f}s")
+        return result
+
+    async def download_worker(self, inbox: asyncio.Queue, outbox: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await inbox.get()
+            if item is None:
+                inbox.task_done()
+                break
+            dekad, year = item
+            label = f"dekad #{dekad} in {year}"
+            try:
+                zip_file = await self.timed("download", label, loop.run_in_executor(
+                    self.executor, pull_emodis, self.session, self.working_dir, dekad, year))
+                await outbox.put((dekad, year, zip_file))
+            except Exception as e:
+                self.failures.append((label, "download", str(e)))
+                self.log(f"download failed for {label}: {e}")
+            inbox.task_done()
+
+    async def unzip_worker(self, inbox: asyncio.Queue, outbox: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await inbox.get()
+            if item is None:
+                inbox.task_done()
+                break
+            dekad, year, zip_file = item
+            label = f"dekad #{dekad} in {year}"
+            try:
+                tif_file = await self.timed("unzip", label, loop.run_in_executor(
+                    self.executor, unzip_emodis, zip_file, self.working_dir))
+                await outbox.put((dekad, year, tif_file))
+            except Exception as e:
+                self.failures.append((label, "unzip", str(e)))
+                self.log(f"unzip failed for {label}: {e}")
+            inbox.task_done()
+
+    async def upload_worker(self, inbox: asyncio.Queue):
+        while True:
+            item = await inbox.get()
+            if item is None:
+                inbox.task_done()
+                break
+            dekad, year, tif_file = item
+            label = f"dekad #{dekad} in {year}"
+            try:
+                date = dekad_to_datetime(dekad, year)
+                await self.timed("upload", label, push_to_ee(tif_file, self.gcs_bucket, self.ee_collection, date))
+            except Exception as e:
+                self.failures.append((label, "upload", str(e)))
+                self.log(f"upload failed for {label}: {e}")
+            inbox.task_done()
+
+    async def run(self, dekads: list):
+        downloads = asyncio.Queue()
+        unzips = asyncio.Queue(maxsize=self.max_unzips * 2)
+        uploads = asyncio.Queue(maxsize=self.max_uploads * 2)
+
+        for item in dekads:
+            downloads.put_nowait(item)
+
+        download_workers = [asyncio.ensure_future(self.download_worker(downloads, unzips)) for _ in range(self.max_downloads)]
+        unzip_workers = [asyncio.ensure_future(self.unzip_worker(unzips, uploads)) for _ in range(self.max_unzips)]
+        upload_workers = [asyncio.ensure_future(self.upload_worker(uploads)) for _ in range(self.max_uploads)]
+
+        # shut the stages down in order, each worker exits on a None sentinel
+        for _ in download_workers:
+            await downloads.put(None)
+        await asyncio.gather(*download_workers)
+        for _ in unzip_workers:
+            await unzips.put(None)
+        await asyncio.gather(*unzip_workers)
+        for _ in upload_workers:
+            await uploads.put(None)
+        await asyncio.gather(*upload_workers)
+
+        self.session.close()
+        self.executor.shutdown()
+        return
+
+
+def main(gcs_bucket: str, ee_collection: str, start_time: str="2000-01-01", end_time: str="2000-01-31", working_dir: str="./",
+         max_downloads: int=4, max_unzips: int=2, max_uploads: int=4, cleanup: bool=False, verbose: bool=False) -> None:
 
     start_time = decode_date(start_time)
     end_time = decode_date(end_time)
@@ -96,22 +258,31 @@ def main(gcs_bucket: str, ee_collection: str, start_time: str="2000-01-01", end_
 
     working_dir = Path(working_dir)
 
-    tasks = []
+    dekads = []
     for y in range(start_year,end_year+1):
         for d in range(1,37):
             dekad_date = dekad_to_datetime(d,y)
             if dekad_date >= start_time and dekad_date <= end_time:
-                tasks.append(pipeline(working_dir,gcs_bucket,ee_collection,d,y,verbose=verbose))
+                dekads.append((d,y))
+
+    pipeline = IngestPipeline(working_dir, gcs_bucket, ee_collection, max_downloads=max_downloads,
+                              max_unzips=max_unzips, max_uploads=max_uploads, verbose=verbose)
 
     loop = asyncio.new_event_loop()
-    done, _ = loop.run_until_complete(asyncio.wait(tasks))
+    loop.run_until_complete(pipeline.run(dekads))
     loop.close()
 
+    print(pipeline.timer.summary())
+    if pipeline.failures:
+        print(f"{len(pipeline.failures)} dekads failed:")
+        for label, stage, err in pipeline.failures:
+            print(f"  {label} ({stage}): {err}")
+
     if cleanup:
         files = os.listdir(working_dir)
         for f in files:
             trash = working_dir / f
-            if trash.suffix is not ".py":
+            if trash.is_file() and trash.suffix != ".py" and not trash.name.endswith(".part"):
                 os.remove(str(trash.resolve()))
 
     return
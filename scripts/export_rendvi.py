@@ -70,5 +70,6 @@ rendvi.batchExport(outputs,
                    scale=250, 
                    crs='EPSG:4326',
                    metadata=metadataDict, 
-                   pyramiding=pyramidingDict
+                   pyramiding=pyramidingDict,
+                   manifest="reNDVI_exports.sqlite"
                   )
\ No newline at end of file
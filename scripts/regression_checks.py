@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+import types
+import fire
+import tempfile
+from unittest import mock
+
+import ee
+import numpy as np
+import pandas as pd
+
+from rendvi.cache import EEStageCache
+from rendvi.scheduler import ExportScheduler
+from rendvi.local import LocalRendvi, LocalUtils
+from benchmark_local import syntheticCube
+
+
+def checkCacheMiss(nImages=700, maxSeconds=5.):
+    """
+    A cache miss on an EE stage submits the exports of every image and returns without
+    waiting on the scheduler's poll loop. Task submission is replaced by a stand-in so
+    no Earth Engine session is needed.
+    """
+    started = []
+
+    class Task:
+        def __init__(self, image, assetId, **kwargs):
+            self.id = f"T{len(started)}"
+            self.assetId = assetId
+
+        def start(self):
+            started.append(self.assetId)
+
+    def addCollection(scheduler, collection, collectionAsset, prefix=None, **kwargs):
+        return [scheduler.addJob(None, f"{collectionAsset}/{prefix}_{i:04d}") for i in range(nImages)]
+
+    with tempfile.TemporaryDirectory() as tmp, \
+            mock.patch.object(ee.data, 'createAsset', create=True), \
+            mock.patch.object(ee.data, 'listAssets', return_value={'assets': []}, create=True), \
+            mock.patch.object(ee.batch.Export.image, 'toAsset', Task), \
+            mock.patch.object(ExportScheduler, 'addCollection', addCollection):
+        cache = EEStageCache("projects/rendvi-checks/assets/cache", [[33, -5], [42, 6]],
+                             indexPath=os.path.join(tmp, "index.json"), verbose=False)
+        t0 = time.perf_counter()
+        cache.store("0" * 40, "dekads", types.SimpleNamespace(IC=None))
+        seconds = time.perf_counter() - t0
+
+    passed = seconds < maxSeconds and len(started) == nImages
+    print(f"cacheMiss: {len(started)}/{nImages} exports started in {seconds:.2f}s "
+          f"({'ok' if passed else 'FAILED'})")
+    return passed
+
+
+# back-fill written date by date after Rendvi.climatologyBackFill(method="filter"): the
+# z-scores of the previous dekads in [t - nDays, t - 1 day) are masked where the climatology
+# count (unscaled) is not above 0.6, and their mean fills the gap from the climatology
+def referenceBackFill(values, times, climatology, band="ndvi", nPeriods=5, step=10):
+    nDays = (nPeriods * step) + 5
+    dekads = LocalUtils.dekadOfYear(times)
+    mean = climatology[f"{band}_mean"].values[dekads]
+    std = climatology[f"{band}_stdDev"].values[dekads]
+    count = climatology["count"].values[dekads]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = np.where(count > 0.6, (values - mean) / std, np.nan)
+
+    filled = np.zeros(values.shape, dtype=bool)
+    for i, t in enumerate(times):
+        previous = (times >= t - pd.Timedelta(days=nDays)) & (times < t - pd.Timedelta(days=1))
+        if previous.any():
+            zPrevious = z[previous]
+            nValid = np.isfinite(zPrevious).sum(axis=0)
+            zScore = np.where(nValid > 0, np.nansum(zPrevious, axis=0) / np.maximum(nValid, 1), np.nan)
+        else:
+            zScore = np.zeros(values.shape[1:])
+        filled[i] = np.isnan(values[i]) & np.isfinite(mean[i] + zScore * std[i])
+    return filled
+
+
+def checkBackFill(years=3, size=32, minCoverage=0.99):
+    """
+    LocalRendvi.climatologyBackFill fills the same gaps as the date by date reference of
+    Rendvi's filter method, on a climatology shorter than the archive used in production.
+    """
+    dekads = LocalRendvi(syntheticCube("modis", years, size), "ndvi").getDekadImages()
+    despiked = dekads.applyDespike(window=30, step=10)
+    climatology = dekads.calcClimatology()
+
+    values = despiked.DS["ndvi"].values
+    times = pd.DatetimeIndex(despiked.DS["time"].values)
+    expected = referenceBackFill(values, times, climatology)
+    filled = despiked.climatologyBackFill(climatology).DS["climatologyFilled"].values.astype(bool)
+
+    gaps = int(np.isnan(values).sum())
+    coverage = expected.sum() / max(gaps, 1)
+    passed = np.array_equal(filled, expected) and coverage >= minCoverage
+    print(f"backFill: {int(filled.sum())} of {gaps} gaps filled, reference {int(expected.sum())}, "
+          f"{int((filled != expected).sum())} pixels differ ({'ok' if passed else 'FAILED'})")
+    return passed
+
+
+CHECKS = {
+    "cacheMiss": checkCacheMiss,
+    "backFill": checkBackFill,
+}
+
+
+def main(checks=None):
+    """Run the named checks (all by default) and exit with 1 if any of them fails."""
+    names = list(CHECKS) if checks is None else (checks.split(",") if isinstance(checks, str) else list(checks))
+    failed = [name for name in names if not CHECKS[name]()]
+    if failed:
+        print(f"failed checks: {', '.join(failed)}")
+        sys.exit(1)
+    return
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -21,5 +21,6 @@ setup(name='rendvi',
     #         'rendvi = rendvi.cli:main',
     #     ],
     # },
-    install_requires=["earthengine-api", "fire", "pandas"]
+    install_requires=["earthengine-api", "fire", "pandas", "numpy", "xarray"],
+    extras_require={"zarr": ["zarr"], "cog": ["rioxarray"]}
 )